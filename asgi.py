@@ -0,0 +1,10 @@
+from jobserver.asgi import create_asgi_app
+
+app = create_asgi_app()
+
+
+if __name__ == '__main__':
+    import sys
+    import uvicorn
+    config_name = sys.argv[1] if len(sys.argv) > 1 else 'default'
+    uvicorn.run(create_asgi_app(config_name=config_name))
@@ -0,0 +1,104 @@
+"""
+Benchmark the API hot paths.
+
+* GET /jobs latency depending on the number of stored jobs
+* Job.to_dict(stringify=True) throughput for a finished job
+* authorization overhead of load_user_from_header_authorization for Basic
+  and Bearer authorization
+
+"""
+import base64
+from datetime import datetime as dt
+
+import bson
+import pandas as pd
+
+from jobserver.models.job import Job
+from jobserver.models.user import User
+from jobserver.auth.authorization import load_user_from_header_authorization
+from benchmarks.common import bench_app, measure
+
+
+def job_document(i):
+    now = dt.utcnow()
+    result = pd.DataFrame({'value': [float(j) for j in range(100)]})
+    return {
+        '_id': bson.ObjectId(),
+        'created': now,
+        'started': now,
+        'finished': now,
+        'time_sec': 1.0,
+        'script_name': 'summary',
+        'user_id': 'user_%d' % (i % 10),
+        'data': {'type': 'datafile', 'name': 'timeseries.csv'},
+        'script': {'name': 'summary', 'type': 'function', 'args': [],
+                   'kwargs': {}},
+        'result': result.describe().to_dict()
+    }
+
+
+def bench_listing(app, sizes):
+    client = app.test_client()
+    coll = Job.get_collection()
+    results = []
+
+    with app.app_context():
+        for size in sizes:
+            coll.delete_many({})
+            coll.insert_many([job_document(i) for i in range(size)])
+
+            res = measure(lambda: client.get('/jobs'), repeat=3)
+            res.update({'name': 'api.get_jobs', 'params': {'jobs': size}})
+            results.append(res)
+    return results
+
+
+def bench_to_dict(app, number):
+    doc = job_document(0)
+    with app.app_context():
+        job = Job.from_document(dict(doc))
+        view = Job.view_class(bson.raw_bson.RawBSONDocument(bson.encode(doc)))
+
+        model = measure(lambda: job.to_dict(stringify=True), number=number)
+        model.update({'name': 'api.to_dict', 'params': {'type': 'model'}})
+        view = measure(lambda: view.to_dict(stringify=True), number=number)
+        view.update({'name': 'api.to_dict', 'params': {'type': 'view'}})
+    return [model, view]
+
+
+def bench_auth(app, number):
+    app.config['API_V1_LOGIN'] = True
+    results = []
+
+    with app.app_context():
+        user = User(email='bench@jobserver.org', password='bench',
+                    activated=True, role='user')
+        user.create()
+
+        basic = base64.b64encode(b'bench@jobserver.org:bench').decode()
+        token = user.get_access_token()
+        if isinstance(token, bytes):
+            token = token.decode()
+
+        for method, header in (('basic', 'Basic %s' % basic),
+                               ('bearer', 'Bearer %s' % token)):
+            headers = {'Authorization': header}
+            with app.test_request_context('/jobs', headers=headers):
+                res = measure(load_user_from_header_authorization,
+                              number=number)
+            res.update({'name': 'api.auth', 'params': {'method': method}})
+            results.append(res)
+
+    app.config['API_V1_LOGIN'] = False
+    return results
+
+
+def run(quick=False, mongo_uri=None):
+    app = bench_app(mongo_uri)
+    sizes = (100, 1000) if quick else (100, 1000, 10000)
+    number = 100 if quick else 1000
+
+    results = bench_listing(app, sizes)
+    results.extend(bench_to_dict(app, number))
+    results.extend(bench_auth(app, number))
+    return results
@@ -0,0 +1,45 @@
+"""
+Benchmark reading DataFiles of different sizes.
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from jobserver.models.data_file import DataFile
+from benchmarks.common import measure
+
+
+def make_csv(path, rows):
+    df = pd.DataFrame(
+        np.random.gamma(4., 10., size=(rows, 4)),
+        columns=['a', 'b', 'c', 'd']
+    )
+    df.to_csv(path, index=None)
+
+
+def run(quick=False, mongo_uri=None):
+    sizes = (1000, 10000) if quick else (1000, 10000, 100000, 1000000)
+    tmp = tempfile.mkdtemp()
+    results = []
+
+    try:
+        for rows in sizes:
+            path = os.path.join(tmp, 'bench_%d.csv' % rows)
+            make_csv(path, rows)
+            f = DataFile(path=path)
+
+            res = measure(f.read_data, repeat=3)
+            mb = os.path.getsize(path) / 1024. / 1024.
+            res.update({
+                'name': 'datafile.read_data',
+                'params': {'rows': rows, 'size_mb': mb},
+                'mb_per_sec': mb / res['median']
+            })
+            results.append(res)
+    finally:
+        shutil.rmtree(tmp)
+
+    return results
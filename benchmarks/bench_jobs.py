@@ -0,0 +1,70 @@
+"""
+Benchmark the job lifecycle.
+
+Jobs are created by PUT /job, started by GET /job/<id>/run and the benchmark
+waits until all of them are finished. The script is a no-op, so the
+benchmark measures the overhead of the jobserver itself: request handling,
+data and script loading, the Thread start and all database writes.
+"""
+import time
+
+from bson import ObjectId
+
+from jobserver.registry import registry
+from jobserver.models.job import Job
+from benchmarks.common import bench_app
+
+
+def bench_noop(data):
+    return data
+
+
+def wait_finished(ids, timeout=120):
+    _filter = {'_id': {'$in': ids},
+               '$or': [{'finished': {'$ne': None}}, {'error': True}]}
+    coll = Job.get_collection()
+    t1 = time.perf_counter()
+    while coll.count_documents(_filter) < len(ids):
+        if time.perf_counter() - t1 > timeout:
+            raise RuntimeError('The jobs did not finish within %d sec.'
+                               % timeout)
+        time.sleep(0.002)
+
+
+def run(quick=False, mongo_uri=None):
+    app = bench_app(mongo_uri)
+    registry.register(bench_noop)
+    client = app.test_client()
+    n_jobs = 20 if quick else 200
+
+    with app.app_context():
+        # submit and run all jobs
+        t1 = time.perf_counter()
+        ids = []
+        for i in range(n_jobs):
+            res = client.put('/job', json={
+                'script_name': 'bench_noop',
+                'raw_data': [i, i + 1, i + 2]
+            })
+            job_id = res.get_json()['_id']
+            client.get('/job/%s/run' % job_id)
+            ids.append(ObjectId(job_id))
+        submitted = time.perf_counter() - t1
+
+        wait_finished(ids)
+        elapsed = time.perf_counter() - t1
+
+        # mean time from creation to finish
+        docs = Job.get_collection().find({'_id': {'$in': ids}},
+                                         {'created': 1, 'finished': 1})
+        latency = [(d['finished'] - d['created']).total_seconds()
+                   for d in docs if d.get('finished') is not None]
+
+    return [{
+        'name': 'jobs.lifecycle',
+        'params': {'jobs': n_jobs},
+        'jobs_per_sec': n_jobs / elapsed,
+        'submit_per_sec': n_jobs / submitted,
+        'mean_latency': sum(latency) / len(latency) if latency else None,
+        'errors': n_jobs - len(latency)
+    }]
@@ -0,0 +1,121 @@
+"""
+Benchmark model instances against read-only document views.
+
+Compares time and allocated memory of hydrating a listing of Job documents
+into Job model instances (as MongoModel.get_all does) against wrapping the
+raw BSON documents into DocumentView instances (MongoModel.get_all with
+view=True). The documents are BSON encoded up front, so no database is
+needed and only the decoding and serialization cost is measured.
+
+Run like:
+
+.. code-block:: bash
+
+    python -m benchmarks.bench_views --docs 20000
+
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from datetime import datetime as dt
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from jobserver.models.job import Job
+
+
+def make_documents(n):
+    """Build n BSON encoded finished Job documents"""
+    now = dt.utcnow()
+    docs = []
+    for i in range(n):
+        doc = {
+            '_id': bson.ObjectId(),
+            'created': now,
+            'started': now,
+            'finished': now,
+            'edited': now,
+            'time_sec': 1.5,
+            'script_name': 'summary',
+            'user_id': 'user_%d' % (i % 50),
+            'data': {
+                'type': 'datafile',
+                'path': '/data/timeseries.csv',
+                'name': 'timeseries.csv',
+                'size': '566 KB'
+            },
+            'script': {
+                'name': 'summary',
+                'type': 'function',
+                'args': [],
+                'kwargs': {}
+            },
+            'result': {
+                'value': {k: float(j) for j, k in enumerate(
+                    ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+                )}
+            }
+        }
+        docs.append(bson.encode(doc))
+    return docs
+
+
+def hydrate_models(raw_docs, serialize):
+    models = [Job.from_document(bson.decode(b)) for b in raw_docs]
+    if serialize:
+        return [m.to_dict(stringify=True) for m in models]
+    return [m.finished for m in models]
+
+
+def hydrate_views(raw_docs, serialize):
+    views = (Job.view_class(RawBSONDocument(b)) for b in raw_docs)
+    if serialize:
+        return [v.to_dict(stringify=True) for v in views]
+    return [v.finished for v in views]
+
+
+def measure(func, raw_docs, serialize):
+    # timing
+    t1 = time.perf_counter()
+    func(raw_docs, serialize)
+    elapsed = time.perf_counter() - t1
+
+    # allocations
+    tracemalloc.start()
+    result = func(raw_docs, serialize)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return {'seconds': elapsed, 'peak_bytes': peak}
+
+
+def run(quick=False, mongo_uri=None, n_docs=None):
+    if n_docs is None:
+        n_docs = 1000 if quick else 10000
+    raw_docs = make_documents(n_docs)
+
+    results = []
+    for serialize in (True, False):
+        for name, func in (('model', hydrate_models), ('view', hydrate_views)):
+            res = measure(func, raw_docs, serialize)
+            res.update({
+                'name': 'views.listing',
+                'params': {
+                    'type': name,
+                    'mode': 'to_dict' if serialize else 'single_field',
+                    'docs': n_docs
+                }
+            })
+            results.append(res)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--docs', type=int, default=10000)
+    args = parser.parse_args()
+
+    print(json.dumps(run(n_docs=args.docs), indent=4))
@@ -0,0 +1,122 @@
+"""
+Shared helpers of the benchmark suite.
+
+The benchmarks run offline. Instead of a MongoDB server, the application is
+connected to an in-memory mongomock client, which has to be installed:
+
+.. code-block:: bash
+
+    pip install mongomock
+
+As mongomock is much slower than a real server for large collections, the
+absolute numbers are only comparable between runs on the same machine. To
+benchmark against a local mongod instead, pass a MongoDB URI to the runner.
+
+"""
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from jobserver.app import create_app
+from jobserver.models.mongo import mongo
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def bench_app(mongo_uri=None, **config):
+    """Create a Flask app connected to a fresh benchmark database
+
+    Parameters
+    ----------
+    mongo_uri : str
+        If given, the benchmark database is created on this server instead
+        of mongomock. The database 'jobserver_bench' will be dropped.
+    config : dict
+        Config values to be overwritten.
+
+    Returns
+    -------
+    app : flask.Flask
+
+    """
+    app = create_app('default')
+    app.config['API_V1_LOGIN'] = False
+    app.config['METRICS_MULTIPROC_DIR'] = None
+    app.config.update(config)
+
+    if mongo_uri is None:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('The benchmarks need mongomock: pip install mongomock')
+        mongo.cx = mongomock.MongoClient()
+    else:
+        from pymongo import MongoClient
+        mongo.cx = MongoClient(mongo_uri)
+    mongo.cx.drop_database('jobserver_bench')
+    mongo.db = mongo.cx['jobserver_bench']
+
+    return app
+
+
+def measure(func, repeat=5, number=1):
+    """Time func
+
+    Parameters
+    ----------
+    func : callable
+        Function without arguments.
+    repeat : int
+        Number of timed repetitions.
+    number : int
+        Number of calls per repetition.
+
+    Returns
+    -------
+    result : dict
+        min, median and mean seconds per call and calls per second based on
+        the median.
+
+    """
+    times = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - t1) / number)
+
+    median = statistics.median(times)
+    return {
+        'min': min(times),
+        'median': median,
+        'mean': statistics.mean(times),
+        'per_sec': 1. / median if median > 0 else None,
+        'repeat': repeat,
+        'number': number
+    }
+
+
+def environment():
+    """Describe the environment the benchmarks ran in"""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    with open(os.path.join(ROOT, 'VERSION')) as f:
+        version = f.read().strip()
+
+    return {
+        'version': version,
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    }
@@ -0,0 +1,69 @@
+"""
+Run the jobserver benchmark suite.
+
+The results are written as JSON, containing a description of the
+environment and one record per benchmark, so that they can be compared
+between releases.
+
+.. code-block:: bash
+
+    python -m benchmarks.run --quick --output bench.json
+
+"""
+import argparse
+import contextlib
+import json
+import sys
+from collections import OrderedDict
+
+from benchmarks import bench_views, bench_jobs, bench_api, bench_datafile
+from benchmarks.common import environment
+
+BENCHMARKS = OrderedDict([
+    ('views', bench_views),
+    ('jobs', bench_jobs),
+    ('api', bench_api),
+    ('datafile', bench_datafile),
+])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run jobserver benchmarks.')
+    parser.add_argument('--quick', action='store_true',
+                        help='use small sizes for a fast run')
+    parser.add_argument('--only', default=None,
+                        help='comma separated list of: %s'
+                             % ', '.join(BENCHMARKS.keys()))
+    parser.add_argument('--mongo-uri', default=None,
+                        help='benchmark against this MongoDB server instead '
+                             'of mongomock')
+    parser.add_argument('--output', default=None,
+                        help='write the JSON results to this file')
+    args = parser.parse_args(argv)
+
+    names = list(BENCHMARKS.keys())
+    if args.only is not None:
+        names = [n.strip() for n in args.only.split(',')]
+        unknown = [n for n in names if n not in BENCHMARKS]
+        if len(unknown) > 0:
+            parser.error('unknown benchmarks: %s' % ', '.join(unknown))
+
+    results = []
+    # the jobserver prints to stdout, keep it clean for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        for name in names:
+            print('running %s ...' % name)
+            results.extend(BENCHMARKS[name].run(quick=args.quick,
+                                                mongo_uri=args.mongo_uri))
+
+    output = json.dumps({'environment': environment(), 'results': results},
+                        indent=4)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ from flask import Blueprint, jsonify, current_app, g, request
 from flask_restful import Api
 
 from jobserver.auth.authorization import load_user_from_header_authorization
+from jobserver.ratelimit import limiter
 
 api_v1_blueprint = Blueprint('apiv1', __name__)
 apiv1 = Api(api_v1_blueprint)
@@ -46,6 +47,12 @@ def check_login_state():
         return response, status
 
 
+@api_v1_blueprint.before_request
+def check_rate_limit():
+    """Answer requests exceeding the rate limit by 429 Too Many Requests"""
+    return limiter.check()
+
+
 @api_v1_blueprint.route('/protected', methods=['GET', 'POST'])
 def protected():
     return jsonify({'user': g.user.to_dict(stringify=True)})
\ No newline at end of file
@@ -1,11 +1,16 @@
 """
 RESTful endpoint for handling data files
 """
-from flask import request, jsonify, make_response
+import os
+
+from flask import request, jsonify, send_file
 from flask_restful import Resource
 
 from jobserver.models.data_file import DataFile
+from jobserver.models.export import export_cache
 from jobserver.api import api_v1_blueprint, apiv1
+from jobserver.conditional import file_validators, is_not_modified, \
+    cache_headers
 
 
 class DataFileApi(Resource):
@@ -79,9 +84,12 @@ def get(name):
 
     Load a data file from the DATA_DIR. if the url parameter format was
     set, the content of the file will be returned. Supported formats are
-    'csv', 'json', 'html' and 'txt'.
+    'csv', 'json', 'html' and 'txt'. The exports are cached on disk, see
+    jobserver.models.export.
     If the parameter is omitted, only the DataFile instance is returned
-    as JSON response
+    as JSON response. The ETag and Last-Modified header are derived from the
+    mtime of the file, conditional requests are answered by 304 Not
+    Modified.
 
     Parameters
     ----------
@@ -105,31 +113,30 @@ def get(name):
                    'message': 'A data file of name %s was not found.' % name
                }), 404
 
+    # check for changes of the file
+    etag, modified = file_validators(f.path, request.args.get('format'))
+    headers = cache_headers(etag, modified)
+    if is_not_modified(request.headers, etag, modified):
+        return '', 304, headers
+
     # check if params are given
     if 'format' not in request.args:
-        return jsonify({
+        response = jsonify({
             'name': f.name(),
             'path': f.path,
             'size': f.size()
         })
+        response.headers.extend(headers)
+        return response
     else:
-        # load data
-        data = f.read()
-        fmt = request.args['format']
-        if fmt.lower() == 'csv':
-            mime = 'text/pain'
-            content = data.to_csv(sep=',', index=None)
-        elif fmt.lower() == 'json':
-            mime = 'application/json'
-            content = data.to_json()
-        elif fmt.lower() == 'html':
-            mime = 'text/html'
-            content = data.to_html()
-        else:
-            mime = 'text/plain'
-            content = data.to_csv(sep='\t')
-        response = make_response(content)
-        response.headers['Content-type'] = mime
+        # send the cached export
+        fmt = request.args['format'].lower()
+        fp = export_cache.open(f, fmt)
+        response = send_file(fp, mimetype=export_cache.mimetype(fmt),
+                             conditional=False)
+        response.content_length = os.fstat(fp.fileno()).st_size
+        for key, value in headers.items():
+            response.headers[key] = value
         return response
 
 
@@ -1,13 +1,17 @@
 """
 RESTful endpoint for handling data in MongoDB
 """
-from flask import request
+from flask import request, make_response
 from flask_restful import Resource
 from bson.errors import InvalidId, InvalidDocument
 
 from jobserver.api import apiv1
 from jobserver.models.data_mongo import DataMongo
 from jobserver.auth.authorization import get_user_bound_filter
+from jobserver.conditional import VALIDATOR_FIELDS, document_validators, \
+    is_conditional, is_not_modified, cache_headers, make_etag
+from jobserver.errors import UnsupportedFormatError
+from jobserver.models.result import MIMETYPES, negotiate, serialize
 
 
 class DataMongoApi(Resource):
@@ -16,7 +20,12 @@ class DataMongoApi(Resource):
 
         Returns a Data Object, which is any kind of JSON serializable object.
         These objects might return big amounts of data in the response body
-        of this request.
+        of this request. Therefore, conditional requests are answered by 304
+        Not Modified, without loading the data.
+
+        The data can be requested as 'arrow', 'parquet' or 'msgpack' by the
+        Accept header or the URL parameter format, see
+        jobserver.models.result.
 
         Parameters
         ----------
@@ -32,6 +41,24 @@ class DataMongoApi(Resource):
         # get the filter
         _filter = get_user_bound_filter(['admin'])
 
+        try:
+            fmt = negotiate(request.headers.get('Accept'),
+                            request.args.get('format'))
+        except UnsupportedFormatError as e:
+            return {'status': 406, 'message': str(e)}, 406
+
+        # answer conditional requests by the timestamps only
+        if is_conditional(request.headers):
+            stamps = DataMongo.get(_id=data_id, filter=dict(_filter),
+                                   fields=VALIDATOR_FIELDS)
+            if stamps is not None:
+                etag, modified = document_validators(stamps)
+                if is_not_modified(request.headers, make_etag(etag, fmt),
+                                   modified):
+                    headers = cache_headers(make_etag(etag, fmt), modified)
+                    headers['Vary'] = 'Accept'
+                    return '', 304, headers
+
         # get the data object
         data = DataMongo.get(_id=data_id, filter=_filter)
         if data is None:
@@ -39,8 +66,22 @@ class DataMongoApi(Resource):
                 'status': 405,
                 'message': 'Data Object ID not found'
             }, 405
-        else:
-            return data.to_dict(stringify=True), 200
+        etag, modified = document_validators(data)
+        # the representation depends on the Accept header
+        headers = cache_headers(make_etag(etag, fmt), modified)
+        headers['Vary'] = 'Accept'
+        if fmt == 'json':
+            return data.to_dict(stringify=True), 200, headers
+
+        # binary formats hold the data only
+        try:
+            body = serialize(fmt, data.read())
+        except UnsupportedFormatError as e:
+            return {'status': 406, 'message': str(e)}, 406
+        response = make_response(body)
+        response.headers['Content-Type'] = MIMETYPES[fmt]
+        response.headers.extend(headers)
+        return response
 
     def post(self, data_id):
         """ Edit a Data Object
@@ -211,20 +252,40 @@ class DataMongosApi(Resource):
         fields = dict(data=0)
 
         # get the data
-        data = DataMongo.get_all(filter=_filter, fields=fields)
+        data = [d.to_dict(stringify=True) for d in
+                DataMongo.get_all(filter=_filter, fields=fields, view=True)]
 
         # return
         return {
             'status': 200,
             'found': len(data),
-            'data': [d.to_dict(stringify=True) for d in data]
+            'data': data
         }, 200
 
     def delete(self):
+        """DELETE all Data Objects
+
+        Deletes all Data Objects the current user is allowed to see. The
+        deletion is done on the database server.
+
+        Returns
+        -------
+        response : dict
+            JSON response to this DELETE data request
+
+        """
+        # get the filter
+        _filter = get_user_bound_filter(['admin'])
+
+        success, total = DataMongo.delete_all(filter=_filter)
+
         return {
-            'status': 505,
-            'message': 'not implemented'
-        }, 505
+            'status': 200,
+            'acknowledged': success == total,
+            'deleted': success,
+            'total': total,
+            'message': 'Deleted %d of %d Data Objects' % (success, total)
+        }, 200
 
 
 apiv1.add_resource(DataMongoApi, '/data/<string:data_id>', endpoint='data')
@@ -1,20 +1,64 @@
 """
 RESTful endpoint for Job
 """
-from flask import request, jsonify, g
+from datetime import datetime as dt, timedelta
+import math
+
+from flask import request, jsonify, g, make_response, current_app
 from flask_restful import Resource
 from bson.errors import InvalidId
+from pymongo.errors import DuplicateKeyError
 
 from jobserver.models.job import Job
+from jobserver.models.profile import JobProfile
+from jobserver.scheduler import scheduler
 from jobserver.api import api_v1_blueprint, apiv1
 from jobserver.auth.authorization import get_user_bound_filter
-    
+from jobserver.conditional import VALIDATOR_FIELDS, document_validators, \
+    is_conditional, is_not_modified, cache_headers, make_etag
+from jobserver.errors import ScriptNotFoundError, ScriptArgumentError, \
+    ResourceLimitError, UnsupportedFormatError, DisabledError, \
+    JobExecutionRestrictedError
+from jobserver.models.result import ResultStore, MIMETYPES, negotiate, \
+    serialize
+
+
+def get_idempotency_key(data=None):
+    """Return the idempotency key of the request
+
+    The key is read from the 'Idempotency-Key' header or from the
+    'request_id' field of the request data. None, if there is no key.
+
+    """
+    key = request.headers.get('Idempotency-Key')
+    if key is None and data is not None:
+        key = data.pop('request_id', None)
+    return str(key) if key is not None else None
+
+
+def job_cache_headers(job, fmt=None):
+    """Return the caching headers of a Job
+
+    Finished Jobs may be reused by the client for HTTP_CACHE_MAX_AGE
+    seconds. The format of the response is part of the ETag.
+
+    """
+    etag, modified = document_validators(job)
+    if fmt is not None:
+        etag = make_etag(etag, fmt)
+    max_age = None
+    if job.finished is not None:
+        max_age = current_app.config.get('HTTP_CACHE_MAX_AGE')
+    return cache_headers(etag, modified, max_age=max_age)
+
 
 class JobApi(Resource):
     def get(self, job_id):
         """GET Job
 
-        GET request for an Job of id job_id
+        GET request for an Job of id job_id. The response has an ETag and
+        a Last-Modified header. Conditional requests are answered by 304 Not
+        Modified without loading the Job, see jobserver.conditional.
 
         Parameters
         ----------
@@ -30,6 +74,15 @@ class JobApi(Resource):
         # check if a user is logged in 
         _filter = get_user_bound_filter(roles=['admin'])
 
+        # answer conditional requests by the timestamps only
+        if is_conditional(request.headers):
+            stamps = Job.get(job_id, filter=dict(_filter),
+                             fields=VALIDATOR_FIELDS)
+            if stamps is not None:
+                etag, modified = document_validators(stamps)
+                if is_not_modified(request.headers, etag, modified):
+                    return '', 304, job_cache_headers(stamps)
+
         # get the Job
         job = Job.get(job_id, filter=_filter)
 
@@ -37,7 +90,7 @@ class JobApi(Resource):
         if job is None:
             return {'status': 404, 'message': 'No Job of id %s' % job_id}
         else:
-            return job.to_dict(stringify=True)
+            return job.to_dict(stringify=True), 200, job_cache_headers(job)
 
     def post(self, job_id):
         """POST request
@@ -97,26 +150,40 @@ class JobApi(Resource):
             JSON response to this PUT Request
 
         """
-        # check for existing job id
-        if Job.id_exists(job_id):
-            return {
-                'status': 409,
-                'message': 'A job of id %s already exists' % job_id
-            }, 409
-
         # get the passed data
         data = request.get_json()
         if data is None:
             data = dict()
+        request_id = get_idempotency_key(data)
 
         # if a user is logged in, bind the job to this user
         _filter = get_user_bound_filter(roles=['admin'])
         data.update(_filter)
 
+        # check for existing job id
+        if Job.id_exists(job_id):
+            # a retried request returns the existing job
+            job = Job.get(job_id, filter=_filter)
+            if request_id is not None and job is not None and \
+                    job.request_id == request_id:
+                return job.to_dict(stringify=True), 200
+            return {
+                'status': 409,
+                'message': 'A job of id %s already exists' % job_id
+            }, 409
+
         # create the Job
         try:
             job = Job(_id=job_id, **data)
+            if request_id is not None:
+                Job.ensure_indexes()
+                job.request_id = request_id
             job.create()
+        except DuplicateKeyError:
+            return {
+                'status': 409,
+                'message': 'A job of id %s already exists' % job_id
+            }, 409
         except InvalidId as e:
             return {'status': 505, 'message': str(e)}, 505
         except Exception as e:
@@ -167,11 +234,12 @@ class JobsApi(Resource):
         _filter = get_user_bound_filter(roles=['admin'])
 
         # get the jobs
-        jobs = Job.get_all(filter=_filter)
+        jobs = [job.to_dict(stringify=True)
+                for job in Job.get_all(filter=_filter, view=True)]
 
         return {
             'found': len(jobs),
-            'jobs': [job.to_dict(stringify=True) for job in jobs]
+            'jobs': jobs
         }, 200
 
     def post(self):
@@ -198,11 +266,12 @@ class JobsApi(Resource):
         _filter = {"$and": [user_filter, body]}
 
         # get the jobs
-        jobs = Job.get_all(filter=_filter)
+        jobs = [job.to_dict(stringify=True)
+                for job in Job.get_all(filter=_filter, view=True)]
 
         return {
             'found': len(jobs),
-            'jobs': [job.to_dict(stringify=True) for job in jobs]
+            'jobs': jobs
         }, 200
 
     def delete(self):
@@ -218,9 +287,88 @@ class JobsApi(Resource):
                 'message': 'Deleted %d of %d Jobs' % (success, total)}, 200
 
 
+class JobTimingsApi(Resource):
+    def get(self):
+        """Aggregated Job phase timings
+
+        Returns the 50th, 95th and 99th percentile of each recorded phase of
+        the Job execution per script. Only Jobs started within the last
+        'hours' (URL parameter, default 24) are used. The URL parameter
+        'script' can be used to limit the response to a single script. If
+        Authentication is enabled, only Jobs of the current user are used,
+        unless the user is an admin. At most the JOB_TIMINGS_LIMIT most
+        recent Jobs are used.
+
+        Returns
+        -------
+        response : JSON
+            A JSON serialized response of the timing percentiles
+
+        """
+        # check if a user is logged in
+        _filter = get_user_bound_filter(roles=['admin'])
+
+        # build the time window
+        try:
+            hours = float(request.args.get('hours', 24))
+            if not (math.isfinite(hours) and hours > 0):
+                raise ValueError(hours)
+            since = dt.utcnow() - timedelta(hours=hours)
+        except (ValueError, OverflowError):
+            # also rejects windows reaching before the year 1
+            return {
+                'status': 400,
+                'message': 'hours has to be a positive number.'
+            }, 400
+        _filter.update({'started': {'$gte': since}})
+
+        if request.args.get('script') is not None:
+            _filter.update({'script.name': request.args.get('script')})
+
+        stats, found = Job.timing_stats(
+            filter=_filter,
+            limit=current_app.config.get('JOB_TIMINGS_LIMIT')
+        )
+
+        return {
+            'status': 200,
+            'since': str(since),
+            'found': found,
+            'scripts': stats
+        }, 200
+
+
+class JobQueueApi(Resource):
+    def get(self):
+        """Scheduler status
+
+        Returns the number of workers, running and queued Jobs. Admins get
+        the queue length of every user, other users only their own.
+
+        Returns
+        -------
+        response : JSON
+            A JSON serialized response of the scheduler status
+
+        """
+        # check if a user is logged in
+        _filter = get_user_bound_filter(roles=['admin'])
+
+        stats = scheduler.stats()
+        if 'user_id' in _filter:
+            stats['queues'] = {
+                k: v for k, v in stats['queues'].items()
+                if k == _filter['user_id']
+            }
+
+        return stats, 200
+
+
 # add the resources
 apiv1.add_resource(JobApi, '/job/<string:job_id>', endpoint='job')
 apiv1.add_resource(JobsApi, '/jobs', endpoint='jobs')
+apiv1.add_resource(JobTimingsApi, '/jobs/timings', endpoint='job_timings')
+apiv1.add_resource(JobQueueApi, '/jobs/queue', endpoint='job_queue')
 
 
 @api_v1_blueprint.route('/job', methods=['PUT'])
@@ -231,6 +379,10 @@ def put_job_without_id():
     preferred method for creating new jobs, as the job_id input has to match
     the MongoDB id pattern.
 
+    A client can send an 'Idempotency-Key' header or a 'request_id' field.
+    Retrying the request with the same key returns the Job created by the
+    first request with status 200, instead of creating another one.
+
     Returns
     -------
     response : dict
@@ -242,22 +394,37 @@ def put_job_without_id():
     if data is None:
         data = dict()
 
+    request_id = get_idempotency_key(data)
+
     # if a user is logged in, bind the job to this user 
     _filter = get_user_bound_filter(roles=['admin'])
     data.update(_filter)
     
     # create the Job
     try:
-        job = Job(**data)
-        job.create()
+        if request_id is None:
+            job, created = Job(**data), True
+            job.create()
+        else:
+            job, created = Job.create_once(request_id, **data)
     except Exception as e:
         return jsonify({'status': 500, 'message': str(e)}), 500
 
-    return jsonify(job.to_dict(stringify=True)), 201
+    return jsonify(job.to_dict(stringify=True)), 201 if created else 200
 
 
 @api_v1_blueprint.route('/job/<string:job_id>/run', methods=['GET', 'POST', 'PUT'])
 def run_job(job_id):
+    """Run Job
+
+    Start the Job of job_id. A Job is executed only once, concurrent and
+    repeated run requests are answered by 409. If the request sends an
+    'Idempotency-Key' header, a retry with the same key returns the already
+    running Job with status 202. The claim of a Job, which was submitted
+    but never started, lapses after JOB_CLAIM_TIMEOUT seconds, e.g. if the
+    server restarted meanwhile.
+
+    """
     # check if a user is logged in 
     _filter = get_user_bound_filter(roles=['admin'])
     
@@ -270,19 +437,172 @@ def run_job(job_id):
             'message': 'No Job of id %s' % job_id
         }), 404
 
-    # start the job
-    if job.started is None:
-#        try:
-        job.start()
+    # claim the job, so that it is started only once
+    run_key = get_idempotency_key()
+    timeout = current_app.config.get('JOB_CLAIM_TIMEOUT')
+    if job.claim(run_key=run_key, timeout=timeout):
+        try:
+            job.start()
+        except (DisabledError, JobExecutionRestrictedError) as e:
+            job.release()
+            return jsonify({'status': 403, 'message': str(e)}), 403
+        except (ScriptNotFoundError, ScriptArgumentError,
+                ResourceLimitError, ValueError) as e:
+            # includes invalid resources and priorities
+            job.release()
+            return jsonify({'status': 400, 'message': str(e)}), 400
+        except Exception:
+            job.release()
+            raise
 #        except Exception as e:
 #            return jsonify({'status': 500, 'message': str(e)}), 500
 
         # return the job
         return jsonify(job.to_dict(stringify=True)), 202
 
+    # a retried run request returns the running job
+    job = Job.get(job_id, filter=_filter)
+    if job is not None and run_key is not None and job.run_key == run_key:
+        return jsonify(job.to_dict(stringify=True)), 202
+
     # job was already started
     else:
         return jsonify({
             'status': 409,
             'message': 'The job %s was already started' % job_id
         }), 409
+
+
+@api_v1_blueprint.route('/job/<string:job_id>/profile', methods=['GET'])
+def get_job_profile(job_id):
+    """GET Job profile
+
+    Return the profiling report of a Job that was run with the 'profile'
+    flag set. The report lists the functions with the highest cumulative
+    time. If the URL parameter format=pstats is given, the raw pstats data
+    is returned as file download instead, which can be loaded by
+    pstats.Stats.
+
+    Parameters
+    ----------
+    job_id : string
+        ObjectId of the profiled Job.
+
+    Returns
+    -------
+    response : dict
+        JSON response to this GET Request
+
+    """
+    # check if a user is logged in
+    _filter = get_user_bound_filter(roles=['admin'])
+
+    # the user needs access to the job
+    job = Job.get(job_id, filter=_filter, fields={'_id': 1})
+    if job is None:
+        return jsonify({
+            'status': 404,
+            'message': 'No Job of id %s' % job_id
+        }), 404
+
+    profile = JobProfile.get(job.id)
+    if profile is None:
+        return jsonify({
+            'status': 404,
+            'message': 'The job %s has no profile' % job_id
+        }), 404
+
+    # return the raw stats
+    if request.args.get('format', '').lower() == 'pstats':
+        if profile.stats is None:
+            return jsonify({
+                'status': 404,
+                'message': 'No pstats data stored for job %s' % job_id
+            }), 404
+        response = make_response(bytes(profile.stats))
+        response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['Content-Disposition'] = \
+            'attachment; filename=%s.pstats' % job_id
+        return response
+
+    return jsonify({
+        'job_id': job_id,
+        'created': str(profile.created),
+        'has_stats': profile.stats is not None,
+        'report': profile.report
+    }), 200
+
+
+@api_v1_blueprint.route('/job/<string:job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """GET Job result
+
+    Return the result of a finished Job. The format is negotiated by the
+    Accept header or set by the URL parameter format: 'json' (default),
+    'arrow', 'parquet' or 'msgpack', see jobserver.models.result.
+
+    Parameters
+    ----------
+    job_id : string
+        ObjectId of the Job.
+
+    Returns
+    -------
+    response : flask.Response
+        The result in the requested format.
+
+    """
+    # check if a user is logged in
+    _filter = get_user_bound_filter(roles=['admin'])
+
+    try:
+        fmt = negotiate(request.headers.get('Accept'),
+                        request.args.get('format'))
+    except UnsupportedFormatError as e:
+        return jsonify({'status': 406, 'message': str(e)}), 406
+
+    # answer conditional requests by the timestamps only
+    if is_conditional(request.headers):
+        stamps = Job.get(job_id, filter=dict(_filter),
+                         fields=VALIDATOR_FIELDS)
+        if stamps is not None and stamps.finished is not None:
+            etag, modified = document_validators(stamps)
+            if is_not_modified(request.headers, make_etag(etag, fmt),
+                               modified):
+                headers = job_cache_headers(stamps, fmt)
+                headers['Vary'] = 'Accept'
+                return '', 304, headers
+
+    fields = dict(VALIDATOR_FIELDS, result=1, coalesced_with=1)
+    job = Job.get(job_id, filter=_filter, fields=fields)
+    if job is None:
+        return jsonify({
+            'status': 404,
+            'message': 'No Job of id %s' % job_id
+        }), 404
+    if job.finished is None:
+        return jsonify({
+            'status': 404,
+            'message': 'The job %s has no result' % job_id
+        }), 404
+
+    # the representation depends on the Accept header
+    headers = job_cache_headers(job, fmt)
+    headers['Vary'] = 'Accept'
+    if fmt == 'json':
+        return jsonify(job.result), 200, headers
+
+    # use the stored table of DataFrame results
+    value = ResultStore.load(job.coalesced_with or job.id)
+    if value is None:
+        value = job.result
+
+    try:
+        body = serialize(fmt, value)
+    except UnsupportedFormatError as e:
+        return jsonify({'status': 406, 'message': str(e)}), 406
+
+    response = make_response(body)
+    response.headers['Content-Type'] = MIMETYPES[fmt]
+    response.headers.extend(headers)
+    return response
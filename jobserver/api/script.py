@@ -1,56 +1,46 @@
 """
 RESTful endpoint for meta data about the available scripts
 """
-import inspect
-
+from flask import request
 from flask_restful import Resource
 
-from jobserver.util import load_script_func
-from jobserver.app import scripts
+from jobserver.errors import ScriptNotFoundError
+from jobserver.registry import registry
 from jobserver.api import apiv1
 
 
 class ScriptApi(Resource):
     def get(self, name):
-        # load the function
+        # load the script
         try:
-            func = load_script_func(module='scripts', name=name)
-        except Exception as e:
-            # TODO: catch more specific here
-            return {'status': 500, 'message': str(e)}, 500
+            spec = registry.get(name)
+        except ScriptNotFoundError as e:
+            return {'status': 404, 'message': str(e)}, 404
 
-        return {
-            'name': name,
-            'description': func.__doc__,
-            'parameters': func.__code__.co_varnames
-        }
+        return spec.to_dict()
 
 
 class ScriptsApi(Resource):
     def get(self):
-        # define little helper
-        def _check(func_name):
-            if func_name.startswith('_'):
-                return False
-            elif func_name == 'on_init':
-                return False
-            elif inspect.ismodule(getattr(scripts, func_name)):
-                return False
-            else:
-                return True
-
-        # get all functions in scripts
-        f_list = [getattr(scripts, n) for n in scripts.__dir__() if _check(n)]
-
-        # return
-        return {
-            'found': len(f_list),
-            'scripts': [{
-                'name': f.__name__,
-                'description': f.__doc__,
-                'parameters': f.__code__.co_varnames
-            } for f in f_list]
-        }
+        """Get all scripts
+
+        The listing is built once by the registry. It is sent along with an
+        ETag, a request with a matching If-None-Match header is answered by
+        304 Not Modified.
+
+        Returns
+        -------
+        response : JSON
+            A JSON serialized response of all registered scripts
+
+        """
+        payload, etag = registry.listing()
+        headers = {'ETag': '"%s"' % etag}
+
+        if request.if_none_match.contains_weak(etag):
+            return '', 304, headers
+
+        return payload, 200, headers
 
 
 # add the resources
@@ -1,10 +1,14 @@
 import os
+import time
 
-from flask import Flask, request
+from flask import Flask, request, g
 
-from jobserver import scripts
+from jobserver import scripts, metrics
 from jobserver.config import config
 from jobserver.models.mongo import mongo
+from jobserver.models.mongo_async import async_mongo
+from jobserver.loader import loader
+from jobserver.ratelimit import limiter
 
 APP_PATH = os.path.abspath(os.path.dirname(__file__))
 
@@ -17,6 +21,10 @@ def create_app(config_name='default'):
 
     # initialize the MongoDB connection
     mongo.init_app(app)
+    async_mongo.init_app(app)
+
+    # limit the request rates
+    limiter.init_app(app)
 
     # add Blueprints
     from jobserver.api import api_v1_blueprint
@@ -28,41 +36,90 @@ def create_app(config_name='default'):
     from jobserver.main import main_blueprint
     app.register_blueprint(main_blueprint)
 
+    # start the job workers
+    from jobserver.scheduler import scheduler
+    scheduler.init_app(app)
+
+    # start archiving old finished jobs, in one process at a time
+    from jobserver.models.retention import retention
+    retention.init_app(app)
+
+    # cache the data file exports
+    from jobserver.models.export import export_cache
+    export_cache.init_app(app)
+
+    # compress responses and decompress request bodies
+    from jobserver.compression import compression
+    compression.init_app(app)
+
+    # collect request metrics
+    if app.config.get('METRICS_ENABLED'):
+        metrics.registry.configure(
+            multiproc_dir=app.config.get('METRICS_MULTIPROC_DIR'),
+            dump_interval=app.config.get('METRICS_DUMP_INTERVAL', 5.0)
+        )
+
+        @app.before_request
+        def start_request_timer():
+            g.request_start = time.perf_counter()
+
+        @app.after_request
+        def record_request_time(response):
+            start = g.get('request_start')
+            if start is not None:
+                metrics.http_request_time.labels(
+                    request.endpoint or 'unmatched',
+                    request.method,
+                    response.status_code
+                ).observe(time.perf_counter() - start)
+            metrics.registry.maybe_dump()
+            return response
+
+    # register the script functions
+    loader.init_app(app)
+
     # as a last step, call the scripts on_init function
     scripts.on_init(app)
 
     # set CORS
     @app.after_request
     def after_request(response):
-        # this can be handled better
-        request_origin = request.headers.get('origin')
-        origins = [
-            "http://localhost:4200",
-            "http://localhost, ",
-            "http://localhost:5000"
-            ]
-        if request_origin is None:
-            origin = origins[0]
-
-        elif request_origin in origins or '*' in origins:
-            origin = request_origin
-        else:
-            origin = '*'
-        allowed = "origin, x-requested-with, content-type, accept, " \
-                  "authorization"
-        methods = "GET, PUT, POST, DELETE, OPTIONS"
-
-        # set the HEADERS
-        response.headers["Access-Control-Allow-Origin"] = origin
-        response.headers["Access-Control-Allow-Methods"] = methods
-        response.headers["Access-Control-Allow-Credentials"] = "true"
-        response.headers["Access-Control-Allow-Headers"] = allowed
+        headers = cors_headers(request.headers.get('origin'))
+        for key, value in headers.items():
+            response.headers[key] = value
 
         return response
 
     return app
 
 
+def cors_headers(request_origin):
+    """Build the CORS headers for the given request origin"""
+    # this can be handled better
+    origins = [
+        "http://localhost:4200",
+        "http://localhost, ",
+        "http://localhost:5000"
+        ]
+    if request_origin is None:
+        origin = origins[0]
+
+    elif request_origin in origins or '*' in origins:
+        origin = request_origin
+    else:
+        origin = '*'
+    allowed = "origin, x-requested-with, content-type, accept, " \
+              "authorization"
+    methods = "GET, PUT, POST, DELETE, OPTIONS"
+
+    return {
+        "Access-Control-Allow-Origin": origin,
+        "Access-Control-Allow-Methods": methods,
+        "Access-Control-Allow-Credentials": "true",
+        "Access-Control-Allow-Headers": allowed
+    }
+
+
 if __name__ == '__main__':
     import sys
     config_name = sys.argv[1] if len(sys.argv) > 1 else 'default'
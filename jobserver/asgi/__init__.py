@@ -0,0 +1,128 @@
+"""
+ASGI serving mode.
+
+The ASGI application runs the I/O bound endpoints, which are typically hit
+by many long-polling or streaming clients, natively on the event loop:
+
+* GET /job/<job_id>
+* GET /jobs
+* GET /job/<job_id>/events (server-sent events of the Job status)
+
+Authorization of these routes is async as well. Any other request is
+passed to the Flask app, which runs in a thread pool. Thus, a single process
+can hold thousands of idle connections. The ASGI mode needs some optional
+dependencies:
+
+.. code-block:: bash
+
+    pip install jobserver[asgi]
+    uvicorn asgi:app
+
+"""
+import asyncio
+import math
+import re
+import time
+from functools import partial
+
+from jobserver import metrics
+from jobserver.app import create_app, cors_headers
+from jobserver.asgi.auth import load_user
+from jobserver.asgi.http import Request, JSONResponse
+from jobserver.asgi.views import ROUTES
+from jobserver.compression import compression
+from jobserver.models.mongo_async import async_mongo
+from jobserver.ratelimit import limiter, too_many_requests
+
+
+class AsgiApp:
+    def __init__(self, flask_app):
+        from asgiref.wsgi import WsgiToAsgi
+
+        self.flask_app = flask_app
+        self.config = flask_app.config
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.routes = [(m, re.compile(p + '$'), e, v) for m, p, e, v in ROUTES]
+        if not async_mongo.enabled:
+            raise RuntimeError('The ASGI mode needs motor. Install it by: '
+                               'pip install jobserver[asgi]')
+
+    def match(self, method, path):
+        for route_method, pattern, endpoint, view in self.routes:
+            if route_method != method:
+                continue
+            match = pattern.match(path)
+            if match is not None:
+                return endpoint, view, match.groupdict()
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            route = self.match(scope['method'].upper(), scope['path'])
+            if route is not None:
+                return await self.handle(route, scope, receive, send)
+        return await self.wsgi(scope, receive, send)
+
+    async def handle(self, route, scope, receive, send):
+        start = time.perf_counter()
+        endpoint, view, params = route
+        request = Request(scope, receive)
+        request.path_params = params
+
+        request.user, response = await load_user(request, self.config)
+        if response is None:
+            response = await self.check_rate_limit(endpoint, request)
+        if response is None:
+            response = await view(request, self.config)
+        self.compress(request, response)
+        response.headers.update(cors_headers(request.headers.get('origin')))
+        await response(send)
+
+        if self.config.get('METRICS_ENABLED'):
+            metrics.http_request_time.labels(
+                endpoint, request.method, response.status
+            ).observe(time.perf_counter() - start)
+            metrics.registry.maybe_dump()
+
+
+    @staticmethod
+    def compress(request, response):
+        """Compress the response, as the Flask app does"""
+        if not compression.enabled or response.status != 200 or \
+                not compression.compressible(response.media_type,
+                                             response.headers,
+                                             response.length):
+            return
+        encoding = compression.negotiate(
+            request.headers.get('accept-encoding'))
+        if encoding is not None:
+            response.compress(compression.encoder(encoding), encoding)
+
+    async def check_rate_limit(self, endpoint, request):
+        """Return a 429 response, if the request exceeds the rate limit"""
+        if not limiter.enabled:
+            return None
+
+        user = request.user
+        if user is not None:
+            identity, role, user_limits = str(user.id), user.role, \
+                user.rate_limits
+        else:
+            identity, role, user_limits = \
+                (request.scope.get('client') or ('unknown',))[0], None, None
+
+        # the mongo backend blocks, run it in the thread pool
+        allowed, retry_after = await asyncio.get_event_loop().run_in_executor(
+            None, partial(limiter.hit, request.method, endpoint, identity,
+                          role, user_limits)
+        )
+        if allowed:
+            return None
+        return JSONResponse(
+            too_many_requests(retry_after), 429,
+            headers={'Retry-After': str(int(math.ceil(retry_after)))}
+        )
+
+
+def create_asgi_app(config_name='default'):
+    return AsgiApp(create_app(config_name=config_name))
@@ -0,0 +1,78 @@
+"""
+Async counterpart of jobserver.auth.authorization for the native ASGI
+routes. The user is loaded by AsyncUser, the credentials are checked with
+the same password hashing and access tokens as the Flask API.
+"""
+import base64
+import binascii
+
+from itsdangerous import BadSignature, SignatureExpired
+
+from jobserver.asgi.http import error
+from jobserver.models.user import User, AsyncUser
+
+
+async def load_user(request, config):
+    """Load the user from the Authorization header
+
+    Returns
+    -------
+    user : AsyncUser
+        The logged in user, or None if the login is disabled.
+    response : jobserver.asgi.http.Response
+        An error response, if the authorization failed, else None.
+
+    """
+    # check if the login status shall be tested
+    if not config.get('API_V1_LOGIN'):
+        return None, None
+
+    auth_header = request.headers.get('authorization')
+    if auth_header is None:
+        return None, error(401, 'No HTTP Authorization HEADER found.')
+
+    password = None
+
+    # check the different supported Authorization methods
+    if auth_header.lower().startswith('basic'):
+        try:
+            enc = base64.b64decode(auth_header[6:]).decode()
+            email, password = enc.split(':', 1)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            return None, error(401, 'Malformed Basic Authorization.')
+        user = await AsyncUser.get_by_email(email)
+
+    elif auth_header.lower().startswith('bearer'):
+        try:
+            user_id = User.decode_access_token(auth_header[7:], config=config)
+        except SignatureExpired:
+            return None, error(401, 'Your access token has expired. Please '
+                                    'request a new one.')
+        except BadSignature:
+            return None, error(401, 'The passed access token was not valid.')
+        user = await AsyncUser.get(user_id)
+
+    else:
+        return None, error(501, 'Only Basic and Bearer Authorization are '
+                                'implemented')
+
+    # same checks as check_user_logged_in
+    if user is None:
+        return None, error(404, 'User not found.')
+    if not user.is_activated():
+        return None, error(405, 'Your account has not been activated.')
+    if password is not None and not user.verify_password(password):
+        return None, error(405, 'The password was incorrect')
+
+    return user, None
+
+
+def get_user_bound_filter(user, roles=[]):
+    """Same as jobserver.auth.authorization.get_user_bound_filter"""
+    if user is None:
+        return {}
+    role = user.role
+    if role is not None and (role.lower() in roles or
+                             role.lower() == 'superuser'):
+        return {}
+    return {'user_id': str(user.id)}
@@ -0,0 +1,137 @@
+"""
+Minimal request and response objects for the native ASGI routes.
+"""
+import json
+from urllib.parse import parse_qsl
+
+
+class Request:
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope['method'].upper()
+        self.path = scope['path']
+        self.headers = {
+            k.decode('latin-1').lower(): v.decode('latin-1')
+            for k, v in scope.get('headers', [])
+        }
+        self.args = dict(parse_qsl(scope.get('query_string', b'').decode()))
+        self.path_params = dict()
+        self.user = None
+        self.disconnected = False
+
+    async def body(self):
+        chunks = []
+        while True:
+            message = await self.receive()
+            if message['type'] == 'http.disconnect':
+                self.disconnected = True
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        return b''.join(chunks)
+
+    async def get_json(self):
+        body = await self.body()
+        if len(body) == 0:
+            return None
+        return json.loads(body.decode())
+
+    async def wait_disconnect(self):
+        """Wait until the client has closed the connection"""
+        while not self.disconnected:
+            message = await self.receive()
+            if message['type'] == 'http.disconnect':
+                self.disconnected = True
+
+
+class Response:
+    media_type = 'application/json'
+
+    def __init__(self, body=b'', status=200, headers=None, media_type=None):
+        self.body = body
+        self.status = status
+        self.headers = dict(headers or {})
+        self.encoder = None
+        if media_type is not None:
+            self.media_type = media_type
+
+    @property
+    def length(self):
+        """Size of the body in bytes, None if unknown"""
+        if isinstance(self.body, str):
+            return len(self.body.encode())
+        return len(self.body)
+
+    def compress(self, encoder, encoding):
+        """Compress the body by an encoder of jobserver.compression"""
+        self.encoder = encoder
+        self.headers['Content-Encoding'] = encoding
+        self.headers['Vary'] = 'Accept-Encoding'
+        etag = self.headers.get('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            self.headers['ETag'] = 'W/' + etag
+
+    def raw_headers(self):
+        headers = dict(self.headers)
+        headers.setdefault('Content-Type', self.media_type)
+        return [(k.lower().encode('latin-1'), str(v).encode('latin-1'))
+                for k, v in headers.items()]
+
+    async def __call__(self, send):
+        body = self.body
+        if isinstance(body, str):
+            body = body.encode()
+        if self.encoder is not None:
+            body = self.encoder.compress(body) + self.encoder.flush()
+        self.headers['Content-Length'] = len(body)
+        await send({'type': 'http.response.start', 'status': self.status,
+                    'headers': self.raw_headers()})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+class JSONResponse(Response):
+    def __init__(self, data, status=200, headers=None):
+        super(JSONResponse, self).__init__(
+            body=json.dumps(data), status=status, headers=headers
+        )
+
+
+class StreamingResponse(Response):
+    """Response sending the chunks of an async iterator as they come
+
+    Parameters
+    ----------
+    chunks : async iterator
+        Yields str or bytes chunks of the response body.
+
+    """
+    def __init__(self, chunks, status=200, headers=None, media_type=None):
+        super(StreamingResponse, self).__init__(
+            status=status, headers=headers, media_type=media_type
+        )
+        self.chunks = chunks
+
+    @property
+    def length(self):
+        return None
+
+    async def __call__(self, send):
+        await send({'type': 'http.response.start', 'status': self.status,
+                    'headers': self.raw_headers()})
+        async for chunk in self.chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if self.encoder is not None:
+                chunk = self.encoder.compress(chunk)
+                if not chunk:
+                    continue
+            await send({'type': 'http.response.body', 'body': chunk,
+                        'more_body': True})
+        last = self.encoder.flush() if self.encoder is not None else b''
+        await send({'type': 'http.response.body', 'body': last})
+
+
+def error(status, message):
+    return JSONResponse({'status': status, 'message': message}, status)
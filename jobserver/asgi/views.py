@@ -0,0 +1,141 @@
+"""
+Natively async routes of the ASGI serving mode.
+
+These are the I/O bound read endpoints, which are typically hit by many
+polling clients at once. They query MongoDB through AsyncJob and never
+block the event loop. All other routes are served by the Flask app.
+"""
+import asyncio
+import json
+
+from jobserver.asgi.auth import get_user_bound_filter
+from jobserver.asgi.http import Response, JSONResponse, StreamingResponse, \
+    error
+from jobserver.conditional import VALIDATOR_FIELDS, document_validators, \
+    is_conditional, is_not_modified, cache_headers
+from jobserver.models.job import AsyncJob
+
+# fields of a Job reported by the status events
+STATUS_FIELDS = ('_id', 'started', 'finished', 'time_sec', 'error',
+                 'message', 'heartbeat')
+
+
+async def _get_job(request, fields=None):
+    _filter = get_user_bound_filter(request.user, roles=['admin'])
+    return await AsyncJob.get(request.path_params['job_id'], filter=_filter,
+                              fields=fields)
+
+
+async def get_job(request, config):
+    """GET Job
+
+    Same response as the GET /job/<job_id> route of the Flask API,
+    including the handling of conditional requests.
+
+    """
+    if is_conditional(request.headers):
+        stamps = await _get_job(request, fields=VALIDATOR_FIELDS)
+        if stamps is not None:
+            etag, modified = document_validators(stamps)
+            if is_not_modified(request.headers, etag, modified):
+                return Response(b'', 304, _cache_headers(stamps, config))
+
+    job = await _get_job(request)
+    if job is None:
+        return error(404, 'No Job of id %s' % request.path_params['job_id'])
+    return JSONResponse(job.to_dict(stringify=True),
+                        headers=_cache_headers(job, config))
+
+
+def _cache_headers(job, config):
+    etag, modified = document_validators(job)
+    max_age = config.get('HTTP_CACHE_MAX_AGE') \
+        if job.finished is not None else None
+    return cache_headers(etag, modified, max_age=max_age)
+
+
+async def get_jobs(request, config):
+    """GET all Jobs
+
+    The Jobs are streamed from the cursor, so the listing is never held in
+    memory as a whole. As the number of Jobs is only known at the end, the
+    'found' field is sent last.
+
+    """
+    _filter = get_user_bound_filter(request.user, roles=['admin'])
+
+    async def chunks():
+        yield '{"jobs": ['
+        found = 0
+        async for job in AsyncJob.iter_all(filter=_filter, view=True):
+            yield (', ' if found > 0 else '') + \
+                json.dumps(job.to_dict(stringify=True))
+            found += 1
+        yield '], "found": %d}' % found
+
+    return StreamingResponse(chunks())
+
+
+def _event(name, data):
+    return 'event: %s\ndata: %s\n\n' % (name, json.dumps(data))
+
+
+async def job_events(request, config):
+    """Server-sent events of a Job
+
+    Sends a 'status' event whenever the status fields of the Job change. If
+    the Job finished, the full Job is sent as 'finished' event, if it
+    failed, an 'error' event is sent. Then the stream is closed. The Job is
+    polled every ASGI_POLL_INTERVAL seconds. Idle connections are kept alive
+    by a comment every ASGI_KEEPALIVE_INTERVAL seconds.
+
+    """
+    fields = {f: 1 for f in STATUS_FIELDS}
+    job = await _get_job(request, fields)
+    if job is None:
+        return error(404, 'No Job of id %s' % request.path_params['job_id'])
+
+    interval = config.get('ASGI_POLL_INTERVAL', 1.0)
+    keepalive = config.get('ASGI_KEEPALIVE_INTERVAL', 15.0)
+
+    async def chunks():
+        # detect closed connections while waiting
+        watcher = asyncio.ensure_future(request.wait_disconnect())
+        last, idle = None, 0.
+        try:
+            while not request.disconnected:
+                current = await AsyncJob.get(job.id, fields=fields)
+                if current is None:
+                    yield _event('error', {'message': 'Job was deleted.'})
+                    break
+
+                status = current.to_dict(stringify=True)
+                if current.finished is not None:
+                    full = await AsyncJob.get(job.id)
+                    yield _event('finished', full.to_dict(stringify=True))
+                    break
+                if current.error:
+                    yield _event('error', status)
+                    break
+                if status != last:
+                    yield _event('status', status)
+                    last, idle = status, 0.
+                elif idle >= keepalive:
+                    yield ': keepalive\n\n'
+                    idle = 0.
+
+                await asyncio.wait([watcher], timeout=interval)
+                idle += interval
+        finally:
+            watcher.cancel()
+
+    return StreamingResponse(chunks(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache'})
+
+
+# (method, path pattern, endpoint, view)
+ROUTES = [
+    ('GET', r'/job/(?P<job_id>[^/]+)', 'asgi.job', get_job),
+    ('GET', r'/jobs', 'asgi.jobs', get_jobs),
+    ('GET', r'/job/(?P<job_id>[^/]+)/events', 'asgi.job_events', job_events),
+]
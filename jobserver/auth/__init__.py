@@ -3,6 +3,7 @@ from flask_restful import Api
 
 from jobserver.auth.authorization import load_user_from_header_authorization,\
     login_required, user_route, role_required
+from jobserver.ratelimit import limiter
 
 auth_blueprint = Blueprint('auth', __name__)
 auth_api = Api(auth_blueprint)
@@ -34,3 +35,9 @@ def check_login_state():
     else:
         g.user = None
         return response, status
+
+
+@auth_blueprint.before_request
+def check_rate_limit():
+    """Answer requests exceeding the rate limit by 429 Too Many Requests"""
+    return limiter.check()
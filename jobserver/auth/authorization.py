@@ -118,6 +118,29 @@ def role_required(route=None, roles=['admin']):
     return role_checker
 
 
+def load_user(route):
+    """Load the user of the request into g.user
+
+    For routes outside of the api and auth blueprints, which load the user
+    before each request. Like the auth blueprint, requests without
+    authorization get no user, invalid authorizations are answered by their
+    error.
+
+    """
+    @wraps(route)
+    def user_loader(*args, **kwargs):
+        response, status = load_user_from_header_authorization()
+        if status == 200:
+            g.user = response
+        elif status == 401:
+            g.user = None
+        else:
+            g.user = None
+            return response.get_json(), status
+        return route(*args, **kwargs)
+    return user_loader
+
+
 def load_user_from_header_authorization():
     if 'Authorization' not in request.headers:
         return jsonify({
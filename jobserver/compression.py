@@ -0,0 +1,362 @@
+"""
+Compression of responses and request bodies.
+
+General
+-------
+Job results, data objects and datafile exports are large, but compress
+well. Responses are compressed if the client accepts one of the supported
+encodings and the body is larger than COMPRESSION_MIN_SIZE bytes. Streamed
+responses, like file downloads, are compressed chunk by chunk. Server-sent
+events and already encoded responses are never compressed.
+
+The supported encodings are 'gzip' and, if the optional packages are
+installed, 'br' (brotli) and 'zstd' (zstandard):
+
+.. code-block:: bash
+
+    pip install brotli zstandard
+
+Request bodies sent with a Content-Encoding header of one of these
+encodings, or 'deflate', are decompressed before they reach the views, so
+data objects and datafiles can be uploaded compressed. The bodies are
+decompressed in bounded steps, thus a small, highly compressed body cannot
+expand far beyond COMPRESSION_MAX_REQUEST_SIZE in memory. Brotli encoded
+bodies need brotli 1.2 or newer.
+
+The compression is configured by the application config:
+
+* COMPRESSION_ENABLED: turn the response compression on or off.
+* COMPRESSION_ENCODINGS: the encodings in order of preference, if the
+  client accepts several of them equally.
+* COMPRESSION_MIN_SIZE: do not compress smaller responses.
+* COMPRESSION_LEVEL: dict of the compression level per encoding.
+* COMPRESSION_MIMETYPES: compress only responses of these mimetypes.
+* COMPRESSION_MAX_REQUEST_SIZE: maximum size of a decompressed request
+  body. Larger requests are answered by 413.
+
+"""
+import io
+import json
+import zlib
+
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_LEVELS = {'gzip': 6, 'br': 4, 'zstd': 3}
+
+DEFAULT_MIMETYPES = ('application/json', 'text/csv', 'text/plain',
+                     'text/html')
+
+# maximum size of the decompressed output of a single step
+CHUNK_SIZE = 16 * 1024
+
+# zstd input fed per step. A slice expands to at most about 1 MB
+ZSTD_SLICE_SIZE = 32
+
+
+class GzipEncoder:
+    def __init__(self, level=6, wbits=31):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+class BrotliEncoder:
+    def __init__(self, level=4):
+        self._obj = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._obj.process(data)
+
+    def flush(self):
+        return self._obj.finish()
+
+
+class ZstdEncoder:
+    def __init__(self, level=3):
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+def available_encodings():
+    """Return the encodings supported by the installed packages"""
+    encodings = ['gzip']
+    if brotli is not None:
+        encodings.append('br')
+    if zstandard is not None:
+        encodings.append('zstd')
+    return encodings
+
+
+class ZlibDecoder:
+    def __init__(self, wbits=15):
+        self._obj = zlib.decompressobj(wbits)
+
+    def feed(self, data, write, size=CHUNK_SIZE):
+        while True:
+            out = self._obj.decompress(data, size)
+            write(out)
+            data = self._obj.unconsumed_tail
+            if not data and len(out) < size:
+                break
+
+    def finish(self):
+        if not self._obj.eof:
+            raise ValueError('The compressed body is truncated.')
+
+
+class BrotliDecoder:
+    def __init__(self):
+        self._obj = brotli.Decompressor()
+
+    def feed(self, data, write, size=CHUNK_SIZE):
+        write(self._obj.process(data, output_buffer_limit=size))
+        while not self._obj.can_accept_more_data():
+            write(self._obj.process(b'', output_buffer_limit=size))
+
+    def finish(self):
+        if not self._obj.is_finished():
+            raise ValueError('The compressed body is truncated.')
+
+
+class ZstdDecoder:
+    def __init__(self):
+        self._dctx = zstandard.ZstdDecompressor()
+        self._obj = self._dctx.decompressobj(write_size=CHUNK_SIZE)
+
+    def feed(self, data, write, size=CHUNK_SIZE):
+        # the output of decompressobj is not limited, only its input
+        for i in range(0, len(data), ZSTD_SLICE_SIZE):
+            chunk = data[i:i + ZSTD_SLICE_SIZE]
+            while chunk:
+                if self._obj.eof:
+                    # the body continues with another frame
+                    self._obj = self._dctx.decompressobj(write_size=size)
+                write(self._obj.decompress(chunk))
+                chunk = self._obj.unused_data if self._obj.eof else b''
+
+    def finish(self):
+        if not self._obj.eof:
+            raise ValueError('The compressed body is truncated.')
+
+
+def decompressor(encoding):
+    """Return a decoder of the encoding, or None
+
+    The decoder passes the decompressed output of each fed chunk to a
+    write function, in bounded steps. Its finish method raises a
+    ValueError, if the body ended within a compressed stream.
+
+    """
+    if encoding in ('gzip', 'x-gzip'):
+        return ZlibDecoder(47)
+    elif encoding == 'deflate':
+        return ZlibDecoder()
+    elif encoding == 'br' and brotli is not None and \
+            hasattr(brotli.Decompressor, 'can_accept_more_data'):
+        return BrotliDecoder()
+    elif encoding == 'zstd' and zstandard is not None:
+        return ZstdDecoder()
+    return None
+
+
+def compress_chunks(chunks, encoder):
+    """Compress an iterable of byte chunks"""
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = encoder.compress(chunk)
+            if data:
+                yield data
+        yield encoder.flush()
+    finally:
+        # close files of streamed downloads
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+class Compression:
+    def __init__(self, app=None):
+        self.enabled = False
+        self.encodings = ['gzip']
+        self.min_size = 1024
+        self.levels = dict(DEFAULT_LEVELS)
+        self.mimetypes = DEFAULT_MIMETYPES
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure the compression and register the Flask hooks"""
+        config = app.config
+        self.enabled = config.get('COMPRESSION_ENABLED', True)
+        available = available_encodings()
+        self.encodings = [e for e in config.get('COMPRESSION_ENCODINGS',
+                                                available) if e in available]
+        self.min_size = config.get('COMPRESSION_MIN_SIZE', 1024)
+        self.levels.update(config.get('COMPRESSION_LEVEL') or {})
+        self.mimetypes = tuple(config.get('COMPRESSION_MIMETYPES',
+                                          DEFAULT_MIMETYPES))
+
+        app.wsgi_app = DecompressMiddleware(
+            app.wsgi_app,
+            max_size=config.get('COMPRESSION_MAX_REQUEST_SIZE')
+        )
+        if self.enabled:
+            app.after_request(self.compress_response)
+
+    def negotiate(self, accept_encoding):
+        """Return the best encoding for the Accept-Encoding header, or None
+
+        The quality values of the client decide, ties are broken by the
+        order of COMPRESSION_ENCODINGS.
+
+        """
+        if not accept_encoding or len(self.encodings) == 0:
+            return None
+        accept = parse_accept_header(accept_encoding)
+        return accept.best_match(self.encodings)
+
+    def encoder(self, encoding):
+        level = self.levels.get(encoding)
+        if encoding == 'br':
+            return BrotliEncoder(level)
+        elif encoding == 'zstd':
+            return ZstdEncoder(level)
+        return GzipEncoder(level)
+
+    def compressible(self, mimetype, headers, length=None):
+        """Check if a response should be compressed"""
+        if 'Content-Encoding' in headers:
+            return False
+        if mimetype not in self.mimetypes:
+            return False
+        return length is None or length >= self.min_size
+
+    def compress_response(self, response):
+        """Flask after_request hook compressing the response"""
+        from flask import request
+
+        if request.method == 'HEAD' or response.status_code < 200 or \
+                response.status_code in (204, 206, 304):
+            return response
+        if not self.compressible(response.mimetype, response.headers,
+                                 response.content_length):
+            return response
+        encoding = self.negotiate(request.headers.get('Accept-Encoding'))
+        response.vary.add('Accept-Encoding')
+        if encoding is None:
+            return response
+
+        encoder = self.encoder(encoding)
+        if response.is_streamed or response.direct_passthrough:
+            # compress the chunks as they are sent
+            response.direct_passthrough = False
+            response.response = compress_chunks(response.response, encoder)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            response.set_data(encoder.compress(data) + encoder.flush())
+
+        response.headers['Content-Encoding'] = encoding
+        # the compressed body is another representation of the resource
+        etag = response.headers.get('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            response.headers['ETag'] = 'W/' + etag
+        return response
+
+
+class RequestTooLarge(ValueError):
+    pass
+
+
+class DecompressMiddleware:
+    """WSGI middleware decompressing request bodies
+
+    The body is decompressed into memory, up to max_size bytes, and
+    replaces the input stream of the request.
+
+    """
+    def __init__(self, app, max_size=None):
+        self.app = app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding in ('', 'identity'):
+            return self.app(environ, start_response)
+
+        decoder = decompressor(encoding)
+        if decoder is None:
+            return self.error(start_response, '415 Unsupported Media Type',
+                              'Content-Encoding %s is not supported.'
+                              % encoding)
+        try:
+            body = self.decompress(environ, decoder)
+        except RequestTooLarge as e:
+            return self.error(start_response, '413 Payload Too Large',
+                              str(e))
+        except Exception:
+            return self.error(start_response, '400 Bad Request',
+                              'The request body could not be decompressed.')
+
+        environ['wsgi.input'] = io.BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        del environ['HTTP_CONTENT_ENCODING']
+        return self.app(environ, start_response)
+
+    def decompress(self, environ, decoder, chunk_size=16 * 1024):
+        stream = environ['wsgi.input']
+        length = environ.get('CONTENT_LENGTH')
+        # a malformed Content-Length is a bad request
+        remaining = int(length) if length else None
+
+        body = io.BytesIO()
+
+        def write(data):
+            body.write(data)
+            if self.max_size is not None and body.tell() > self.max_size:
+                raise RequestTooLarge('The decompressed request body '
+                                      'exceeds %d bytes.' % self.max_size)
+
+        while remaining is None or remaining > 0:
+            chunk = stream.read(chunk_size if remaining is None
+                                else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            decoder.feed(chunk, write)
+        decoder.finish()
+        return body.getvalue()
+
+    @staticmethod
+    def error(start_response, status, message):
+        body = json.dumps({'status': int(status.split()[0]),
+                           'message': message}).encode()
+        start_response(status, [('Content-Type', 'application/json'),
+                                ('Content-Length', str(len(body)))])
+        return [body]
+
+
+compression = Compression()
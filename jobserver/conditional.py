@@ -0,0 +1,128 @@
+"""
+Conditional requests and HTTP caching.
+
+General
+-------
+Finished Jobs, data objects and data files rarely change, but are polled
+and downloaded over and over again. Their responses carry an ETag and a
+Last-Modified header, which are derived from the timestamps of the document
+or from the mtime of the file. A request sending a matching If-None-Match
+or If-Modified-Since header is answered by 304 Not Modified. The validators
+are checked before the payload is loaded, so a 304 costs only the lookup of
+the timestamps. Unconditional requests skip that lookup.
+
+Finished Jobs are sent with a Cache-Control max-age of HTTP_CACHE_MAX_AGE
+seconds, so clients do not even ask again. All other responses have to be
+revalidated by the client on each use.
+"""
+import hashlib
+import os
+from datetime import datetime as dt, timezone
+
+from werkzeug.http import http_date, parse_date, parse_etags
+
+# the fields needed to build the validators of a document
+VALIDATOR_NAMES = ('created', 'edited', 'finished', 'heartbeat', 'started')
+
+# projection of these fields. The ETag does not depend on this dict, which
+# some drivers extend in place
+VALIDATOR_FIELDS = {f: 1 for f in VALIDATOR_NAMES}
+
+
+def make_etag(*parts):
+    """Return an ETag value built from the parts"""
+    key = '|'.join(str(p) for p in parts)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def document_validators(doc):
+    """Return the ETag and Last-Modified date of a Job or data object
+
+    Parameters
+    ----------
+    doc : jobserver.models.mongo.DocumentModel
+        The model, which needs to hold the VALIDATOR_FIELDS only.
+
+    Returns
+    -------
+    etag : str
+    modified : datetime.datetime
+        The latest timestamp of the document, or None.
+
+    """
+    stamps = [getattr(doc, f) for f in VALIDATOR_NAMES]
+    modified = [s for s in stamps if isinstance(s, dt)]
+    return make_etag(doc.id, *stamps), max(modified) if modified else None
+
+
+def file_validators(path, *parts):
+    """Return the ETag and Last-Modified date of a file
+
+    Additional parts, like the requested format, are added to the ETag.
+
+    """
+    stat = os.stat(path)
+    modified = dt.utcfromtimestamp(stat.st_mtime)
+    return make_etag(path, stat.st_mtime, stat.st_size, *parts), modified
+
+
+def is_conditional(headers):
+    """Check if the request sends If-None-Match or If-Modified-Since"""
+    return bool(headers.get('if-none-match') or
+                headers.get('if-modified-since'))
+
+
+def is_not_modified(headers, etag, modified=None):
+    """Check the conditional request headers
+
+    If-None-Match takes precedence over If-Modified-Since. ETags are
+    compared weakly.
+
+    Parameters
+    ----------
+    headers : dict
+        The request headers. Lower case keys are used, so the headers of
+        Flask and ASGI requests are both supported.
+    etag : str
+        The current ETag of the resource.
+    modified : datetime.datetime
+        The current Last-Modified date of the resource, naive UTC.
+
+    Returns
+    -------
+    not_modified : bool
+        True, if the request can be answered by 304 Not Modified.
+
+    """
+    if_none_match = headers.get('if-none-match')
+    if if_none_match:
+        return parse_etags(if_none_match).contains_weak(etag)
+
+    if_modified_since = headers.get('if-modified-since')
+    if modified is None or not if_modified_since:
+        return False
+    since = parse_date(if_modified_since)
+    if since is None:
+        return False
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    # HTTP dates have a resolution of seconds
+    return modified.replace(microsecond=0) <= since
+
+
+def cache_headers(etag, modified=None, max_age=None):
+    """Return the ETag, Last-Modified and Cache-Control headers
+
+    If max_age is given, the response may be reused by the client for that
+    number of seconds. Otherwise, it has to be revalidated on each use. The
+    responses are bound to the user, so shared caches must not store them.
+
+    """
+    headers = {'ETag': '"%s"' % etag}
+    if modified is not None:
+        headers['Last-Modified'] = http_date(modified)
+    if max_age:
+        headers['Cache-Control'] = 'private, max-age=%d' % max_age
+    else:
+        headers['Cache-Control'] = 'private, no-cache'
+    return headers
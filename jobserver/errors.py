@@ -11,4 +11,20 @@ class CodeBlockMissingError(AttributeError, JobserverError):
 
 
 class DisabledError(ValueError, JobserverError):
-    pass
\ No newline at end of file
+    pass
+
+
+class ScriptNotFoundError(ValueError, JobserverError):
+    pass
+
+
+class ScriptArgumentError(TypeError, JobserverError):
+    pass
+
+
+class ResourceLimitError(ValueError, JobserverError):
+    pass
+
+
+class UnsupportedFormatError(ValueError, JobserverError):
+    pass
@@ -0,0 +1,243 @@
+"""
+Discover and hot-reload script modules.
+
+General
+-------
+Scripts are loaded from three kinds of sources:
+
+* the jobserver.scripts package,
+* every public .py file in the directories listed in the SCRIPT_DIRS
+  config value. Each file is loaded as an own module. Only functions
+  defined in the file itself are registered.
+* the entry points of the group SCRIPT_ENTRY_POINT_GROUP. An entry point
+  can either refer to a function or a module.
+
+The synthetic load test scripts of jobserver.scripts.synthetic are only
+registered, if LOADTEST_SCRIPTS is set.
+
+If SCRIPT_RELOAD_INTERVAL is set, a watcher thread checks the modification
+times of the package and directory files in that interval. A changed
+source is loaded into a new module first. Only if that succeeds, its
+scripts are atomically replaced in the registry, otherwise the old version
+is kept and the error is logged. Running Jobs keep the function they were
+started with. Entry points are loaded once, as installing a package needs a
+restart anyway. Only the 'local-dev' config turns the reloading on.
+
+The version of the script used is recorded on each Job. If SCRIPT_WARMUP
+is set, the setup of the scripts is run right after they were loaded,
+instead of on their first Job.
+
+"""
+import glob
+import importlib
+import importlib.util
+import os
+import sys
+from threading import Thread, Event, Lock
+
+from jobserver import scripts
+from jobserver.registry import registry
+
+# module name prefix of the modules loaded from SCRIPT_DIRS
+PLUGIN_PREFIX = 'jobserver_plugins.'
+
+
+def _mtimes(paths):
+    mtimes = dict()
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime
+        except OSError:
+            pass
+    return mtimes
+
+
+class PackageSource:
+    """The scripts of an imported package, reloaded in place"""
+    own_only = False
+
+    def __init__(self, module):
+        self.name = module.__name__
+        self.module = module
+        self.mtimes = _mtimes(self.files())
+
+    def files(self):
+        path = os.path.dirname(self.module.__file__)
+        return glob.glob(os.path.join(path, '**', '*.py'), recursive=True)
+
+    def changed(self):
+        return _mtimes(self.files()) != self.mtimes
+
+    def reload(self):
+        # a broken version is only retried after the next change
+        mtimes = _mtimes(self.files())
+        changed = [p for p, t in mtimes.items() if self.mtimes.get(p) != t]
+        self.mtimes = mtimes
+
+        # reload changed submodules first, then the package itself
+        for name, mod in list(sys.modules.items()):
+            if name.startswith(self.name + '.') and \
+                    getattr(mod, '__file__', None) in changed:
+                importlib.reload(mod)
+        self.module = importlib.reload(self.module)
+        return self.module
+
+
+class FileSource:
+    """A single script file, loaded into a new module on each change"""
+    own_only = True
+
+    def __init__(self, path):
+        self.path = path
+        stem = os.path.splitext(os.path.basename(path))[0]
+        self.name = PLUGIN_PREFIX + stem
+        self.module = None
+        self.mtimes = dict()
+
+    def files(self):
+        return [self.path]
+
+    def changed(self):
+        return _mtimes(self.files()) != self.mtimes
+
+    def reload(self):
+        # a broken version is only retried after the next change
+        self.mtimes = _mtimes(self.files())
+        spec = importlib.util.spec_from_file_location(self.name, self.path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+        # only replace a working module
+        sys.modules[self.name] = module
+        self.module = module
+        return module
+
+
+def iter_entry_points(group):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(group))
+
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return list(eps.select(group=group))
+    return list(eps.get(group, []))
+
+
+class ScriptLoader:
+    def __init__(self, app=None):
+        self.sources = dict()
+        self.watcher = None
+        self.logger = None
+        self.warm_up = False
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Load all script sources and start the watcher, if configured"""
+        self.logger = app.logger
+        self.warm_up = app.config.get('SCRIPT_WARMUP', False)
+        self.sources = dict()
+        self.add(PackageSource(scripts), load=False)
+        registry.load_module(scripts)
+        if self.warm_up:
+            self.set_up(scripts.__name__)
+
+        # the synthetic load test scripts are opt-in
+        if app.config.get('LOADTEST_SCRIPTS', False):
+            from jobserver.scripts import synthetic
+            registry.load_module(synthetic, own_only=True)
+
+        for directory in app.config.get('SCRIPT_DIRS') or []:
+            for path in sorted(glob.glob(os.path.join(directory, '*.py'))):
+                if not os.path.basename(path).startswith('_'):
+                    self.add(FileSource(path))
+
+        group = app.config.get('SCRIPT_ENTRY_POINT_GROUP')
+        if group is not None:
+            self.load_entry_points(group)
+
+        interval = app.config.get('SCRIPT_RELOAD_INTERVAL')
+        if interval is not None and self.watcher is None:
+            self.watcher = ScriptWatcher(self, interval)
+            self.watcher.start()
+
+    def add(self, source, load=True):
+        self.sources[source.name] = source
+        if load:
+            self.load(source)
+
+    def load(self, source):
+        """(Re)load a source and swap its scripts into the registry
+
+        Returns
+        -------
+        success : bool
+            False, if the source could not be loaded. The scripts of the
+            last working version are kept in that case.
+
+        """
+        try:
+            module = source.reload()
+        except Exception as e:
+            self.logger.error('Loading scripts from %s failed: %s'
+                              % (source.name, str(e)))
+            return False
+        registry.load_module(module, own_only=source.own_only)
+        self.logger.info('Loaded scripts from %s' % source.name)
+        if self.warm_up:
+            self.set_up(source.name)
+        return True
+
+    def set_up(self, source=None):
+        """Run the setup of the scripts and log failures"""
+        for name, message in registry.warm_up(source).items():
+            self.logger.error('Setup of script %s failed: %s'
+                              % (name, message))
+
+    def load_entry_points(self, group):
+        for ep in iter_entry_points(group):
+            try:
+                obj = ep.load()
+            except Exception as e:
+                self.logger.error('Loading entry point %s failed: %s'
+                                  % (ep.name, str(e)))
+                continue
+            if callable(obj):
+                registry.replace('entry_point:%s' % ep.name, [obj])
+            else:
+                registry.load_module(obj, own_only=True)
+
+    def check(self):
+        """Reload all changed sources. Returns the number of reloads"""
+        reloaded = 0
+        with self._lock:
+            for source in list(self.sources.values()):
+                if source.changed() and self.load(source):
+                    reloaded += 1
+        return reloaded
+
+
+class ScriptWatcher(Thread):
+    """Background thread polling the script sources for changes"""
+    def __init__(self, loader, interval):
+        super(ScriptWatcher, self).__init__(daemon=True)
+        self.loader = loader
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.loader.check()
+            except Exception as e:
+                self.loader.logger.error('Script reload failed: %s' % str(e))
+
+    def stop(self):
+        self.stopped.set()
+
+
+loader = ScriptLoader()
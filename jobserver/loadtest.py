@@ -0,0 +1,273 @@
+"""
+Load test a running jobserver.
+
+General
+-------
+The load test drives a mix of job submissions, job polling, job listings and
+data file uploads against a jobserver instance. The concurrency is increased
+step by step. For each step, the throughput, latency distributions and error
+rates are recorded. Finally, the knee of the throughput curve is reported,
+which is the concurrency above which adding more clients does not increase
+the throughput significantly anymore.
+
+The load test needs httpx, which is installed by the 'loadtest' extra:
+
+.. code-block:: bash
+
+    pip install jobserver[loadtest]
+
+The 'sleep' and 'cpu' workloads need the synthetic scripts, which are only
+registered by servers running with LOADTEST_SCRIPTS enabled.
+
+Examples
+--------
+
+.. code-block:: bash
+
+    jobserver-loadtest http://localhost:5000 --concurrency 1,2,4,8,16,32 \\
+        --duration 30 --workload sleep --token MYTOKEN
+
+The operation mix is given as weights, like --mix submit=1,poll=5,list=1.
+Available workloads are 'summary' (the timeseries.csv summary script),
+'sleep' (I/O bound) and 'cpu' (CPU bound).
+
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import sys
+import time
+import uuid
+
+from jobserver.metrics import percentile
+
+WORKLOADS = {
+    'summary': {'script_name': 'summary', 'datafile': 'timeseries.csv'},
+    'sleep': {'script': {'name': 'sleep_for', 'kwargs': {'seconds': 0.2}},
+              'raw_data': [0]},
+    'cpu': {'script': {'name': 'burn_cpu', 'kwargs': {'iterations': 200000}},
+            'raw_data': [0]},
+}
+
+OPERATIONS = ('submit', 'poll', 'list', 'upload')
+
+UPLOAD_CONTENT = '\n'.join(
+    ['time,value'] + ['%d,%.3f' % (i, random.random()) for i in range(1000)]
+).encode()
+
+
+def find_knee(x, y):
+    """Find the knee of a concave, increasing curve
+
+    Uses the Kneedle approach: both axes are normalized to [0, 1] and the
+    knee is the point of maximum distance above the straight line between
+    the first and the last point.
+
+    Returns
+    -------
+    knee : object
+        The x value of the knee, or None if there are less than 3 points.
+
+    """
+    if len(x) < 3:
+        return None
+    x_min, x_max = min(x), max(x)
+    y_min, y_max = min(y), max(y)
+    if x_max == x_min or y_max == y_min:
+        return x[0]
+
+    diff = [(yi - y_min) / (y_max - y_min) - (xi - x_min) / (x_max - x_min)
+            for xi, yi in zip(x, y)]
+    return x[diff.index(max(diff))]
+
+
+class LoadTest:
+    def __init__(self, url, mix, workload='sleep', headers=None,
+                 timeout=30.):
+        self.url = url.rstrip('/')
+        self.mix = mix
+        self.workload = WORKLOADS[workload]
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.job_ids = []
+        self.samples = []
+
+    def record(self, op, start, ok):
+        self.samples.append((op, time.perf_counter() - start, ok))
+
+    async def submit(self, client):
+        start = time.perf_counter()
+        res = await client.put(self.url + '/job', json=self.workload)
+        if res.status_code != 201:
+            self.record('submit', start, False)
+            return
+        job_id = res.json()['_id']
+        res = await client.get(self.url + '/job/%s/run' % job_id)
+        ok = res.status_code == 202
+        self.record('submit', start, ok)
+        if ok:
+            self.job_ids.append(job_id)
+
+    async def poll(self, client):
+        if len(self.job_ids) == 0:
+            return await self.submit(client)
+        start = time.perf_counter()
+        job_id = random.choice(self.job_ids[-100:])
+        res = await client.get(self.url + '/job/%s' % job_id)
+        self.record('poll', start, res.status_code == 200)
+
+    async def list(self, client):
+        start = time.perf_counter()
+        res = await client.get(self.url + '/jobs')
+        self.record('list', start, res.status_code == 200)
+
+    async def upload(self, client):
+        name = 'loadtest_%s.csv' % uuid.uuid4().hex
+        start = time.perf_counter()
+        res = await client.put(self.url + '/datafile/%s' % name,
+                               files={'file': (name, UPLOAD_CONTENT)})
+        self.record('upload', start, res.status_code == 201)
+        if res.status_code == 201:
+            await client.delete(self.url + '/datafile/%s' % name)
+
+    async def worker(self, client, until):
+        ops, weights = zip(*self.mix.items())
+        while time.perf_counter() < until:
+            op = random.choices(ops, weights)[0]
+            try:
+                await getattr(self, op)(client)
+            except Exception:
+                self.samples.append((op, 0., False))
+
+    async def step(self, concurrency, duration):
+        """Run the load test with a fixed concurrency"""
+        import httpx
+
+        self.samples = []
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(headers=self.headers, limits=limits,
+                                     timeout=self.timeout) as client:
+            start = time.perf_counter()
+            until = start + duration
+            await asyncio.gather(*[self.worker(client, until)
+                                   for _ in range(concurrency)])
+            elapsed = time.perf_counter() - start
+
+        return self.summarize(concurrency, elapsed)
+
+    def summarize(self, concurrency, elapsed):
+        ok = [s for s in self.samples if s[2]]
+        result = {
+            'concurrency': concurrency,
+            'seconds': elapsed,
+            'requests': len(self.samples),
+            'throughput': len(ok) / elapsed,
+            'error_rate': 1. - len(ok) / len(self.samples)
+            if len(self.samples) > 0 else 0.,
+            'operations': {}
+        }
+
+        for op in self.mix.keys():
+            latency = sorted(s[1] for s in ok if s[0] == op)
+            total = len([s for s in self.samples if s[0] == op])
+            result['operations'][op] = {
+                'requests': total,
+                'errors': total - len(latency),
+                'p50': percentile(latency, 50),
+                'p95': percentile(latency, 95),
+                'p99': percentile(latency, 99)
+            }
+        return result
+
+    def run(self, levels, duration):
+        steps = []
+        for concurrency in levels:
+            loop = asyncio.new_event_loop()
+            try:
+                res = loop.run_until_complete(
+                    self.step(concurrency, duration)
+                )
+            finally:
+                loop.close()
+            print('concurrency %4d: %8.1f req/s, %5.1f%% errors' % (
+                concurrency, res['throughput'], res['error_rate'] * 100
+            ), file=sys.stderr)
+            steps.append(res)
+
+        knee = find_knee([s['concurrency'] for s in steps],
+                         [s['throughput'] for s in steps])
+        return {'url': self.url, 'mix': self.mix, 'steps': steps,
+                'knee': knee}
+
+
+def parse_mix(mix):
+    weights = dict()
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError('Unknown operation %s. Use one of %s.'
+                             % (name, ', '.join(OPERATIONS)))
+        weights[name] = float(weight) if weight else 1.
+    return weights
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Soak test a running jobserver.'
+    )
+    parser.add_argument('url', help='base URL of the jobserver')
+    parser.add_argument('--concurrency', default='1,2,4,8,16,32',
+                        help='comma separated concurrency levels')
+    parser.add_argument('--duration', type=float, default=20.,
+                        help='seconds per concurrency level')
+    parser.add_argument('--mix', default='submit=1,poll=5,list=1,upload=1',
+                        help='operation weights')
+    parser.add_argument('--workload', default='sleep',
+                        choices=sorted(WORKLOADS.keys()))
+    parser.add_argument('--token', default=None,
+                        help='access token for Bearer authorization')
+    parser.add_argument('--user', default=None,
+                        help='email:password for Basic authorization')
+    parser.add_argument('--timeout', type=float, default=30.)
+    parser.add_argument('--output', default=None,
+                        help='write the JSON report to this file')
+    args = parser.parse_args(argv)
+
+    try:
+        import httpx  # noqa: F401
+    except ImportError:
+        parser.exit(1, 'The load test needs httpx: '
+                    'pip install jobserver[loadtest]\n')
+
+    headers = {}
+    if args.token is not None:
+        headers['Authorization'] = 'Bearer %s' % args.token
+    elif args.user is not None:
+        headers['Authorization'] = 'Basic %s' % base64.b64encode(
+            args.user.encode()).decode()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    levels = [int(c) for c in args.concurrency.split(',')]
+
+    test = LoadTest(args.url, mix, workload=args.workload, headers=headers,
+                    timeout=args.timeout)
+    report = test.run(levels, args.duration)
+    print('knee of the throughput curve at concurrency %s' % report['knee'],
+          file=sys.stderr)
+
+    output = json.dumps(report, indent=4)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,4 +4,4 @@ from flask_restful import Api
 main_blueprint = Blueprint('main', __name__)
 main_api = Api(main_blueprint)
 
-from . import info
\ No newline at end of file
+from . import info, metrics
\ No newline at end of file
@@ -0,0 +1,67 @@
+from flask import current_app, Response
+from flask_restful import Resource
+
+from jobserver import metrics
+from jobserver.auth.authorization import load_user, role_required
+from jobserver.main import main_api
+
+
+class MetricsApi(Resource):
+    def get(self):
+        """Return all metrics
+
+        Returns the metrics recorded by all jobserver processes in the
+        Prometheus text format. This includes job throughput, latency and
+        result sizes, HTTP request latencies per endpoint and the MongoDB
+        client metrics. The route is only available in case METRICS_ENABLED
+        is set.
+
+        Returns
+        -------
+        metrics : text
+            Prometheus text exposition format.
+
+        """
+        if not current_app.config.get('METRICS_ENABLED'):
+            return {
+                'status': 404,
+                'message': 'Metrics are not enabled.'
+            }, 404
+
+        return Response(metrics.registry.render(),
+                        content_type=metrics.CONTENT_TYPE)
+
+
+class MongoMetricsApi(Resource):
+    method_decorators = [role_required(roles=['admin']), load_user]
+
+    def get(self):
+        """Return MongoDB client metrics
+
+        This internal route returns latency histograms of all MongoDB
+        commands per collection and the time spent waiting for a pooled
+        connection. The metrics are only recorded in case MONGO_MONITORING
+        is enabled. The route is restricted to admins and superusers.
+
+        Returns
+        -------
+        metrics : JSON
+            JSON serialized command latency and pool wait histograms.
+
+        """
+        if not current_app.config.get('MONGO_MONITORING'):
+            return {
+                'status': 404,
+                'message': 'MongoDB monitoring is not enabled.'
+            }, 404
+
+        return {
+            'status': 200,
+            'commands': metrics.command_latency.to_dict(),
+            'pool': metrics.pool_wait.to_dict()
+        }, 200
+
+
+main_api.add_resource(MetricsApi, '/metrics', endpoint='metrics')
+main_api.add_resource(MongoMetricsApi, '/metrics/mongo',
+                      endpoint='mongo_metrics')
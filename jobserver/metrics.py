@@ -0,0 +1,574 @@
+"""
+Metrics collected by the jobserver.
+
+General
+-------
+The metrics module implements lightweight, thread-safe metric types used to
+instrument the jobserver. It does not depend on Flask, so the metrics can be
+recorded from anywhere, including the Threads running the Job processes.
+
+All metrics are registered to the module level registry and can be rendered
+in the Prometheus text exposition format. The MongoDB client is instrumented
+by the CommandLatencyListener and the PoolWaitListener, which are registered
+as pymongo event listeners when the client is created.
+
+Multiple processes
+------------------
+If the jobserver runs in several processes, like gunicorn workers, each
+process only knows its own metrics. In this case a shared directory can be
+configured by the METRICS_MULTIPROC_DIR config value. Each process will dump
+its metrics into this directory and the process serving the /metrics route
+merges all dumps. Counters and histograms are summed up, gauges of
+processes that are not alive anymore are dropped.
+
+"""
+from threading import Lock, local
+from collections import OrderedDict
+import json
+import os
+import time
+
+from pymongo import monitoring
+
+# default latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+# buckets for job durations in seconds
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0,
+                    3600.0)
+
+# buckets for sizes in bytes
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 4e6, 16e6, 64e6)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(Counter):
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class Histogram:
+    """Cumulative histogram
+
+    Records observations into fixed buckets. Each bucket holds the number
+    of observations less or equal to its upper bound.
+
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {'counts': list(self.counts), 'sum': self.sum,
+                    'count': self.count}
+
+    def to_dict(self):
+        snap = self.snapshot()
+        return {
+            'buckets': dict(zip([str(b) for b in self.buckets],
+                                snap['counts'])),
+            'sum': snap['sum'],
+            'count': snap['count']
+        }
+
+
+class MetricFamily:
+    """A named metric with a set of labeled children"""
+    types = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+    def __init__(self, name, documentation, kind, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        if kind not in self.types:
+            raise ValueError('kind has to be one of %s' % str(self.types))
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._children = dict()
+        self._lock = Lock()
+
+    def labels(self, *values, **kwargs):
+        if len(kwargs) > 0:
+            values = tuple(kwargs[n] for n in self.labelnames)
+        values = tuple(str(v) for v in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError('%s needs the labels %s'
+                             % (self.name, str(self.labelnames)))
+
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                if self.kind == 'histogram':
+                    child = Histogram(self.buckets)
+                else:
+                    child = self.types[self.kind]()
+                self._children[values] = child
+        return child
+
+    # shortcuts for metrics without labels
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def children(self):
+        with self._lock:
+            return list(self._children.items())
+
+    def snapshot(self):
+        return {
+            'documentation': self.documentation,
+            'kind': self.kind,
+            'labelnames': list(self.labelnames),
+            'buckets': list(self.buckets),
+            'samples': [[list(values), child.snapshot()]
+                        for values, child in self.children()]
+        }
+
+
+def merge_snapshots(snapshots):
+    """Merge the snapshots of several processes into one"""
+    merged = OrderedDict()
+    for snap in snapshots:
+        for name, family in snap.items():
+            if name not in merged:
+                merged[name] = dict(family, samples=OrderedDict())
+            samples = merged[name]['samples']
+            for values, value in family['samples']:
+                key = tuple(values)
+                if key not in samples:
+                    samples[key] = value
+                elif family['kind'] == 'histogram':
+                    prev = samples[key]
+                    samples[key] = {
+                        'counts': [a + b for a, b in
+                                   zip(prev['counts'], value['counts'])],
+                        'sum': prev['sum'] + value['sum'],
+                        'count': prev['count'] + value['count']
+                    }
+                else:
+                    samples[key] = samples[key] + value
+
+    # back to the snapshot format
+    for family in merged.values():
+        family['samples'] = [[list(k), v]
+                             for k, v in family['samples'].items()]
+    return merged
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                     .replace('\n', '\\n'))
+        for n, v in pairs
+    )
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def render(snapshot):
+    """Render a registry snapshot in the Prometheus text format"""
+    lines = []
+    for name, family in snapshot.items():
+        lines.append('# HELP %s %s' % (name, family['documentation']))
+        lines.append('# TYPE %s %s' % (name, family['kind']))
+        names = family['labelnames']
+
+        for values, value in family['samples']:
+            if family['kind'] != 'histogram':
+                lines.append('%s%s %s' % (name, _format_labels(names, values),
+                                          _format_value(value)))
+                continue
+
+            for bound, count in zip(family['buckets'], value['counts']):
+                labels = _format_labels(names, values,
+                                        ('le', _format_value(bound)))
+                lines.append('%s_bucket%s %d' % (name, labels, count))
+            labels = _format_labels(names, values, ('le', '+Inf'))
+            lines.append('%s_bucket%s %d' % (name, labels, value['count']))
+            labels = _format_labels(names, values)
+            lines.append('%s_sum%s %s' % (name, labels,
+                                          _format_value(value['sum'])))
+            lines.append('%s_count%s %d' % (name, labels, value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Registry:
+    def __init__(self):
+        self.families = OrderedDict()
+        self.multiproc_dir = None
+        self.dump_interval = 5.0
+        self._last_dump = 0.0
+        self._lock = Lock()
+        self._dump_lock = Lock()
+
+    def _register(self, name, documentation, kind, labelnames=(),
+                  buckets=LATENCY_BUCKETS):
+        with self._lock:
+            if name not in self.families:
+                self.families[name] = MetricFamily(
+                    name, documentation, kind, labelnames, buckets
+                )
+            return self.families[name]
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(name, documentation, 'counter', labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(name, documentation, 'gauge', labelnames)
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=LATENCY_BUCKETS):
+        return self._register(name, documentation, 'histogram', labelnames,
+                              buckets)
+
+    def snapshot(self):
+        with self._lock:
+            families = list(self.families.values())
+        return OrderedDict((f.name, f.snapshot()) for f in families)
+
+    def configure(self, multiproc_dir=None, dump_interval=5.0):
+        self.multiproc_dir = multiproc_dir
+        self.dump_interval = dump_interval
+        if multiproc_dir is not None:
+            os.makedirs(multiproc_dir, exist_ok=True)
+
+    def dump(self):
+        """Write the metrics of this process into the multiproc_dir"""
+        if self.multiproc_dir is None:
+            return
+        path = os.path.join(self.multiproc_dir, 'metrics_%d.json'
+                            % os.getpid())
+        tmp = path + '.tmp'
+        # requests and workers of this process share the temporary file
+        with self._dump_lock:
+            with open(tmp, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, path)
+            self._last_dump = time.monotonic()
+
+    def maybe_dump(self):
+        """Dump, if the last dump is older than the dump_interval"""
+        if self.multiproc_dir is None:
+            return
+        if time.monotonic() - self._last_dump >= self.dump_interval:
+            self.dump()
+
+    def collect(self):
+        """Return the merged snapshot of all processes"""
+        if self.multiproc_dir is None:
+            return self.snapshot()
+
+        # make sure the own metrics are up to date
+        self.dump()
+
+        snapshots = []
+        for fname in sorted(os.listdir(self.multiproc_dir)):
+            if not (fname.startswith('metrics_') and fname.endswith('.json')):
+                continue
+            pid = int(fname[8:-5])
+            try:
+                with open(os.path.join(self.multiproc_dir, fname)) as f:
+                    snap = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            # gauges of dead processes are not valid anymore
+            if not _pid_alive(pid):
+                snap = OrderedDict((n, fam) for n, fam in snap.items()
+                                   if fam['kind'] != 'gauge')
+            snapshots.append(snap)
+        return merge_snapshots(snapshots)
+
+    def render(self):
+        return render(self.collect())
+
+
+registry = Registry()
+
+
+class PhaseTimer:
+    """Record the duration of named phases
+
+    Phases are timed by the phase context manager. Nested phases are
+    exclusive, that means the time spent in an inner phase is not added to
+    the outer phase. A phase can be entered several times, the durations
+    are summed up. The timer can be shared between threads.
+
+    Examples
+    --------
+    >>> timer = PhaseTimer()
+    >>> with timer.phase('load'):
+    ...     load()
+    >>> timer.to_dict()
+    {'load': 0.0123}
+
+    """
+    def __init__(self):
+        self.phases = OrderedDict()
+        self._stack = local()
+        self._lock = Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def to_dict(self):
+        with self._lock:
+            return dict(self.phases)
+
+
+class _Phase:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = None
+        self.children = 0.0
+
+    def __enter__(self):
+        stack = getattr(self.timer._stack, 'phases', None)
+        if stack is None:
+            stack = self.timer._stack.phases = []
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter() - self.start
+        stack = self.timer._stack.phases
+        stack.pop()
+        if len(stack) > 0:
+            stack[-1].children += elapsed
+        self.timer.add(self.name, elapsed - self.children)
+        return False
+
+
+def percentile(values, q):
+    """Linear interpolated percentile of sorted values, q in [0, 100]"""
+    if len(values) == 0:
+        return None
+    pos = (len(values) - 1) * q / 100.
+    lower = int(pos)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+# ------------------------------------------------
+#       Job and HTTP metrics
+# ------------------------------------------------
+job_queue_wait = registry.histogram(
+    'jobserver_job_queue_wait_seconds',
+    'Time between the start request of a job and its execution.',
+    ['script'], DURATION_BUCKETS
+)
+job_run_time = registry.histogram(
+    'jobserver_job_run_seconds',
+    'Execution time of jobs.',
+    ['script'], DURATION_BUCKETS
+)
+jobs_total = registry.counter(
+    'jobserver_jobs_total',
+    'Number of finished jobs by status.',
+    ['script', 'status']
+)
+job_result_size = registry.histogram(
+    'jobserver_job_result_bytes',
+    'Size of the DataFrame job results, as stored Arrow stream.',
+    ['script'], SIZE_BUCKETS
+)
+active_workers = registry.gauge(
+    'jobserver_active_workers',
+    'Number of currently executing jobs.'
+)
+queued_jobs = registry.gauge(
+    'jobserver_queued_jobs',
+    'Number of jobs waiting for a worker.'
+)
+coalesced_jobs = registry.counter(
+    'jobserver_coalesced_jobs_total',
+    'Number of jobs sharing the execution of an identical job.',
+    ['script']
+)
+http_request_time = registry.histogram(
+    'jobserver_http_request_seconds',
+    'Latency of HTTP requests per endpoint.',
+    ['endpoint', 'method', 'status']
+)
+mongo_command_time = registry.histogram(
+    'jobserver_mongo_command_seconds',
+    'Latency of MongoDB commands per collection.',
+    ['collection', 'command']
+)
+mongo_command_failures = registry.counter(
+    'jobserver_mongo_command_failures_total',
+    'Number of failed MongoDB commands.',
+    ['command']
+)
+mongo_pool_wait = registry.histogram(
+    'jobserver_mongo_pool_wait_seconds',
+    'Time spent waiting for a pooled MongoDB connection.'
+)
+mongo_pool_timeouts = registry.counter(
+    'jobserver_mongo_pool_timeouts_total',
+    'Number of timed out connection pool checkouts.'
+)
+
+
+# ------------------------------------------------
+#       MongoDB client instrumentation
+# ------------------------------------------------
+class CommandLatencyListener(monitoring.CommandListener):
+    """Record the latency of MongoDB commands per collection"""
+    def __init__(self):
+        self._pending = dict()
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(event):
+        return event.connection_id, event.request_id
+
+    def started(self, event):
+        # most commands name the collection as value of the command
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.database_name
+        with self._lock:
+            self._pending[self._key(event)] = collection
+
+    def _observe(self, event):
+        with self._lock:
+            collection = self._pending.pop(self._key(event), None)
+        if collection is not None:
+            mongo_command_time.labels(collection, event.command_name)\
+                .observe(event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._observe(event)
+
+    def failed(self, event):
+        self._observe(event)
+        mongo_command_failures.labels(event.command_name).inc()
+
+    def to_dict(self):
+        collections = dict()
+        for (collection, command), hist in mongo_command_time.children():
+            collections.setdefault(collection, dict())[command] = \
+                hist.to_dict()
+        failures = {values[0]: counter.value for values, counter
+                    in mongo_command_failures.children()}
+        return {'collections': collections, 'failures': failures}
+
+
+class PoolWaitListener(monitoring.ConnectionPoolListener):
+    """Record the time spent waiting for a pooled connection"""
+    def __init__(self):
+        self._started = local()
+
+    def connection_check_out_started(self, event):
+        self._started.t = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        t = getattr(self._started, 't', None)
+        if t is not None:
+            mongo_pool_wait.observe(time.perf_counter() - t)
+            self._started.t = None
+
+    def connection_check_out_failed(self, event):
+        self._started.t = None
+        if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+            mongo_pool_timeouts.inc()
+
+    def to_dict(self):
+        return {
+            'wait': mongo_pool_wait.labels().to_dict(),
+            'timeouts': mongo_pool_timeouts.labels().value
+        }
+
+    # the remaining pool events are not recorded
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+command_latency = CommandLatencyListener()
+pool_wait = PoolWaitListener()
@@ -22,3 +22,12 @@ class BaseDataModel:
 
     def to_dict(self):
         return {'type': self._type, 'data': self._data}
+
+    def identity(self):
+        """Return a JSON serializable description of the content
+
+        Two data models of the same identity hold the same content. It is
+        used to fingerprint Jobs.
+
+        """
+        return self.to_dict()
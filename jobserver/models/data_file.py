@@ -117,6 +117,10 @@ class DataFile(BaseDataModel):
             'size': self.size()
         }
 
+    def identity(self):
+        return {'type': self._type, 'path': self.path,
+                'mtime': os.path.getmtime(self.path)}
+
 
 class DataFileAsObject(DataFile):
     """
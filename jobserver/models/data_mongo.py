@@ -36,11 +36,13 @@ class DataMongo(MongoModel, BaseDataModel):
         else:
             return self.data
 
-    def create(self):
+    def create(self, operation='write'):
         if self.created is None:
             self.created = dt.utcnow()
-        super(DataMongo, self).create()
+        super(DataMongo, self).create(operation=operation)
 
-    def update(self, data={}):
-        self.edited = dt.utcnow()
-        super(DataMongo, self).update(data=data)
+    def update(self, data={}, operation='write'):
+        # a save without changes does not write
+        if len(data) > 0 or self.is_dirty:
+            self.edited = dt.utcnow()
+        return super(DataMongo, self).update(data=data, operation=operation)
@@ -0,0 +1,174 @@
+"""
+Exports of DataFiles into other formats.
+
+General
+-------
+A DataFile can be downloaded as 'csv', 'json', 'html' or 'txt' (tab
+separated). The export is rendered once and written into a cache directory.
+Following downloads of the same file and format are sent from that file, as
+long as the DataFile was not changed. CSV exports are rendered in chunks of
+rows, so the rendered text is never held in memory as a whole.
+
+The cache is bounded in size. If it grows larger, the least recently used
+exports are removed. It is configured by the application config:
+
+* EXPORT_CACHE_PATH: directory of the cached exports. Defaults to a
+  'jobserver_exports' directory in the temporary directory of the system.
+* EXPORT_CACHE_SIZE: maximum size of the cache, in bytes or as string like
+  '512M'.
+
+The cache directory can be shared by multiple processes.
+"""
+import hashlib
+import os
+import tempfile
+from threading import Lock
+
+from jobserver.scheduler import parse_memory
+
+# rows rendered at once into a csv export
+CHUNK_ROWS = 50000
+
+
+def _render_csv(df, fp, sep=',', index=False):
+    for start in range(0, max(len(df), 1), CHUNK_ROWS):
+        df.iloc[start:start + CHUNK_ROWS].to_csv(
+            fp, sep=sep, index=index, header=start == 0
+        )
+
+
+FORMATS = {
+    'csv': ('text/csv', lambda df, fp: _render_csv(df, fp)),
+    'json': ('application/json', lambda df, fp: df.to_json(fp)),
+    'html': ('text/html', lambda df, fp: df.to_html(fp)),
+    'txt': ('text/plain', lambda df, fp: _render_csv(df, fp, '\t', True)),
+}
+
+
+class ExportCache:
+    def __init__(self, app=None):
+        self.path = os.path.join(tempfile.gettempdir(), 'jobserver_exports')
+        self.max_size = 512 * 1024 ** 2
+        self._locks = dict()
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        path = app.config.get('EXPORT_CACHE_PATH')
+        if path is not None:
+            self.path = path
+        size = parse_memory(app.config.get('EXPORT_CACHE_SIZE'))
+        if size is not None:
+            self.max_size = size
+
+    @staticmethod
+    def mimetype(fmt):
+        """Return the mimetype of the format. Unknown formats are 'txt'"""
+        return FORMATS.get(fmt, FORMATS['txt'])[0]
+
+    def key(self, datafile, fmt):
+        """Return the cache file name of the export
+
+        The key changes with the modification time and the size of the
+        DataFile, thus changed files are rendered again.
+
+        """
+        stat = os.stat(datafile.path)
+        key = '|'.join(str(p) for p in (
+            os.path.abspath(datafile.path), stat.st_mtime_ns, stat.st_size,
+            fmt
+        ))
+        return '%s.%s' % (hashlib.sha1(key.encode()).hexdigest(), fmt)
+
+    def open(self, datafile, fmt):
+        """Open the export of the DataFile in the given format
+
+        The export is rendered, if it is not cached. The file is returned
+        opened, so it can still be sent, if it is evicted meanwhile.
+
+        Parameters
+        ----------
+        datafile : jobserver.models.data_file.DataFile
+            The DataFile to export.
+        fmt : str
+            One of 'csv', 'json', 'html' or 'txt'. Unknown formats are
+            exported as 'txt'.
+
+        Returns
+        -------
+        fp : file
+            The export, opened for binary reading.
+
+        """
+        if fmt not in FORMATS:
+            fmt = 'txt'
+        name = self.key(datafile, fmt)
+        path = os.path.join(self.path, name)
+
+        # render each export only once at a time
+        with self._lock:
+            lock = self._locks.setdefault(name, Lock())
+        with lock:
+            try:
+                fp = open(path, 'rb')
+                # mark as recently used
+                os.utime(path)
+                rendered = False
+            except FileNotFoundError:
+                self.render(datafile, fmt, path)
+                fp = open(path, 'rb')
+                rendered = True
+        with self._lock:
+            self._locks.pop(name, None)
+
+        if rendered:
+            self.evict(keep=path)
+        return fp
+
+    def render(self, datafile, fmt, path):
+        """Render the export into path
+
+        The export is written into a temporary file first and then moved,
+        so other processes never see a partial export.
+
+        """
+        os.makedirs(self.path, exist_ok=True)
+        df = datafile.read_data()
+
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', newline='') as fp:
+                FORMATS[fmt][1](df, fp)
+            os.replace(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def evict(self, keep=None):
+        """Remove the least recently used exports above the maximum size"""
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.tmp') or entry.path == keep:
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(f[1] for f in files)
+        if keep is not None and os.path.exists(keep):
+            size += os.path.getsize(keep)
+
+        for _, file_size, path in sorted(files):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+
+
+export_cache = ExportCache()
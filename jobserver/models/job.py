@@ -15,22 +15,36 @@ Build a new Job, containing information about the Process to be executed.
 >>> job.create()
 
 """
-from threading import Thread
-from datetime import datetime as dt
+import asyncio
+import hashlib
+import json
+from datetime import datetime as dt, timedelta
 
+from bson import ObjectId
 from flask import g, current_app
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
 
 from jobserver.models.mongo import MongoModel
+from jobserver.models.mongo_async import AsyncMongoModel, async_mongo
 from jobserver.models.process import Process, FileProcess
 from jobserver.models.data_file import DataFile
 from jobserver.models.data_mongo import DataMongo
 from jobserver.models.data import BaseDataModel
+from jobserver.models.profile import JobProfile
+from jobserver.models.quota import QuotaUsage
+from jobserver.models.result import ResultStore
+from jobserver.models.user import User
+from jobserver.metrics import PhaseTimer, percentile
 from jobserver.util import load_script_func
+from jobserver.registry import registry
+from jobserver.scheduler import scheduler, parse_resources
 from jobserver.errors import JobExecutionRestrictedError, DisabledError
 
 
 class Job(MongoModel):
     collection = 'jobs'
+    _indexed = False
 
     def __init__(self, created=None, started=None, finished=None,
                  result=None, **kwargs):
@@ -44,9 +58,139 @@ class Job(MongoModel):
         for key in kwargs.keys():
             setattr(self, key, kwargs[key])
             
-    def update(self, data={}):
-        self.edited = dt.utcnow()
-        super(Job, self).update(data=data)
+    def update(self, data={}, operation='write'):
+        # a save without changes does not write
+        if len(data) > 0 or self.is_dirty:
+            self.edited = dt.utcnow()
+        return super(Job, self).update(data=data, operation=operation)
+
+    @classmethod
+    def ensure_indexes(cls):
+        """Create the unique index of the idempotency keys"""
+        if cls._indexed:
+            return
+        cls.get_collection().create_index(
+            [('user_id', ASCENDING), ('request_id', ASCENDING)],
+            unique=True,
+            partialFilterExpression={'request_id': {'$exists': True}}
+        )
+        cls._indexed = True
+
+    @classmethod
+    def create_once(cls, request_id, **kwargs):
+        """Create a Job, unless the request_id was used before
+
+        The request_id is a key chosen by the client, which is unique for
+        each user. Thus, a client can safely retry a create request, which
+        timed out, without creating a duplicated Job.
+
+        Parameters
+        ----------
+        request_id : str
+            The idempotency key of the create request.
+        kwargs : dict
+            The Job attributes. The 'user_id' scopes the request_id.
+
+        Returns
+        -------
+        job : Job
+            The new Job, or the Job created by the first request.
+        created : bool
+            True, if the Job was created by this call.
+
+        """
+        cls.ensure_indexes()
+        _filter = {'user_id': kwargs.get('user_id'), 'request_id': request_id}
+        coll = cls.get_collection()
+
+        doc = coll.find_one(_filter)
+        if doc is None:
+            job = cls(request_id=request_id, **kwargs)
+            try:
+                job.create()
+                return job, True
+            except DuplicateKeyError:
+                # a concurrent request with the same key was faster
+                doc = coll.find_one(_filter)
+        return cls.from_document(doc), False
+
+    def claim(self, run_key=None, timeout=None):
+        """Atomically mark this Job as submitted for execution
+
+        Only one of many concurrent or retried run requests can claim a
+        Job, so it is executed exactly once. The scheduler queue is held in
+        memory, thus a claimed Job, which was never started, is lost on a
+        restart. Its claim lapses after timeout seconds.
+
+        Parameters
+        ----------
+        run_key : str
+            Optional idempotency key of the run request. A retried run
+            request can be recognized by it.
+        timeout : float
+            Seconds after which the claim of a Job, that has not started,
+            can be taken over. None, to never let a claim lapse.
+
+        Returns
+        -------
+        claimed : bool
+            True, if this call claimed the Job. False, if it was already
+            submitted or started.
+
+        """
+        # the Job changes, so clients have to revalidate it
+        now = dt.utcnow()
+        claim = {'submitted': now, 'edited': now}
+        if run_key is not None:
+            claim['run_key'] = run_key
+        _filter = {'_id': self.id, 'started': None, 'submitted': None}
+        if timeout is not None:
+            expired = now - timedelta(seconds=timeout)
+            del _filter['submitted']
+            _filter['$or'] = [
+                {'submitted': None},
+                {'submitted': {'$lt': expired}}
+            ]
+        res = self.get_collection().update_one(_filter, {'$set': claim})
+        if res.modified_count == 0:
+            return False
+        self._doc.update(claim)
+        return True
+
+    def release(self):
+        """Release the claim of a Job that could not be started"""
+        edited = dt.utcnow()
+        self.get_collection().update_one(
+            {'_id': self.id},
+            {'$set': {'edited': edited},
+             '$unset': {'submitted': '', 'run_key': ''}}
+        )
+
+    def mark_started(self):
+        """Atomically set the start date of this Job
+
+        A lapsed claim can submit a Job a second time, while it is still
+        queued. Only the first Process marking the Job runs it.
+
+        Returns
+        -------
+        started : bool
+            True, if this call started the Job. False, if it was already
+            started.
+
+        """
+        now = dt.utcnow()
+        res = self.get_collection('progress').update_one(
+            {'_id': self.id, 'started': None},
+            {'$set': {'started': now, 'edited': now}}
+        )
+        if res.modified_count == 0:
+            return False
+        self._doc.update({'started': now, 'edited': now})
+        return True
+        self._doc['edited'] = edited
+        self._doc.pop('submitted', None)
+        self._doc.pop('run_key', None)
 
     def start(self):
         """Execute Job
@@ -57,41 +201,189 @@ class Job(MongoModel):
         quota, a superuser or admin are assumed to be unrestricted.
 
         The data and process are loaded from the configured 'data' and
-        'script' information. The Job execution itself is called in a new
-        Thread that runs the Process.run method. After starting the thread,
-        meta data about the data object and the Process class are stored into
-        the Job instance and are persisted into the database.
+        'script' information. Meta data about the data object and the
+        Process class are stored into the Job instance and are persisted into
+        the database. Then, the Process is submitted to the scheduler, which
+        runs the Process.run method on one of its worker threads, considering
+        the 'priority' of the Job and the fair share of its user.
+
+        Before anything else, the script and its arguments are validated by
+        check_script.
+
+        The duration of each phase of the Job execution is recorded into the
+        'timings' attribute: restriction, data_load, script_resolution,
+        queue_wait, execution, result_conversion and persistence.
+
+        A Job identical to a queued or running one is not executed again,
+        but receives the result of the other Job, see get_fingerprint.
 
         Returns
         -------
         void
 
         """
+        timer = PhaseTimer()
+
+        # fail early on unknown scripts and bad arguments
+        with timer.phase('script_resolution'):
+            spec = self.check_script()
+            self.get_priority()
+            resources = self.get_resources(spec)
+            scheduler.check(resources)
+            if self.profile:
+                self.check_profiling()
+
         # check, if the job execution is restricted
-        self.check_restrictions()
+        with timer.phase('restriction'):
+            self.check_restrictions()
+
+        # everything below may fail, give back the consumed quota then
+        try:
+            # load data
+            with timer.phase('data_load'):
+                data = self.load_input_data()
+
+            # load the process
+            with timer.phase('script_resolution'):
+                process = self.load_process(data=data, timer=timer, spec=spec)
+            process.timer = timer
+            process.spec = spec
+            process.memory_limit = resources['memory']
+            process.cores = resources['cores']
+
+            # run under the profiler, if requested
+            if self.profile:
+                process.profile = True
+                process.profile_top_n = current_app.config.get(
+                    'JOB_PROFILE_TOP_N', 30)
+                process.profile_stats = current_app.config.get(
+                    'JOB_PROFILE_STORE_STATS', True)
+
+            # keep DataFrame results for the binary download formats
+            process.store_table = ResultStore.enabled() and \
+                current_app.config.get('JOB_RESULT_TABLES', True)
+
+            # let the Process report a heartbeat while running
+            if async_mongo.enabled:
+                process.heartbeat_interval = current_app.config.get(
+                    'JOB_HEARTBEAT_INTERVAL')
+
+            # store data information
+            self.fingerprint = self.get_fingerprint(spec, data)
+            self.data = data.to_dict()
+
+            # Process object
+            process_dict = self.script
+            if process_dict is None:
+                process_dict = {}
+            process_dict.update(process.to_dict())
+            if spec is not None:
+                process_dict['version'] = spec.version
+            process_dict['resources'] = resources
+            self.script = process_dict
+
+            # save everything, before the worker takes over the Job
+            with timer.phase('persistence'):
+                self.timings = timer.to_dict()
+                self.save()
+
+            # submit the Process to the scheduler. Identical Jobs are coalesced
+            process.enqueue()
+            user = getattr(g, 'user', None)
+            scheduler.submit(
+                process,
+                key=self.user_id,
+                role=user.role if user is not None else None,
+                priority=self.get_priority(),
+                resources=resources,
+                fingerprint=self.fingerprint
+            )
+        except Exception:
+            self.refund_quota()
+            raise
+
+    def get_priority(self):
+        """Return the scheduling priority of this Job
 
-        # load data
-        data = self.load_input_data()
+        The priority only orders the Jobs of the same user. Defaults to 0.
 
-        # load the process
-        process = self.load_process(data=data)
+        """
+        if self.priority is None:
+            return 0
+        try:
+            return int(self.priority)
+        except (TypeError, ValueError):
+            raise ValueError('The priority has to be an integer.')
 
-        # start the Process in a new Thread
-        # TODO: here, I could use joblib memcache
-        Thread(target=process.run).start()
+    def get_fingerprint(self, spec, data):
+        """Return the fingerprint of the script, arguments and input data
 
-        # store data information
-        self.data = data.to_dict()
+        Jobs of the same fingerprint compute the same result. Only Jobs of
+        registered scripts, which allow coalescing, are fingerprinted.
+        Profiled Jobs are never coalesced.
 
-        # Process object
-        process_dict = self.script
-        if process_dict is None:
-            process_dict = {}
-        process_dict.update(process.to_dict())
-        self.script = process_dict
+        Returns
+        -------
+        fingerprint : str
+            The hex digest, or None if the Job must not be coalesced.
+
+        """
+        if spec is None or not spec.coalesce or self.profile:
+            return None
+        script = self.script if isinstance(self.script, dict) else {}
+        try:
+            key = json.dumps([spec.name, spec.version,
+                              script.get('args', []),
+                              script.get('kwargs', {}),
+                              data.identity()],
+                             sort_keys=True, default=str)
+        except (TypeError, ValueError, OSError):
+            return None
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get_resources(self, spec=None):
+        """Return the resources requested by this Job
+
+        The resource hints of the script can be raised by a 'resources'
+        dict on the Job, like {'cores': 4, 'memory': '2G'}. See
+        jobserver.scheduler.parse_resources.
+
+        """
+        hints = spec.resources if spec is not None else None
+        return parse_resources(hints, self.resources)
 
-        # save everything
-        self.save()
+    def check_script(self):
+        """Validate the script settings
+
+        For function scripts, the script is looked up in the registry and
+        the Job arguments are bound to its signature. Thus, a Job with an
+        unknown script or bad arguments fails before it is started.
+
+        Returns
+        -------
+        spec : jobserver.registry.ScriptSpec
+            The registered script, or None for other script types.
+
+        Raises
+        ------
+        error : ScriptNotFoundError
+            If the script function is not registered.
+        error : ScriptArgumentError
+            If the arguments do not match the script signature.
+
+        """
+        if self.script is not None and isinstance(self.script, dict):
+            if self.script.get('type', 'function') != 'function':
+                return None
+            spec = registry.get(self.script.get('name'))
+            spec.bind(self.script.get('args', []),
+                      self.script.get('kwargs', {}))
+        elif self.script_name is not None:
+            spec = registry.get(self.script_name)
+            spec.bind()
+        else:
+            return None
+        return spec
 
     def check_restrictions(self):
         """Check Job availability
@@ -99,12 +391,13 @@ class Job(MongoModel):
         In the standard configuration a job can only be executed if the user
         is a superuser or admin or if the user has a attribute 'job_quota' > 1,
         which will be decreased. If the passed user is None, API login is
-        assumed to be turned off and the job execution is unlimited
+        assumed to be turned off and the job execution is unlimited.
 
-        Parameters
-        ----------
-        user : User
-            The user requesting to start the job.
+        Additionally, the time-windowed quotas 'jobs_per_hour' and
+        'cpu_seconds_per_day' are checked, see jobserver.models.quota. All
+        quotas are consumed by atomic updates, so concurrent starts by the
+        same user cannot overspend them. The consumed quotas are stored in
+        the 'quota' attribute, to refund them on errors.
 
         Returns
         -------
@@ -126,36 +419,147 @@ class Job(MongoModel):
         if user.role in ['superuser', 'admin']:
             return None
 
+        user_id = str(user.id)
+        config = current_app.config
+
+        # time-windowed quotas
+        limits = {
+            'jobs_per_hour': user.jobs_per_hour if user.jobs_per_hour
+            is not None else config.get('QUOTA_JOBS_PER_HOUR'),
+            'cpu_seconds_per_day': user.cpu_seconds_per_day
+            if user.cpu_seconds_per_day is not None
+            else config.get('QUOTA_CPU_SECONDS_PER_DAY')
+        }
+        if any(limit is not None for limit in limits.values()):
+            QuotaUsage.ensure_indexes(config.get('QUOTA_USAGE_TTL_DAYS', 7))
+        quota = {
+            'user_id': user_id,
+            'job_quota': False,
+            'jobs_per_hour': False,
+            'cpu_seconds': limits['cpu_seconds_per_day'] is not None
+        }
+
+        # the CPU time is only known afterwards, so only check the limit
+        if limits['cpu_seconds_per_day'] is not None and \
+                not QuotaUsage.consume(user_id, 'cpu_seconds_per_day',
+                                       limits['cpu_seconds_per_day'], 0):
+            raise JobExecutionRestrictedError(
+                'The CPU time of today is used up.')
+
+        if limits['jobs_per_hour'] is not None and \
+                not QuotaUsage.consume(user_id, 'jobs_per_hour',
+                                       limits['jobs_per_hour'], 1):
+            raise JobExecutionRestrictedError(
+                'Too many Jobs started within the last hour.')
+        quota['jobs_per_hour'] = limits['jobs_per_hour'] is not None
+
         # check if quota is deactivated for this user:
-        if user.job_quota is None:
+        if user.job_quota is not None:
+            # decrease the quota, only if there is one left
+            res = User.get_collection('write').update_one(
+                {'_id': user.id, 'job_quota': {'$gte': 1}},
+                {'$inc': {'job_quota': -1}}
+            )
+            if res.modified_count == 0:
+                if quota['jobs_per_hour']:
+                    QuotaUsage.add(user_id, 'jobs_per_hour', -1)
+                raise JobExecutionRestrictedError(
+                    'No Job execution time left.')
+            quota['job_quota'] = True
+
+        self.quota = quota
+        return None
+
+    def check_profiling(self):
+        """Check if profiling is allowed
+
+        The JOB_PROFILING config value controls who is allowed to run a Job
+        under the profiler. If set to 'all', every user may profile Jobs,
+        if set to 'admin', only superusers and admins, or any request if the
+        API login is turned off. Any other value disables profiling.
+
+        Raises
+        ------
+        error : DisabledError
+            In case the profiling is not allowed.
+
+        """
+        policy = current_app.config.get('JOB_PROFILING')
+        user = getattr(g, 'user', None)
+
+        if policy == 'all':
             return None
+        elif policy == 'admin' and \
+                (user is None or user.role in ['superuser', 'admin']):
+            return None
+        raise DisabledError('Job profiling is not allowed.')
+
+    def refund_quota(self):
+        """Give back the quotas consumed by check_restrictions
 
-        # check if user has quota
-        if user.job_quota is not None and user.job_quota >= 1:
-            user.job_quota -= 1
-            user.save()
+        Used, if the Job could not be started after its restrictions were
+        checked. Both, the 'job_quota' of the user and the started Job of
+        the 'jobs_per_hour' window are refunded.
+
+        Returns
+        -------
+        None
+
+        """
+        quota = self.quota
+        if quota is None:
             return None
-        else:
-            raise JobExecutionRestrictedError('No Job execution time left.')
+
+        if quota.get('jobs_per_hour'):
+            QuotaUsage.add(quota['user_id'], 'jobs_per_hour', -1)
+            quota['jobs_per_hour'] = False
+        if quota.get('job_quota'):
+            User.get_collection('write').update_one(
+                {'_id': ObjectId(quota['user_id'])},
+                {'$inc': {'job_quota': 1}}
+            )
+            quota['job_quota'] = False
+        self.quota = quota
+        return None
+
+    @classmethod
+    def on_delete(cls, ids):
+        # remove the profiles and result tables of deleted jobs
+        JobProfile.get_collection('write').delete_many({'_id': {'$in': ids}})
+        ResultStore.delete(ids)
 
     def on_error(self):
         """Error handler
 
-        This error handler is used to handle the active user on job errors.
-        As default behaviour any user with a configured quota will get an
-        increase of 1 unit on his quota as the job errored.
+        This error handler is used to handle the user of the Job on job
+        errors. As default behaviour any user with a consumed job_quota will
+        get an increase of 1 unit on his quota as the job errored. The
+        refund is an atomic increment, as the handler is called from the
+        worker running the Job.
 
         Returns
         -------
         None
 
         """
-        # get user
-        user = getattr(g, 'user', None)
+        quota = self.quota
+        if quota is None or not quota.get('job_quota'):
+            return None
 
-        if user is not None and user.job_quota is not None:
-            user.job_quota += 1
-            user.save()
+        User.get_collection('write').update_one(
+            {'_id': ObjectId(quota['user_id'])},
+            {'$inc': {'job_quota': 1}}
+        )
+        quota['job_quota'] = False
+        self.quota = quota
+        self.save(operation='progress')
+
+    def record_usage(self, core_seconds):
+        """Add the core-seconds of the execution to the daily usage"""
+        if self.quota is None or not self.quota.get('cpu_seconds'):
+            return None
+        QuotaUsage.add(self.quota['user_id'], 'cpu_seconds_per_day',
+                       core_seconds)
 
     def load_input_data(self):
         """Check input data and load model
@@ -212,7 +616,14 @@ class Job(MongoModel):
         else:
             raise ValueError('No data-like setting found on this Job.')
 
-    def load_process(self, data):
+    @staticmethod
+    def _read_data(data, timer=None):
+        if timer is None:
+            return data.read()
+        with timer.phase('data_load'):
+            return data.read()
+
+    def load_process(self, data, timer=None, spec=None):
         """Check script settings and load
 
         The specified script settings will be checked and then the
@@ -226,12 +637,17 @@ class Job(MongoModel):
             Process. The Process will pass the data down to the loaded
             function. This way, a custom Process class can handle data
             differently for its respective types of functions.
+        timer : jobserver.metrics.PhaseTimer
+            Optional timer to record the time spent reading the data.
+        spec : jobserver.registry.ScriptSpec
+            The script returned by check_script. If given, this version of
+            the script is run, even if the script was reloaded meanwhile.
 
         Returns
         -------
         process : Process
-            Process instance. The job start method will execute the Process.run
-            method in an extra Thread.
+            Process instance. The scheduler will execute the Process.run
+            method on one of its worker threads.
 
         Notes
         -----
@@ -263,12 +679,15 @@ class Job(MongoModel):
             # ---------------------------------------------------
             if self.script.get('type', 'function') == 'function':
                 # load the function
-                func = load_script_func('scripts', self.script['name'])
+                if spec is not None:
+                    func = spec.func
+                else:
+                    func = load_script_func('scripts', self.script['name'])
 
                 # return the Process instance
                 return Process(
                     f=func,
-                    data=data.read(),
+                    data=self._read_data(data, timer),
                     args=self.script.get('args', []),
                     kwargs=self.script.get('kwargs', {}),
                     job=self
@@ -291,7 +710,7 @@ class Job(MongoModel):
                 # return the Process instance
                 return FileProcess(
                     filename=self.script.get('name'),
-                    data=data.read(),
+                    data=self._read_data(data, timer),
                     args=self.script.get('args', []),
                     kwargs=self.script.get('kwargs', {}),
                     job=self
@@ -317,8 +736,9 @@ class Job(MongoModel):
         # script_name shortcut used
         elif self.script_name is not None:
             return Process(
+                spec.func if spec is not None else
                 load_script_func('scripts', self.script_name),
-                data.read(),
+                self._read_data(data, timer),
                 args=[],
                 kwargs={},
                 job=self
@@ -328,8 +748,110 @@ class Job(MongoModel):
         else:
             raise ValueError('No script to process was specified')
 
-    def create(self):
+    @classmethod
+    def timing_stats(cls, filter={}, percentiles=(50, 95, 99), limit=None):
+        """Aggregate the phase timings
+
+        Calculates percentiles of the recorded phase timings of all Jobs
+        matching filter, grouped by script name and phase.
+
+        Parameters
+        ----------
+        filter : dict
+            MongoDB query filter.
+        percentiles : tuple
+            The percentiles to calculate.
+        limit : int
+            Use only the most recent limit Jobs, to bound the number of
+            durations held in memory. None uses all Jobs.
+
+        Returns
+        -------
+        stats : dict
+            Nested dict of script name, phase and 'p<percentile>' keys. Each
+            phase also holds the number of Jobs as 'count'.
+        found : int
+            Number of Jobs used.
+
+        """
+        fields = {'timings': 1, 'script.name': 1}
+        docs = cls.get_collection('list').find(filter, fields)\
+            .sort('_id', -1)
+        if limit is not None:
+            docs = docs.limit(limit)
+
+        # collect the durations
+        values, found = dict(), 0
+        for doc in docs:
+            timings = doc.get('timings')
+            if not isinstance(timings, dict):
+                continue
+            found += 1
+            name = (doc.get('script') or {}).get('name', 'unknown')
+            for phase, seconds in timings.items():
+                values.setdefault(name, dict()).setdefault(phase, [])\
+                    .append(seconds)
+
+        # calculate
+        stats = dict()
+        for name, phases in values.items():
+            stats[name] = dict()
+            for phase, durations in phases.items():
+                durations.sort()
+                d = {'count': len(durations)}
+                for q in percentiles:
+                    d['p%d' % q] = percentile(durations, q)
+                stats[name][phase] = d
+
+        return stats, found
+
+    def create(self, operation='write'):
         if self.created is None:
             self.created = dt.utcnow()
 
-        super(Job, self).create()
+        super(Job, self).create(operation=operation)
+
+
+class AsyncJob(AsyncMongoModel):
+    """Async access to the Jobs
+
+    Used by the ASGI routes and the heartbeat of running Jobs. See Job for
+    the Job execution.
+
+    """
+    collection = Job.collection
+    view_class = Job.view_class
+
+    async def update(self, data={}, operation='write'):
+        # a save without changes does not write
+        if len(data) > 0 or self.is_dirty:
+            self.edited = dt.utcnow()
+        return await super(AsyncJob, self).update(
+            data=data, operation=operation
+        )
+
+    @classmethod
+    async def on_delete(cls, ids):
+        # remove the profiles and result tables of deleted jobs
+        await cls.mongo.collection(JobProfile.collection, 'write')\
+            .delete_many({'_id': {'$in': ids}})
+        await cls.mongo.collection('%s.files' % ResultStore.bucket, 'write')\
+            .delete_many({'_id': {'$in': ids}})
+        await cls.mongo.collection('%s.chunks' % ResultStore.bucket,
+                                   'write')\
+            .delete_many({'files_id': {'$in': ids}})
+
+    @classmethod
+    async def send_heartbeats(cls, job_id, interval):
+        """Update the 'heartbeat' field of a running Job
+
+        Sets the heartbeat to the current time every interval seconds, until
+        cancelled. A Job, which was started but has not finished and has an
+        outdated heartbeat, died with its process.
+
+        """
+        coll = cls.get_collection('progress')
+        while True:
+            await coll.update_one({'_id': job_id},
+                                  {'$set': {'heartbeat': dt.utcnow()}})
+            await asyncio.sleep(interval)
@@ -4,24 +4,271 @@ MongoDB instance defined in the app.py. Can be inherited by the actual data
 models.
 """
 from bson import ObjectId
+from bson.codec_options import CodecOptions
 from bson.errors import InvalidId
+from bson.raw_bson import RawBSONDocument
 from flask_pymongo import PyMongo
-
-mongo = PyMongo()
-
-
-class MongoModel(object):
-    mongo = mongo
+from pymongo import ReadPreference
+from pymongo.write_concern import WriteConcern
+
+from jobserver.models.view import DocumentView
+from jobserver import metrics
+
+WRITE_CONCERN_KEYS = ('w', 'wtimeout', 'j', 'fsync')
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST
+}
+
+
+def client_options(config):
+    """Build the MongoClient keyword arguments from the app config"""
+    options = {
+        'maxPoolSize': config.get('MONGO_MAX_POOL_SIZE'),
+        'minPoolSize': config.get('MONGO_MIN_POOL_SIZE'),
+        'waitQueueTimeoutMS': config.get('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+        'readPreference': config.get('MONGO_READ_PREFERENCE'),
+    }
+    options = {k: v for k, v in options.items() if v is not None}
+
+    if config.get('MONGO_MONITORING'):
+        options['event_listeners'] = [
+            metrics.command_latency, metrics.pool_wait
+        ]
+    return options
+
+
+class Mongo(PyMongo):
+    """PyMongo extension with tuned client and per operation options
+
+    The client is configured from the application config:
+
+    * MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE: size of the connection pool.
+    * MONGO_WAIT_QUEUE_TIMEOUT_MS: time a thread waits for a free
+      connection before an error is raised.
+    * MONGO_READ_PREFERENCE: default read preference, like 'primary' or
+      'secondaryPreferred'.
+    * MONGO_OPERATIONS: dict of operation type to options. Each option dict
+      may contain write concern keys (w, wtimeout, j, fsync) and a
+      'read_preference'. Models pass the operation type along with their
+      requests, e.g. 'progress' for job status writes and 'result' for the
+      job result.
+    * MONGO_MONITORING: if True, command latencies per collection and
+      connection pool waits are recorded in jobserver.metrics.
+
+    """
+    def __init__(self, app=None, *args, **kwargs):
+        self.operations = dict()
+        super(Mongo, self).__init__(app, *args, **kwargs)
+
+    def init_app(self, app, uri=None, *args, **kwargs):
+        config = app.config
+        for key, value in client_options(config).items():
+            kwargs.setdefault(key, value)
+
+        # build the options of each operation type
+        self.operations = dict()
+        for name, opts in config.get('MONGO_OPERATIONS', {}).items():
+            self.operations[name] = self.parse_operation(opts)
+
+        super(Mongo, self).init_app(app, uri, *args, **kwargs)
+
+    @staticmethod
+    def parse_operation(opts):
+        parsed = dict()
+        wc = {k: v for k, v in opts.items() if k in WRITE_CONCERN_KEYS}
+        if len(wc) > 0:
+            parsed['write_concern'] = WriteConcern(**wc)
+        if opts.get('read_preference') is not None:
+            parsed['read_preference'] = READ_PREFERENCES[
+                opts['read_preference']
+            ]
+        return parsed
+
+    def collection(self, name, operation=None):
+        """Return a collection configured for the given operation type"""
+        coll = self.db[name]
+        options = self.operations.get(operation)
+        if options:
+            coll = coll.with_options(**options)
+        return coll
+
+
+mongo = Mongo()
+
+
+class DocumentModel(object):
+    """Attribute access and change tracking of a MongoDB document
+
+    Base of MongoModel and AsyncMongoModel, which add the synchronous and
+    asynchronous database operations.
+
+    """
     collection = None
+    view_class = DocumentView
 
     def __init__(self, **kwargs):
         self.__dict__['_id'] = None
         self.__dict__['_doc'] = dict()
-        self.__dict__['db'] = mongo.db
+        self.__dict__['_dirty'] = set()
+        self.__dict__['_unset'] = set()
         for key in kwargs.keys():
 #            self._doc[key] = kwargs[key]
             setattr(self, key, kwargs[key])
 
+    @classmethod
+    def from_document(cls, doc):
+        """Instantiate from a stored document
+
+        Builds a model instance from a document as returned by the database.
+        As the instance reflects the stored state, it is marked clean
+        afterwards, so that a subsequent update will only write the fields
+        changed after loading.
+
+        Parameters
+        ----------
+        doc : dict
+            The MongoDB document including its '_id'.
+
+        Returns
+        -------
+        instance : DocumentModel
+
+        """
+        instance = cls(**doc)
+        instance.mark_clean()
+        return instance
+
+    def mark_clean(self):
+        """Reset the change tracking
+
+        After calling this method the instance is assumed to be in sync with
+        the database.
+
+        """
+        self._dirty.clear()
+        self._unset.clear()
+
+    @property
+    def is_dirty(self):
+        return len(self._dirty) > 0 or len(self._unset) > 0
+
+    def take_changes(self):
+        """Build the minimal update document of all changes
+
+        The changes are taken, thus the instance is clean afterwards. Changes
+        made meanwhile are kept.
+
+        Returns
+        -------
+        update : dict
+            $set and $unset update document. Empty if nothing changed.
+
+        """
+        dirty, unset = set(self._dirty), set(self._unset)
+        self._dirty.difference_update(dirty)
+        self._unset.difference_update(unset)
+
+        d = dict()
+        fields = {k: self._doc[k] for k in dirty if k in self._doc}
+        if len(fields) > 0:
+            d['$set'] = fields
+        removed = {k: '' for k in unset if k not in self._doc}
+        if len(removed) > 0:
+            d['$unset'] = removed
+        return d
+
+    def restore_changes(self, update):
+        """Track the changes of a failed update again
+
+        Parameters
+        ----------
+        update : dict
+            The update document returned by take_changes, which could not
+            be written. A retried save will write it again.
+
+        """
+        self._dirty.update(update.get('$set', {}))
+        self._unset.update(update.get('$unset', {}))
+
+    @property
+    def id(self):
+        return self._id
+
+    def to_dict(self, stringify=False):
+        # load the document
+        d = dict(self._doc)
+
+        # append id if set
+        if self.id is not None:
+            d.update({'_id': self.id})
+
+        # stringify all values
+        def _stringify(val):
+            if isinstance(val, dict):
+                return {k: _stringify(v) for k, v in val.items()}
+            return str(val)
+
+        if stringify:
+            return _stringify(d)
+        else:
+            return d
+
+    @classmethod
+    def on_delete(cls, ids):
+        """Clean up associated artifacts
+
+        Called after documents were deleted from the collection. Child
+        classes that store information outside of their own documents
+        (like blobs or cache entries) should overwrite this method and
+        remove everything associated to the given ids.
+
+        Parameters
+        ----------
+        ids : list
+            ObjectIds of the deleted documents.
+
+        Returns
+        -------
+        None
+
+        """
+        pass
+
+    def __getattr__(self, item):
+        return self._doc.get(item, None)
+
+    def __setattr__(self, key, value):
+        if key.lower() == '_id' or key.lower() == 'id':
+            if isinstance(value, ObjectId):
+                self.__dict__['_id'] = value
+            else:
+                self.__dict__['_id'] = ObjectId(value)
+        else:
+            self._doc.update({key: value})
+            self._dirty.add(key)
+            self._unset.discard(key)
+
+    def __delattr__(self, item):
+        if item.lower() == '_id' or item.lower() == 'id':
+            raise ValueError('This would delete the whole object.' +
+                             ' Please use the delete method')
+        else:
+            del self._doc[item]
+            self._dirty.discard(item)
+            self._unset.add(item)
+
+
+class MongoModel(DocumentModel):
+    mongo = mongo
+
+    def __init__(self, **kwargs):
+        self.__dict__['db'] = mongo.db
+        super(MongoModel, self).__init__(**kwargs)
+
     @classmethod
     def id_exists(cls, _id):
         if not isinstance(_id, ObjectId):
@@ -30,11 +277,12 @@ class MongoModel(object):
         # check if this id already exists
         return cls.mongo.db[cls.collection].count_documents({'_id': _id}) > 0
 
-    @property
-    def id(self):
-        return self._id
+    @classmethod
+    def get_collection(cls, operation=None):
+        """Return the model collection configured for an operation type"""
+        return cls.mongo.collection(cls.collection, operation=operation)
 
-    def create(self):
+    def create(self, operation='write'):
         # prepare the dict
         d = self._doc
 
@@ -43,54 +291,69 @@ class MongoModel(object):
         if self.id is not None:
             d['_id'] = self.id
 
-        new_id = self.db[self.collection].insert_one(d).inserted_id
+        new_id = self.get_collection(operation).insert_one(d).inserted_id
 
         # set the new id, if it is new
         self._id = new_id
 
-    def update(self, data={}):
-        # update this instance if necessary
-        self._doc.update(data)
+        # the whole document was written
+        self.mark_clean()
 
-        # prepare the dict
-        d = self._doc
+    def update(self, data={}, operation='write'):
+        """Update the database document
 
-        self.db[self.collection].update_one(
-            {'_id': self.id},
-            {'$set': d}
-        )
+        Only the fields changed since the last load or write are sent to the
+        database. Changed attributes are $set, deleted attributes are $unset.
+        If nothing has changed, no request is sent at all.
 
-    def save(self):
-        if self.id is not None:
-            self.update()
-        else:
-            self.create()
+        .. note::
+            Nested objects are tracked by assignment only. If a dict or list
+            attribute is mutated in place, it has to be assigned again to be
+            persisted.
 
-    def to_dict(self, stringify=False):
-        # load the document
-        d = self._doc
+        Parameters
+        ----------
+        data : dict
+            Optional new values to be set on this instance before updating.
+        operation : str
+            Operation type used to configure the write concern. See Mongo.
 
-        # append id if set
-        if self.id is not None:
-            d.update({'_id': self.id})
+        Returns
+        -------
+        acknowledged : bool
+            False if nothing had to be written, True otherwise.
 
-        # stringify all values
-        def _stringify(val):
-            if isinstance(val, dict):
-                return {k: _stringify(v) for k, v in val.items()}
-            return str(val)
+        """
+        # update this instance if necessary
+        for key, value in data.items():
+            setattr(self, key, value)
 
-        if stringify:
-            return _stringify(d)
+        # nothing changed
+        d = self.take_changes()
+        if len(d) == 0:
+            return False
+
+        try:
+            self.get_collection(operation).update_one({'_id': self.id}, d)
+        except Exception:
+            # keep the changes for a retried save
+            self.restore_changes(d)
+            raise
+        return True
+
+    def save(self, operation='write'):
+        if self.id is not None:
+            self.update(operation=operation)
         else:
-            return d
+            self.create(operation=operation)
 
     def delete(self):
-        res = self.db[self.collection].delete_one({'_id': self.id})
+        res = self.get_collection('write').delete_one({'_id': self.id})
 
         if res.deleted_count == 0:
             return False
         else:
+            self.on_delete([self.id])
             return True
 
     @classmethod
@@ -104,52 +367,103 @@ class MongoModel(object):
             except InvalidId:
                 return None
 
-        # update filter
-        filter.update({'_id': _id})
+        # do not change the filter of the caller
+        _filter = dict(filter)
+        _filter.update({'_id': _id})
 
-        res = cls.mongo.db[cls.collection].find_one(filter, fields)
+        res = cls.get_collection('read').find_one(_filter, fields)
         if res is None:
             return None
 
-        return cls(**res)
+        return cls.from_document(res)
 
     @classmethod
-    def get_all(cls, filter={}, fields=None):
+    def get_all(cls, filter={}, fields=None, view=False):
+        """Load all matching documents
+
+        Parameters
+        ----------
+        filter : dict
+            MongoDB query filter.
+        fields : dict
+            Optional projection of the returned fields.
+        view : bool
+            If True, a generator of read-only view_class instances is
+            returned instead of a list of model instances. The documents
+            are then fetched as raw BSON and only decoded on access, which
+            is much cheaper for listings that only serialize the documents.
+
+        Returns
+        -------
+        docs : list, generator
+
+        """
         if cls.collection is None:
             raise ValueError('No collection set on child class')
 
-        # load all docs in this collection
-        all_docs = cls.mongo.db[cls.collection].find(filter, fields)
-
-        return [cls(**doc) for doc in all_docs]
-
-    def __getattr__(self, item):
-        return self._doc.get(item, None)
+        if view:
+            coll = cls.get_collection('list')
+            try:
+                coll = coll.with_options(
+                    codec_options=CodecOptions(document_class=RawBSONDocument)
+                )
+            except NotImplementedError:
+                # the client cannot return raw documents (e.g. mongomock)
+                pass
+            return (cls.view_class(doc) for doc in coll.find(filter, fields))
 
-    def __setattr__(self, key, value):
-        if key.lower() == '_id' or key.lower() == 'id':
-            if isinstance(value, ObjectId):
-                self.__dict__['_id'] = value
-            else:
-                self.__dict__['_id'] = ObjectId(value)
-        else:
-            self._doc.update({key: value})
+        # load all docs in this collection
+        all_docs = cls.get_collection('list').find(filter, fields)
 
-    def __delattr__(self, item):
-        if item.lower() == '_id' or item.lower() == 'id':
-            raise ValueError('This would delete the whole object.' +
-                             ' Please use the delete method')
-        else:
-            del self._doc[item]
+        return [cls.from_document(doc) for doc in all_docs]
 
     @classmethod
-    def delete_all(cls, filter={}):
-        jobs = cls.get_all(filter=filter)
-
-        # total operations
-        tot = [job.delete() for job in jobs]
-
-        # successful operation
-        suc = [_ for _ in tot if _]
-
-        return len(suc), len(tot)
+    def delete_all(cls, filter={}, batch_size=1000):
+        """Delete all matching documents
+
+        The documents are deleted on the server side. If the class does not
+        need to clean up any artifacts, a single delete_many is issued.
+        Otherwise, the matching ids are deleted in batches of batch_size and
+        passed to on_delete after each batch.
+
+        Parameters
+        ----------
+        filter : dict
+            MongoDB query filter.
+        batch_size : int
+            Number of documents deleted per request, if artifacts have to
+            be cleaned up.
+
+        Returns
+        -------
+        deleted : int
+            Number of deleted documents.
+        total : int
+            Number of documents matching the filter.
+
+        """
+        coll = cls.get_collection('write')
+
+        # nothing to clean up, delete everything at once
+        if cls.on_delete.__func__ is DocumentModel.on_delete.__func__:
+            deleted = coll.delete_many(filter).deleted_count
+            return deleted, deleted
+
+        def _flush(ids):
+            res = coll.delete_many({'_id': {'$in': ids}})
+            cls.on_delete(ids)
+            return res.deleted_count
+
+        # delete in batches
+        deleted, total, batch = 0, 0, []
+        for doc in coll.find(filter, {'_id': 1}):
+            batch.append(doc['_id'])
+            if len(batch) >= batch_size:
+                deleted += _flush(batch)
+                total += len(batch)
+                batch = []
+        if len(batch) > 0:
+            deleted += _flush(batch)
+            total += len(batch)
+
+        return deleted, total
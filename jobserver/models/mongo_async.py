@@ -0,0 +1,246 @@
+"""
+Asynchronous access to the MongoDB instance defined in the app.py.
+
+The async access is based on motor, which is an optional dependency of the
+jobserver. It is needed for the ASGI serving mode and the Job heartbeats and
+can be installed like:
+
+.. code-block:: bash
+
+    pip install jobserver[asgi]
+
+A motor client is bound to the event loop it is first used in. Therefore,
+AsyncMongo creates one client per event loop, using the same connection
+pool and operation options as the synchronous client. Synchronous code, like
+the Job Process threads, can run coroutines on a background event loop by
+AsyncMongo.submit.
+
+AsyncMongoModel is the async counterpart of MongoModel. It shares the
+attribute access and change tracking, but all database operations are
+coroutines:
+
+>>> job = await AsyncJob.get(job_id)
+>>> job.message = 'halfway there'
+>>> await job.update(operation='progress')
+
+"""
+import asyncio
+from threading import Thread, Lock
+from weakref import WeakKeyDictionary
+
+from bson import ObjectId
+from bson.codec_options import CodecOptions
+from bson.errors import InvalidId
+from bson.raw_bson import RawBSONDocument
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+from jobserver.models.mongo import Mongo, DocumentModel, client_options
+
+
+class AsyncMongo:
+    def __init__(self, app=None):
+        self.uri = None
+        self.options = dict()
+        self.operations = dict()
+        self._clients = WeakKeyDictionary()
+        self._loop = None
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.uri = app.config.get('MONGO_URI')
+        self.options = client_options(app.config)
+        self.operations = {
+            name: Mongo.parse_operation(opts)
+            for name, opts in app.config.get('MONGO_OPERATIONS', {}).items()
+        }
+
+    @property
+    def enabled(self):
+        """True, if motor is installed and the app is initialized"""
+        return AsyncIOMotorClient is not None and self.uri is not None
+
+    @property
+    def cx(self):
+        """The motor client of the running event loop"""
+        if AsyncIOMotorClient is None:
+            raise RuntimeError('Async MongoDB access needs motor. Install '
+                               'it by: pip install motor')
+        if self.uri is None:
+            raise RuntimeError('AsyncMongo is not initialized.')
+        loop = asyncio.get_event_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = AsyncIOMotorClient(self.uri, io_loop=loop,
+                                        **self.options)
+            self._clients[loop] = client
+        return client
+
+    @property
+    def db(self):
+        return self.cx.get_default_database()
+
+    def collection(self, name, operation=None):
+        """Return a collection configured for the given operation type"""
+        coll = self.db[name]
+        options = self.operations.get(operation)
+        if options:
+            coll = coll.with_options(**options)
+        return coll
+
+    def submit(self, coro):
+        """Run a coroutine on the background event loop
+
+        The loop is started in a daemon thread on first use.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Cancelling the future cancels the coroutine.
+
+        """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                Thread(target=self._loop.run_forever, daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+
+async_mongo = AsyncMongo()
+
+
+class AsyncMongoModel(DocumentModel):
+    """Async counterpart of MongoModel
+
+    The CRUD methods have the same signatures as in MongoModel, but are
+    coroutines. The on_delete hook is a coroutine as well.
+
+    """
+    mongo = async_mongo
+
+    @classmethod
+    def get_collection(cls, operation=None):
+        """Return the model collection configured for an operation type"""
+        return cls.mongo.collection(cls.collection, operation=operation)
+
+    @classmethod
+    async def id_exists(cls, _id):
+        if not isinstance(_id, ObjectId):
+            _id = ObjectId(_id)
+
+        n = await cls.get_collection('read').count_documents({'_id': _id})
+        return n > 0
+
+    async def create(self, operation='write'):
+        d = self._doc
+        if self.id is not None:
+            d['_id'] = self.id
+
+        res = await self.get_collection(operation).insert_one(d)
+        self._id = res.inserted_id
+
+        # the whole document was written
+        self.mark_clean()
+
+    async def update(self, data={}, operation='write'):
+        """Update the database document
+
+        Same as MongoModel.update, only the changed fields are written.
+
+        Returns
+        -------
+        acknowledged : bool
+            False if nothing had to be written, True otherwise.
+
+        """
+        for key, value in data.items():
+            setattr(self, key, value)
+
+        d = self.take_changes()
+        if len(d) == 0:
+            return False
+
+        try:
+            await self.get_collection(operation).update_one({'_id': self.id},
+                                                            d)
+        except Exception:
+            # keep the changes for a retried save
+            self.restore_changes(d)
+            raise
+        return True
+
+    async def save(self, operation='write'):
+        if self.id is not None:
+            await self.update(operation=operation)
+        else:
+            await self.create(operation=operation)
+
+    async def delete(self):
+        res = await self.get_collection('write').delete_one({'_id': self.id})
+
+        if res.deleted_count == 0:
+            return False
+        else:
+            await self.on_delete([self.id])
+            return True
+
+    @classmethod
+    async def on_delete(cls, ids):
+        """Clean up associated artifacts, see MongoModel.on_delete"""
+        pass
+
+    @classmethod
+    async def get(cls, _id, filter={}, fields=None):
+        if cls.collection is None:
+            raise ValueError('No collection set on child class')
+
+        if not isinstance(_id, ObjectId):
+            try:
+                _id = ObjectId(_id)
+            except InvalidId:
+                return None
+
+        _filter = dict(filter)
+        _filter.update({'_id': _id})
+
+        res = await cls.get_collection('read').find_one(_filter, fields)
+        if res is None:
+            return None
+
+        return cls.from_document(res)
+
+    @classmethod
+    async def get_all(cls, filter={}, fields=None, view=False):
+        """Load all matching documents into a list
+
+        See MongoModel.get_all. Use iter_all to stream large results.
+
+        """
+        return [doc async for doc in cls.iter_all(filter, fields, view=view)]
+
+    @classmethod
+    async def iter_all(cls, filter={}, fields=None, view=False):
+        """Iterate over all matching documents
+
+        Async generator of model instances, or of read-only view_class
+        instances if view is True.
+
+        """
+        if cls.collection is None:
+            raise ValueError('No collection set on child class')
+
+        coll = cls.get_collection('list')
+        if view:
+            coll = coll.with_options(
+                codec_options=CodecOptions(document_class=RawBSONDocument)
+            )
+            async for doc in coll.find(filter, fields):
+                yield cls.view_class(doc)
+        else:
+            async for doc in coll.find(filter, fields):
+                yield cls.from_document(doc)
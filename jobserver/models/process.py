@@ -2,11 +2,27 @@
 Main model class for handling a process
 """
 from datetime import datetime as dt
+import shutil
 import subprocess
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
 
 import pandas as pd
 
+from jobserver import metrics
 from jobserver.errors import CodeBlockMissingError
+from jobserver.models.mongo_async import async_mongo
+from jobserver.models.profile import Profiler, JobProfile
+from jobserver.models.result import ResultStore
+
+# util-linux prlimit sets the limits of a command before it is executed
+PRLIMIT = shutil.which('prlimit')
+
 
 class Process:
     def __init__(self, f, data, args, kwargs, job):
@@ -16,6 +32,33 @@ class Process:
         self.args = args
         self.kwargs = kwargs
         self.job = job
+        self.queued = None
+        self.timer = metrics.PhaseTimer()
+        self.heartbeat_interval = None
+
+        # registered script and its shared context
+        self.spec = None
+        self.context = None
+
+        # requested resources. The memory limit is enforced on subprocesses
+        self.cores = 1
+        self.memory_limit = None
+
+        # store DataFrame results as Arrow stream, see jobserver.models.result
+        self.store_table = False
+
+        # profiling settings
+        self.profile = False
+        self.profile_top_n = 30
+        self.profile_stats = True
+
+    @property
+    def name(self):
+        return self.f.__name__
+
+    def enqueue(self):
+        """Mark the Process as queued for execution"""
+        self.queued = time.perf_counter()
 
     def run(self):
         """Run this tool
@@ -24,40 +67,186 @@ class Process:
         -------
 
         """
-        # set the start date
-        self.job.started = dt.utcnow()
-        self.job.save()
+        # record the time waited for execution
+        if self.queued is not None:
+            wait = time.perf_counter() - self.queued
+            self.timer.add('queue_wait', wait)
+            metrics.job_queue_wait.labels(self.name).observe(wait)
+
+        # a Job submitted twice by a lapsed claim runs only once
+        with self.timer.phase('persistence'):
+            started = self.job.mark_started()
+        if not started:
+            print('Process skipped, the Job was already started')
+            return
+
+        metrics.active_workers.inc()
+        if self.spec is not None:
+            self.spec.acquire()
+        heartbeat = self.start_heartbeat()
+        try:
+            self._execute()
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+            if self.spec is not None:
+                self.spec.release()
+            metrics.active_workers.dec()
+            self.save_timings()
+            self.record_usage()
+            metrics.registry.maybe_dump()
+
+    def fail(self, error):
+        """Mark the Job as errored by an error outside of the script
+
+        Called by the scheduler, if running the Process raised, like on a
+        failed save of the Job. The result of the Job is dropped, as it
+        might have caused the error.
+
+        """
+        print('Process failed: %s' % str(error))
+        metrics.jobs_total.labels(self.name, 'error').inc()
+        try:
+            self.job.error = True
+            self.job.message = str(error)
+            self.job.finished = None
+            self.job.result = None
+            self.job.save(operation='result')
+            self.job.on_error()
+        except Exception as e:
+            print('Marking the Job as errored failed: %s' % str(e))
+
+    def follow(self, leader):
+        """Finish the Job with the outcome of an identical Process
+
+        Called by the scheduler, if this Process was coalesced with the
+        leader Process, after the leader has finished. A leader, which did
+        not finish, failed.
+
+        """
+        job, done = self.job, leader.job
+        job.coalesced_with = done.id
+        job.started = done.started
+        job.finished = done.finished
+        job.time_sec = done.time_sec
+        if done.error or done.finished is None:
+            job.error = True
+            job.message = done.message or \
+                'The identical Job %s did not finish.' % str(done.id)
+            job.save(operation='result')
+            job.on_error()
+        else:
+            job.result = done.result
+            job.save(operation='result')
+        metrics.jobs_total.labels(self.name, 'coalesced').inc()
+
+    def start_heartbeat(self):
+        """Start the async heartbeat of the Job, if configured
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            The running heartbeat, to be cancelled after the execution, or
+            None if no heartbeat is configured.
+
+        """
+        if self.heartbeat_interval is None or self.job.id is None:
+            return None
+        # the job module imports this module
+        from jobserver.models.job import AsyncJob
+
+        return async_mongo.submit(
+            AsyncJob.send_heartbeats(self.job.id, self.heartbeat_interval)
+        )
+
+    def record_usage(self):
+        """Account the core-seconds of the execution to the user"""
+        seconds = self.timer.phases.get('execution', 0.0)
+        try:
+            self.job.record_usage(self.cores * seconds)
+        except Exception as e:
+            print('Recording the usage failed: %s' % str(e))
+
+    def save_table(self, df):
+        """Store a DataFrame result for the binary download formats"""
+        try:
+            size = ResultStore.save(self.job.id, df)
+        except Exception as e:
+            print('Storing the result table failed: %s' % str(e))
+            return
+        metrics.job_result_size.labels(self.name).observe(size)
+
+    def save_timings(self):
+        """Persist the phase timings into the Job"""
+        self.job.timings = self.timer.to_dict()
+        self.job.save(operation='progress')
+
+    def _execute(self):
         print('Process started')
 
         # run
         try:
-            output = self._run()
+            # the first Job of a script in this process runs its setup
+            if self.spec is not None:
+                with self.timer.phase('setup'):
+                    self.context = self.spec.context()
+
+            t1 = time.perf_counter()
+            with self.timer.phase('execution'):
+                if self.profile:
+                    output = self._run_profiled()
+                else:
+                    output = self._run()
         except Exception as e:
             print('Process errored')
-            self.job.error = True
-            self.job.message = str(e)
-            self.job.save()
-            self.job.on_error(user=self.job.user)
+            metrics.jobs_total.labels(self.name, 'error').inc()
+            with self.timer.phase('persistence'):
+                self.job.error = True
+                self.job.message = str(e)
+                self.job.save(operation='result')
+            self.job.on_error()
             return None
+        metrics.job_run_time.labels(self.name).observe(
+            time.perf_counter() - t1
+        )
 
-        if isinstance(output, pd.DataFrame):
-            output = output.to_dict()
+        with self.timer.phase('result_conversion'):
+            if isinstance(output, pd.DataFrame):
+                if self.store_table:
+                    self.save_table(output)
+                output = output.to_dict()
 
         # finished
-        self.job.finished = dt.utcnow()
-        self.job.time_sec = (self.job.finished -
-                             self.job.started).total_seconds()
-        self.job.result = output
-        self.job.save()
+        with self.timer.phase('persistence'):
+            self.job.finished = dt.utcnow()
+            self.job.time_sec = (self.job.finished -
+                                 self.job.started).total_seconds()
+            self.job.result = output
+            self.job.save(operation='result')
+        metrics.jobs_total.labels(self.name, 'success').inc()
         print('Process finished')
         return None
 
     def _run(self):
+        if self.spec is not None and self.spec.accepts_context:
+            return self.f(self.data, *self.args, context=self.context,
+                          **self.kwargs)
         return self.f(self.data, *self.args, **self.kwargs)
 
+    def _run_profiled(self):
+        """Run under cProfile and store the profile along with the Job"""
+        profiler = Profiler(top_n=self.profile_top_n)
+        try:
+            with profiler:
+                return self._run()
+        finally:
+            JobProfile.from_profiler(
+                self.job.id, profiler, store_stats=self.profile_stats
+            ).create()
+
     def to_dict(self):
         return {
-            'name': self.f.__name__,
+            'name': self.name,
             'type': self.type,
             'args': self.args,
             'kwargs': self.kwargs
@@ -76,6 +265,10 @@ class EvalProcess(Process):
         super(EvalProcess, self).__init__(None, data, args, kwargs, job)
         self.type = 'eval'
 
+    @property
+    def name(self):
+        return 'eval'
+
     def _run(self):
         return eval(
             self.codeblock, 
@@ -95,15 +288,47 @@ class FileProcess(Process):
         super(FileProcess, self).__init__(None, data, args, kwargs, job)
         self.type = 'file'
 
+    @property
+    def name(self):
+        return self.filename
+
+    def _command(self):
+        """Return the command, run under prlimit if memory is limited"""
+        command = [self.filename, self.data, *self.args]
+        if self.memory_limit is not None and PRLIMIT is not None:
+            command = [PRLIMIT, '--as=%d' % self.memory_limit, '--'] + \
+                command
+        return command
+
+    def _limit_memory(self, pid):
+        """Limit the address space of a running subprocess
+
+        Only used without prlimit. The subprocess runs unlimited until the
+        limit is set. preexec_fn is not used, as it can deadlock the child
+        of a threaded server.
+
+        """
+        if resource is None or not hasattr(resource, 'prlimit'):
+            return
+        try:
+            resource.prlimit(pid, resource.RLIMIT_AS,
+                             (self.memory_limit, self.memory_limit))
+        except OSError:
+            # the subprocess exited already
+            pass
+
     def _run(self):
-        process_result = subprocess.run(
-            [self.filename, self.data, *self.args],
+        process = subprocess.Popen(
+            self._command(),
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE
         )
+        if self.memory_limit is not None and PRLIMIT is None:
+            self._limit_memory(process.pid)
+        stdout, stderr = process.communicate()
 
         # check if an error occured
-        if process_result.stderr != b'':
-            raise RuntimeError(process_result.stderr.decode())
+        if stderr != b'':
+            raise RuntimeError(stderr.decode())
         else:
-            return process_result.stdout.decode()
+            return stdout.decode()
@@ -0,0 +1,94 @@
+"""
+Profiling reports of Job executions.
+
+A Job can be started with the 'profile' flag set. Then, the Process runs the
+script function under cProfile and stores a JobProfile into its own
+collection. The profile holds a compact report of the top functions by
+cumulative time and, optionally, the raw pstats data, which can be loaded
+into pstats.Stats or any pstats compatible viewer.
+"""
+import cProfile
+import marshal
+import pstats
+from datetime import datetime as dt
+
+from bson.binary import Binary
+
+from jobserver.models.mongo import MongoModel
+
+# do not store raw stats larger than this
+MAX_STATS_SIZE = 8 * 1024 * 1024
+
+
+class Profiler:
+    """cProfile wrapper used as context manager
+
+    Examples
+    --------
+    >>> profiler = Profiler(top_n=10)
+    >>> with profiler:
+    ...     run_something()
+    >>> profiler.report()
+
+    """
+    def __init__(self, top_n=30):
+        self.top_n = top_n
+        self.profiler = cProfile.Profile()
+        self._stats = None
+
+    def __enter__(self):
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.profiler.disable()
+        return False
+
+    @property
+    def stats(self):
+        if self._stats is None:
+            self._stats = pstats.Stats(self.profiler)
+        return self._stats
+
+    def report(self):
+        """Return the top_n functions, sorted by cumulative time"""
+        report = []
+        for (filename, line, name), (cc, nc, tt, ct, _) in \
+                self.stats.stats.items():
+            report.append({
+                'function': '%s:%d(%s)' % (filename, line, name),
+                'ncalls': nc,
+                'primitive_calls': cc,
+                'tottime': tt,
+                'cumtime': ct
+            })
+        report.sort(key=lambda r: r['cumtime'], reverse=True)
+        return report[:self.top_n]
+
+    def dumps(self):
+        """Return the marshalled pstats data, as pstats.dump_stats does"""
+        return marshal.dumps(self.stats.stats)
+
+
+class JobProfile(MongoModel):
+    """Profile of a Job execution. The id is the id of the profiled Job"""
+    collection = 'job_profiles'
+
+    def __init__(self, created=None, report=None, stats=None, **kwargs):
+        super(JobProfile, self).__init__(**kwargs)
+        self.created = created
+        self.report = report
+        self.stats = stats
+
+    @classmethod
+    def from_profiler(cls, job_id, profiler, store_stats=True):
+        stats = profiler.dumps() if store_stats else None
+        if stats is not None and len(stats) > MAX_STATS_SIZE:
+            stats = None
+
+        return cls(
+            _id=job_id,
+            created=dt.utcnow(),
+            report=profiler.report(),
+            stats=Binary(stats) if stats is not None else None
+        )
@@ -0,0 +1,116 @@
+"""
+Time-windowed quotas of Job executions.
+
+Besides the plain 'job_quota' count on the User, the usage of each user is
+accounted in fixed time windows in the quota_usage collection. Each window
+is a single document, identified by the user, the kind of usage and the
+start of the window. A unique index on these fields makes the consumption
+a single, race-free round-trip: the increment only matches while the
+usage is below the limit. If the limit is reached, the upsert collides
+with the existing window document and the consumption fails.
+
+Supported kinds are:
+
+* jobs_per_hour: number of started Jobs per hour.
+* cpu_seconds_per_day: core-seconds of finished Jobs per day, which is
+  the execution time times the requested cores. The limit is checked on
+  Job start, the usage is added when the Job is done.
+
+The limits are read from the User attribute of the same name, or from the
+QUOTA_JOBS_PER_HOUR and QUOTA_CPU_SECONDS_PER_DAY config values. Old
+windows are removed by a TTL index after QUOTA_USAGE_TTL_DAYS.
+"""
+from datetime import datetime as dt, timedelta
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from jobserver.models.mongo import MongoModel
+
+# kind of usage and window length in seconds
+WINDOWS = {
+    'jobs_per_hour': 3600,
+    'cpu_seconds_per_day': 86400,
+}
+
+
+class QuotaUsage(MongoModel):
+    collection = 'quota_usage'
+    _indexed = False
+
+    @staticmethod
+    def window_start(kind, now=None):
+        """Return the start of the window of kind containing now"""
+        if now is None:
+            now = dt.utcnow()
+        seconds = WINDOWS[kind]
+        epoch = dt(1970, 1, 1)
+        offset = int((now - epoch).total_seconds()) // seconds * seconds
+        return epoch + timedelta(seconds=offset)
+
+    @classmethod
+    def ensure_indexes(cls, ttl_days=7):
+        if cls._indexed:
+            return
+        coll = cls.get_collection()
+        coll.create_index([('user_id', ASCENDING), ('kind', ASCENDING),
+                           ('start', ASCENDING)], unique=True)
+        coll.create_index([('start', ASCENDING)],
+                          expireAfterSeconds=int(ttl_days * 86400))
+        cls._indexed = True
+
+    @classmethod
+    def consume(cls, user_id, kind, limit, amount=1):
+        """Consume amount of the current window, if below the limit
+
+        Parameters
+        ----------
+        user_id : str
+            The id of the user.
+        kind : str
+            One of the keys of WINDOWS.
+        limit : float
+            The usage limit of the window.
+        amount : float
+            The amount to consume. 0 only checks the limit.
+
+        Returns
+        -------
+        consumed : bool
+            False, if the limit of the window is already reached.
+
+        """
+        # a new window is inserted by the upsert without checking the limit
+        if limit <= 0 or amount > limit:
+            return False
+        _filter = {'user_id': user_id, 'kind': kind,
+                   'start': cls.window_start(kind),
+                   'used': {'$lt': limit}}
+        try:
+            cls.get_collection('write').update_one(
+                _filter, {'$inc': {'used': amount}}, upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    @classmethod
+    def add(cls, user_id, kind, amount):
+        """Add usage to the current window without checking any limit"""
+        cls.get_collection('write').update_one(
+            {'user_id': user_id, 'kind': kind,
+             'start': cls.window_start(kind)},
+            {'$inc': {'used': amount}}, upsert=True
+        )
+
+    @classmethod
+    def usage(cls, user_id):
+        """Return the usage of the current windows by kind"""
+        docs = cls.get_collection('read').find({
+            'user_id': user_id,
+            '$or': [{'kind': k, 'start': cls.window_start(k)}
+                    for k in WINDOWS]
+        })
+        usage = {k: 0 for k in WINDOWS}
+        usage.update({d['kind']: d['used'] for d in docs})
+        return usage
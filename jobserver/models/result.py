@@ -0,0 +1,229 @@
+"""
+Binary formats of Job results and data objects.
+
+General
+-------
+Results and data objects are sent as JSON by default. Clients can request
+another format by the Accept header or by the 'format' URL parameter:
+
+=========  ====================================  ========
+format     mimetype                              needs
+=========  ====================================  ========
+json       application/json
+arrow      application/vnd.apache.arrow.stream   pyarrow
+parquet    application/vnd.apache.parquet        pyarrow
+msgpack    application/msgpack                   msgpack
+=========  ====================================  ========
+
+The optional dependencies are installed by:
+
+.. code-block:: bash
+
+    pip install jobserver[formats]
+
+Arrow and Parquet need tabular data. If a script returns a pandas
+DataFrame, the Process stores it as Arrow IPC stream into the GridFS
+bucket 'job_results', along with the JSON result in the Job. The Arrow and
+Parquet responses are built from that stream, without converting the data
+into Python objects. Results without a stored stream and data objects are
+converted from their JSON form. The stream is removed with its Job.
+"""
+import pandas as pd
+from gridfs import GridFSBucket
+from gridfs.errors import NoFile
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from jobserver.errors import UnsupportedFormatError
+from jobserver.models.mongo import mongo
+
+MIMETYPES = {
+    'json': 'application/json',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+    'msgpack': 'application/msgpack',
+}
+
+# other mimetypes in use for the formats
+ALIASES = {
+    'application/x-parquet': 'parquet',
+    'application/x-msgpack': 'msgpack',
+}
+
+
+def available_formats():
+    """Return the formats supported by the installed packages"""
+    formats = ['json']
+    if pa is not None:
+        formats.extend(['arrow', 'parquet'])
+    if msgpack is not None:
+        formats.append('msgpack')
+    return formats
+
+
+def negotiate(accept=None, fmt=None):
+    """Return the requested format
+
+    The 'format' URL parameter takes precedence over the Accept header.
+    If the Accept header matches none of the formats, JSON is used.
+
+    Parameters
+    ----------
+    accept : str
+        The Accept header of the request.
+    fmt : str
+        The 'format' URL parameter of the request.
+
+    Raises
+    ------
+    error : UnsupportedFormatError
+        If an unknown format is requested, or a format whose package is not
+        installed.
+
+    """
+    available = available_formats()
+    if fmt is not None:
+        fmt = fmt.lower()
+        if fmt not in MIMETYPES:
+            raise UnsupportedFormatError('Unknown format %s. Use one of %s.'
+                                         % (fmt, ', '.join(available)))
+        if fmt not in available:
+            raise UnsupportedFormatError('The format %s is not installed on '
+                                         'this server.' % fmt)
+        return fmt
+
+    if not accept:
+        return 'json'
+    offers = [MIMETYPES[f] for f in available] + \
+        [m for m, f in ALIASES.items() if f in available]
+    match = parse_accept_header(accept, MIMEAccept).best_match(offers)
+    if match is None:
+        return 'json'
+    return ALIASES.get(match) or \
+        next(f for f, m in MIMETYPES.items() if m == match)
+
+
+def to_table(value):
+    """Convert a DataFrame or its JSON form into a pyarrow Table
+
+    Raises
+    ------
+    error : UnsupportedFormatError
+        If the value is not tabular.
+
+    """
+    if isinstance(value, pa.Table):
+        return value
+    if not isinstance(value, pd.DataFrame):
+        try:
+            value = pd.DataFrame(value)
+        except (TypeError, ValueError):
+            raise UnsupportedFormatError('The data is not tabular and cannot '
+                                         'be sent as Arrow or Parquet.')
+    return pa.Table.from_pandas(value)
+
+
+def _msgpack_default(obj):
+    # timestamps and other non-native values are sent as string
+    return str(obj)
+
+
+def serialize(fmt, value):
+    """Serialize a result into one of the binary formats
+
+    Parameters
+    ----------
+    fmt : str
+        One of 'arrow', 'parquet' or 'msgpack'.
+    value : object
+        A pyarrow Table, a DataFrame or any JSON serializable result.
+
+    Returns
+    -------
+    body : bytes
+
+    Raises
+    ------
+    error : UnsupportedFormatError
+        If the value cannot be serialized into the format.
+
+    """
+    if fmt == 'msgpack':
+        if pa is not None and isinstance(value, pa.Table):
+            value = value.to_pydict()
+        elif isinstance(value, pd.DataFrame):
+            value = value.to_dict(orient='list')
+        return msgpack.packb(value, default=_msgpack_default,
+                             use_bin_type=True)
+
+    if fmt not in ('arrow', 'parquet'):
+        raise UnsupportedFormatError('Unknown format %s.' % fmt)
+
+    # columns of mixed types cannot be converted
+    try:
+        table = to_table(value)
+        sink = pa.BufferOutputStream()
+        if fmt == 'arrow':
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+        else:
+            pq.write_table(table, sink)
+    except pa.ArrowException as e:
+        raise UnsupportedFormatError('The data cannot be sent as %s: %s'
+                                     % (fmt, str(e)))
+    return sink.getvalue().to_pybytes()
+
+
+class ResultStore:
+    """Arrow IPC streams of DataFrame results in GridFS
+
+    The stream of a Job is stored under the id of the Job.
+
+    """
+    bucket = 'job_results'
+
+    @classmethod
+    def enabled(cls):
+        return pa is not None
+
+    @classmethod
+    def save(cls, job_id, df):
+        """Store a DataFrame result and return its size in bytes"""
+        bucket = GridFSBucket(mongo.db, bucket_name=cls.bucket)
+        cls.delete([job_id])
+        body = serialize('arrow', df)
+        bucket.upload_from_stream_with_id(
+            job_id, str(job_id), body, metadata={'format': 'arrow'}
+        )
+        return len(body)
+
+    @classmethod
+    def load(cls, job_id):
+        """Return the stored result as pyarrow Table, or None"""
+        if pa is None:
+            return None
+        bucket = GridFSBucket(mongo.db, bucket_name=cls.bucket)
+        try:
+            stream = bucket.open_download_stream(job_id)
+        except NoFile:
+            return None
+        return pa.ipc.open_stream(stream.read()).read_all()
+
+    @classmethod
+    def delete(cls, ids):
+        """Remove the stored results of the Jobs"""
+        mongo.collection('%s.files' % cls.bucket, 'write')\
+            .delete_many({'_id': {'$in': ids}})
+        mongo.collection('%s.chunks' % cls.bucket, 'write')\
+            .delete_many({'files_id': {'$in': ids}})
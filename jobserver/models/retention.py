@@ -0,0 +1,241 @@
+"""
+Retention policy for finished Jobs.
+
+The jobs collection would grow forever, slowing down every listing and
+filter. The retention policy periodically moves finished Jobs older than a
+configured number of days into an archive collection. The archived documents
+keep all summary fields, while the result is either kept, compressed or
+dropped. Optionally, the archive collection itself is cleaned by a MongoDB
+TTL index.
+
+The policy is configured by the application config:
+
+* JOB_RETENTION_DAYS: archive Jobs finished more than this number of days
+  ago. If None, the retention worker is not started.
+* JOB_RETENTION_INTERVAL: seconds between two compaction runs.
+* JOB_ARCHIVE_COLLECTION: name of the archive collection.
+* JOB_ARCHIVE_RESULTS: one of 'keep', 'compress' or 'drop'.
+* JOB_ARCHIVE_TTL_DAYS: remove archived Jobs after this number of days. If
+  None, archived Jobs are kept forever.
+
+Every server process starts a retention worker, but only one of them
+archives at a time. The workers compete for a lease document in the
+LEASE_COLLECTION. The holder renews the lease on each run. If it stops,
+the lease expires after two intervals and another worker takes over.
+
+"""
+import os
+import socket
+import uuid
+import zlib
+from threading import Thread, Event
+from datetime import datetime as dt, timedelta
+
+import bson
+from bson.binary import Binary
+from pymongo import ASCENDING, ReplaceOne
+from pymongo.errors import DuplicateKeyError
+
+from jobserver.models.mongo import mongo
+from jobserver.models.job import Job
+
+RESULT_POLICIES = ('keep', 'compress', 'drop')
+
+LEASE_COLLECTION = 'leases'
+
+
+def compress_result(result):
+    """Compress a Job result into a BSON Binary"""
+    return Binary(zlib.compress(bson.encode({'result': result})))
+
+
+def decompress_result(blob):
+    """Restore a Job result compressed by compress_result"""
+    return bson.decode(zlib.decompress(blob))['result']
+
+
+class RetentionPolicy:
+    def __init__(self, days, results='compress', collection='jobs_archive',
+                 ttl_days=None, batch_size=500):
+        if results not in RESULT_POLICIES:
+            raise ValueError('results has to be one of %s'
+                             % str(RESULT_POLICIES))
+        self.days = days
+        self.results = results
+        self.collection = collection
+        self.ttl_days = ttl_days
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            days=config.get('JOB_RETENTION_DAYS'),
+            results=config.get('JOB_ARCHIVE_RESULTS', 'compress'),
+            collection=config.get('JOB_ARCHIVE_COLLECTION', 'jobs_archive'),
+            ttl_days=config.get('JOB_ARCHIVE_TTL_DAYS')
+        )
+
+    def cutoff(self):
+        return dt.utcnow() - timedelta(days=self.days)
+
+    def ensure_indexes(self, db):
+        """Create the indexes used by the retention policy
+
+        The jobs collection gets an index on 'finished' to find the Jobs
+        to be archived. If a ttl is configured, the archive collection gets
+        a TTL index on 'archived'.
+
+        """
+        db[Job.collection].create_index([('finished', ASCENDING)])
+        if self.ttl_days is not None:
+            db[self.collection].create_index(
+                [('archived', ASCENDING)],
+                expireAfterSeconds=int(self.ttl_days * 86400)
+            )
+
+    def to_archive(self, doc, archived):
+        """Turn a Job document into its archived form"""
+        doc['archived'] = archived
+        result = doc.pop('result', None)
+
+        if self.results == 'keep':
+            doc['result'] = result
+        elif self.results == 'compress' and result is not None:
+            doc['result_compressed'] = compress_result(result)
+
+        return doc
+
+    def archive(self, db, renew=None):
+        """Move old finished Jobs into the archive collection
+
+        Jobs are moved in batches. Each batch is first written into the
+        archive collection and then deleted from the jobs collection. As
+        the archive writes are upserts, an interrupted run can safely be
+        repeated.
+
+        Parameters
+        ----------
+        db : pymongo.database.Database
+            The database holding the jobs and archive collection.
+        renew : callable
+            Optional function called before each batch, e.g. to renew a
+            lease. The archival stops, if it returns False.
+
+        Returns
+        -------
+        archived : int
+            Number of archived Jobs.
+
+        """
+        jobs = db[Job.collection]
+        archive = db[self.collection]
+        _filter = {'finished': {'$lt': self.cutoff()}}
+        archived = 0
+
+        while True:
+            if renew is not None and not renew():
+                break
+            batch = list(jobs.find(_filter, limit=self.batch_size))
+            if len(batch) == 0:
+                break
+
+            # write the archive documents
+            now = dt.utcnow()
+            archive.bulk_write([
+                ReplaceOne({'_id': doc['_id']}, self.to_archive(doc, now),
+                           upsert=True)
+                for doc in batch
+            ], ordered=False)
+
+            # remove from the hot collection
+            ids = [doc['_id'] for doc in batch]
+            archived += jobs.delete_many({'_id': {'$in': ids}}).deleted_count
+            Job.on_delete(ids)
+
+        return archived
+
+
+class RetentionWorker(Thread):
+    """Background thread running the RetentionPolicy periodically"""
+    def __init__(self, app, policy, interval):
+        super(RetentionWorker, self).__init__(daemon=True)
+        self.app = app
+        self.policy = policy
+        self.interval = interval
+        self.stopped = Event()
+        self.owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(),
+                                   uuid.uuid4().hex[:8])
+
+    def acquire(self, db, name='retention'):
+        """Take or renew the lease of the archival
+
+        Returns
+        -------
+        acquired : bool
+            True, if this worker holds the lease for the next two intervals.
+            False, if another worker holds it.
+
+        """
+        now = dt.utcnow()
+        try:
+            db[LEASE_COLLECTION].update_one(
+                {'_id': name,
+                 '$or': [{'owner': self.owner}, {'expires': {'$lt': now}}]},
+                {'$set': {'owner': self.owner,
+                          'expires': now + timedelta(
+                              seconds=2 * self.interval)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # the lease is held and the upsert collided with it
+            return False
+        return True
+
+    def run(self):
+        with self.app.app_context():
+            indexed = False
+
+            while True:
+                try:
+                    if not indexed:
+                        self.policy.ensure_indexes(mongo.db)
+                        indexed = True
+                    if self.acquire(mongo.db):
+                        # renew the lease per batch, as long runs outlast it
+                        n = self.policy.archive(
+                            mongo.db, renew=lambda: self.acquire(mongo.db)
+                        )
+                        if n > 0:
+                            self.app.logger.info('Archived %d Jobs' % n)
+                except Exception as e:
+                    self.app.logger.error('Job archival failed: %s' % str(e))
+
+                if self.stopped.wait(self.interval):
+                    break
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Retention:
+    def __init__(self, app=None):
+        self.policy = None
+        self.worker = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Start the retention worker if a retention is configured"""
+        if app.config.get('JOB_RETENTION_DAYS') is None:
+            return
+
+        self.policy = RetentionPolicy.from_config(app.config)
+        self.worker = RetentionWorker(
+            app=app,
+            policy=self.policy,
+            interval=app.config.get('JOB_RETENTION_INTERVAL', 3600)
+        )
+        self.worker.start()
+
+
+retention = Retention()
@@ -16,6 +16,7 @@ from itsdangerous import BadSignature, SignatureExpired, \
     TimedJSONWebSignatureSerializer as Serializer
 
 from .mongo import MongoModel
+from .mongo_async import AsyncMongoModel
 
 
 class User(MongoModel):
@@ -35,7 +36,7 @@ class User(MongoModel):
         if res is None:
             return None
         else:
-            return User(**res)
+            return User.from_document(res)
 
     @property
     def password(self):
@@ -47,15 +48,19 @@ class User(MongoModel):
         # save a password hash instead of a password
         if key == 'password':
             key = '_pw_hash'
-            value = sha256(value.encode()).hexdigest()
+            value = User.hash_password(value)
         super(User, self).__setattr__(key=key, value=value)
 
+    @staticmethod
+    def hash_password(password):
+        return sha256(password.encode()).hexdigest()
+
     @classmethod
     def email_exists(cls, email):
         return cls.mongo.db.users.count_documents({'email': email}) > 0
 
     def verify_password(self, password):
-        return sha256(password.encode()).hexdigest() == self._pw_hash
+        return User.hash_password(password) == self._pw_hash
 
     def is_activated(self):
         return self.activated is True
@@ -83,24 +88,37 @@ class User(MongoModel):
         return serializer.dumps({'id': str(self.id)})
 
     @classmethod
-    def get_from_access_token(cls, token):
+    def decode_access_token(cls, token, config=None):
+        """Return the user id from an access token
+
+        Raises BadSignature or SignatureExpired for invalid tokens. If no
+        config is passed, the config of the current app is used.
+
+        """
+        if config is None:
+            config = current_app.config
+
         # create JSON Web Signature
         serializer = Serializer(
-            current_app.config['SECRET_KEY'],
-            expires_in=current_app.config.get('ACCESS_TOKEN_LIFESPAN', 600)
+            config['SECRET_KEY'],
+            expires_in=config.get('ACCESS_TOKEN_LIFESPAN', 600)
         )
 
         # extract the payload
         payload = serializer.loads(token)
 
-        return User.get(_id=payload['id'])
+        return payload['id']
 
-    def create(self):
+    @classmethod
+    def get_from_access_token(cls, token):
+        return User.get(_id=cls.decode_access_token(token))
+
+    def create(self, operation='write'):
         if User.email_exists(self.email):
             raise ValueError('The mail %s already exists.' % self.email)
-        super(User, self).create()
+        super(User, self).create(operation=operation)
 
-    def update(self, data={}):
+    def update(self, data={}, operation='write'):
         # check if a new mail shall be set
         new_mail = data.get('email', self.email)
 
@@ -113,6 +131,23 @@ class User(MongoModel):
                              new_mail)
 
         # call parent method
-        super(User, self).update(data=data)
+        return super(User, self).update(data=data, operation=operation)
 
 
+class AsyncUser(AsyncMongoModel):
+    """Async access to the users, used by the ASGI authorization"""
+    collection = 'users'
+
+    @classmethod
+    async def get_by_email(cls, email):
+        res = await cls.get_collection('read').find_one({'email': email})
+        if res is None:
+            return None
+        else:
+            return cls.from_document(res)
+
+    def verify_password(self, password):
+        return User.hash_password(password) == self._pw_hash
+
+    def is_activated(self):
+        return self.activated is True
@@ -0,0 +1,83 @@
+"""
+Lightweight read-only views on MongoDB documents.
+
+A DocumentView wraps a document as returned by the database without copying
+it into a model instance. It is meant for the list and read paths, where
+thousands of documents are only serialized and never edited. In combination
+with bson.raw_bson.RawBSONDocument, sub-documents are decoded only when they
+are accessed.
+"""
+from collections.abc import Mapping
+
+from bson import decode
+from bson.raw_bson import RawBSONDocument
+
+
+def _decode(value):
+    """Recursively convert raw BSON documents into plain Python objects"""
+    if isinstance(value, RawBSONDocument):
+        # decode the whole sub-document at once
+        return decode(value.raw)
+    elif isinstance(value, Mapping):
+        return {k: _decode(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+def _stringify(val):
+    if isinstance(val, dict):
+        return {k: _stringify(v) for k, v in val.items()}
+    return str(val)
+
+
+class DocumentView(object):
+    """Read-only view on a single document
+
+    Attribute access mirrors MongoModel: any key of the document can be
+    accessed as attribute and missing keys return None. Decoded values are
+    cached on first access.
+
+    """
+    __slots__ = ('_raw', '_cache')
+
+    def __init__(self, raw):
+        object.__setattr__(self, '_raw', raw)
+        object.__setattr__(self, '_cache', None)
+
+    @property
+    def id(self):
+        return self._raw.get('_id')
+
+    def __getattr__(self, item):
+        if item.startswith('__'):
+            raise AttributeError(item)
+
+        # decode on first access
+        cache = self._cache
+        if cache is None:
+            cache = dict()
+            object.__setattr__(self, '_cache', cache)
+        if item not in cache:
+            cache[item] = _decode(self._raw.get(item))
+        return cache[item]
+
+    def __setattr__(self, key, value):
+        raise AttributeError('%s is read-only.' % self.__class__.__name__)
+
+    def __delattr__(self, item):
+        raise AttributeError('%s is read-only.' % self.__class__.__name__)
+
+    def __contains__(self, item):
+        return item in self._raw
+
+    def keys(self):
+        return self._raw.keys()
+
+    def to_dict(self, stringify=False):
+        d = _decode(self._raw)
+
+        if stringify:
+            return _stringify(d)
+        else:
+            return d
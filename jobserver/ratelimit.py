@@ -0,0 +1,237 @@
+"""
+Token bucket rate limiting of the API.
+
+General
+-------
+Every request is assigned to a route group by its method and endpoint.
+Each user (or client address, if no user is logged in) has a token bucket
+per group. The bucket holds up to 'burst' tokens and is refilled by 'rate'
+tokens per second. Each request takes one token. If the bucket is empty,
+the request is answered by 429 Too Many Requests, with a Retry-After
+header telling the client when the next token is available.
+
+The limiter is configured by the application config:
+
+* RATELIMIT_ENABLED: turn the rate limiting on or off.
+* RATELIMIT_BACKEND: 'memory' keeps the buckets in the process, which is
+  only correct for a single worker process. 'mongo' keeps the buckets in
+  the RATELIMIT_COLLECTION, shared by all processes.
+* RATELIMIT_GROUPS: dict of group name and a list of endpoints, optionally
+  prefixed by the method, like 'PUT apiv1.job'. Requests not matching any
+  group belong to the 'default' group.
+* RATELIMIT_RULES: dict of group name and its limits, like
+  {'rate': 1, 'burst': 10}. A 'roles' dict can hold other limits per user
+  role. A limit of None disables the rate limit, a rate of 0 or less denies
+  all requests of the group. Groups without a rule use the 'default' rule.
+
+Single users can get own limits by a 'rate_limits' attribute, which has the
+same form as RATELIMIT_RULES.
+"""
+import math
+import time
+from datetime import datetime as dt
+from threading import Lock
+
+from pymongo import ASCENDING, ReturnDocument
+
+DEFAULT_RULE = {'rate': 10, 'burst': 20}
+
+# Retry-After of groups denied by a rate of 0
+DENY_RETRY_AFTER = 60.
+
+
+class MemoryBackend:
+    """Token buckets held in the memory of the process"""
+    def __init__(self, max_buckets=100000):
+        self.buckets = dict()
+        self.max_buckets = max_buckets
+        self._lock = Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        """Take cost tokens from a bucket
+
+        Returns
+        -------
+        allowed : bool
+            True, if the tokens were taken.
+        retry_after : float
+            Seconds until enough tokens are available, 0 if allowed.
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self.buckets.get(key, (burst, now))[:2]
+            tokens = min(burst, tokens + (now - updated) * rate)
+
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+
+            if len(self.buckets) >= self.max_buckets:
+                self._evict(now)
+            # each bucket keeps its limits, they differ by group and role
+            self.buckets[key] = (tokens, now, rate, burst)
+
+        if allowed:
+            return True, 0.
+        return False, (cost - tokens) / rate
+
+    def _evict(self, now):
+        """Drop full buckets, or else the least recently used half"""
+        self.buckets = {k: v for k, v in self.buckets.items()
+                        if v[0] + (now - v[1]) * v[2] < v[3]}
+        if len(self.buckets) >= self.max_buckets:
+            recent = sorted(self.buckets.items(), key=lambda kv: kv[1][1])
+            self.buckets = dict(recent[len(recent) // 2:])
+
+
+class MongoBackend:
+    """Token buckets shared by all processes through MongoDB
+
+    Each bucket is one document, which is refilled and taken from by a
+    single update with an aggregation pipeline. Needs MongoDB 4.2 or later.
+
+    """
+    def __init__(self, collection, ttl=3600):
+        self.collection = collection
+        self.ttl = ttl
+        self._indexed = False
+
+    def take(self, key, rate, burst, cost=1):
+        from jobserver.models.mongo import mongo
+
+        coll = mongo.collection(self.collection, operation='write')
+        if not self._indexed:
+            coll.create_index([('updated', ASCENDING)],
+                              expireAfterSeconds=self.ttl)
+            self._indexed = True
+
+        now = dt.utcnow()
+        elapsed = {'$divide': [
+            {'$subtract': [now, {'$ifNull': ['$updated', now]}]}, 1000.
+        ]}
+        doc = coll.find_one_and_update({'_id': key}, [
+            {'$set': {
+                'tokens': {'$min': [burst, {'$add': [
+                    {'$ifNull': ['$tokens', burst]},
+                    {'$multiply': [elapsed, rate]}
+                ]}]},
+                'updated': now
+            }},
+            {'$set': {'allowed': {'$gte': ['$tokens', cost]}}},
+            {'$set': {'tokens': {'$cond': [
+                '$allowed', {'$subtract': ['$tokens', cost]}, '$tokens'
+            ]}}}
+        ], upsert=True, return_document=ReturnDocument.AFTER)
+
+        if doc['allowed']:
+            return True, 0.
+        return False, (cost - doc['tokens']) / rate
+
+
+class RateLimiter:
+    def __init__(self, app=None):
+        self.enabled = False
+        self.backend = None
+        self.groups = dict()
+        self.rules = dict()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.enabled = config.get('RATELIMIT_ENABLED', False)
+        if config.get('RATELIMIT_BACKEND', 'memory') == 'mongo':
+            self.backend = MongoBackend(
+                config.get('RATELIMIT_COLLECTION', 'rate_limits')
+            )
+        else:
+            self.backend = MemoryBackend()
+
+        # map the endpoints to their group
+        self.groups = dict()
+        for group, endpoints in config.get('RATELIMIT_GROUPS', {}).items():
+            for endpoint in endpoints:
+                method, _, name = endpoint.rpartition(' ')
+                self.groups[(method.upper() or None, name)] = group
+
+        self.rules = dict(config.get('RATELIMIT_RULES') or {})
+        self.rules.setdefault('default', DEFAULT_RULE)
+
+    def group(self, method, endpoint):
+        group = self.groups.get((method, endpoint))
+        if group is None:
+            group = self.groups.get((None, endpoint), 'default')
+        return group
+
+    def rule(self, group, role=None, user_limits=None):
+        """Return the rule of a group for a user, or None if unlimited"""
+        if user_limits is not None and group in user_limits:
+            return user_limits[group]
+
+        rule = self.rules.get(group, self.rules['default'])
+        if rule is not None and role in rule.get('roles', {}):
+            return rule['roles'][role]
+        return rule
+
+    def hit(self, method, endpoint, identity, role=None, user_limits=None):
+        """Count a request against its bucket
+
+        Returns
+        -------
+        allowed : bool
+        retry_after : float
+            Seconds until the request would be allowed.
+
+        """
+        if not self.enabled:
+            return True, 0.
+        group = self.group(method, endpoint)
+        rule = self.rule(group, role=role, user_limits=user_limits)
+        if rule is None or rule.get('rate') is None:
+            return True, 0.
+        if float(rule['rate']) <= 0:
+            return False, DENY_RETRY_AFTER
+
+        return self.backend.take('%s:%s' % (group, identity),
+                                 rate=float(rule['rate']),
+                                 burst=float(rule.get('burst', rule['rate'])))
+
+    def check(self):
+        """Flask before_request hook
+
+        Returns a 429 response, if the request exceeds the rate limit.
+
+        """
+        from flask import request, g, jsonify
+
+        if not self.enabled or request.method.lower() == 'options':
+            return None
+
+        user = g.get('user')
+        if user is not None:
+            identity, role = str(user.id), user.role
+            user_limits = user.rate_limits
+        else:
+            identity, role, user_limits = request.remote_addr, None, None
+
+        allowed, retry_after = self.hit(request.method, request.endpoint,
+                                        identity, role, user_limits)
+        if allowed:
+            return None
+
+        response = jsonify(too_many_requests(retry_after))
+        response.status_code = 429
+        response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        return response
+
+
+def too_many_requests(retry_after):
+    return {
+        'status': 429,
+        'message': 'Too many requests. Retry after %d seconds.'
+                   % int(math.ceil(retry_after))
+    }
+
+
+limiter = RateLimiter()
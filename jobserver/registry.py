@@ -0,0 +1,364 @@
+"""
+Registry of the available script functions.
+
+General
+-------
+The registry is built once on application startup from the scripts module.
+For each script function, the signature, description, version and resource
+hints are extracted and kept in a ScriptSpec. The listing of all scripts is
+serialized only once and served with an ETag. The arguments of a Job are
+validated against the signature before the Job is started, so Jobs with bad
+arguments fail without occupying a worker.
+
+Any public function of the scripts module is registered. Further script
+sources are added by the jobserver.loader module. Additional
+metadata can be attached by the register_script decorator:
+
+>>> @register_script(version='1.2', resources={'cores': 2})
+... def summary(data, percentiles=(25, 50, 75)):
+...     pass
+
+Expensive state, like loaded models or lookup tables, is built by a setup
+function once per worker and passed to each call as read-only context:
+
+>>> @register_script(setup=lambda: {'model': load_model()})
+... def predict(data, context=None):
+...     return context['model'].predict(data)
+
+"""
+import atexit
+import hashlib
+import inspect
+import json
+from threading import RLock
+from types import MappingProxyType
+
+from jobserver.errors import ScriptNotFoundError, ScriptArgumentError
+
+# attribute holding the register_script options of a function
+SCRIPT_ATTR = '__jobserver_script__'
+
+
+def register_script(func=None, name=None, version=None, resources=None,
+                    setup=None, teardown=None, coalesce=True):
+    """Mark a function as script and attach metadata
+
+    The function itself is not changed and can still be called directly.
+
+    Parameters
+    ----------
+    name : str
+        Name of the script, defaults to the function name.
+    version : str
+        Version of the script, recorded along with each Job.
+    resources : dict
+        Resource hints used by the scheduler: 'cores', 'memory' (bytes or a
+        string like '1G') and the expected 'duration' in seconds.
+    setup : callable
+        Called without arguments once per worker process, before the first
+        Job of this script is run. The return value is the context of the
+        script. It is passed to every call of the script as 'context'
+        keyword, if the script accepts one. The context is shared by all
+        Jobs and must not be changed.
+    teardown : callable
+        Called with the context, when the worker shuts down or the script
+        was replaced by a new version.
+    coalesce : bool
+        If True, identical Jobs of this script, which are started while one
+        of them is queued or running, share its execution and result. Set
+        it to False for scripts with side effects.
+
+    """
+    options = {'name': name, 'version': version, 'resources': resources,
+               'setup': setup, 'teardown': teardown, 'coalesce': coalesce}
+    if func is None:
+        return lambda f: register_script(f, **options)
+
+    setattr(func, SCRIPT_ATTR, options)
+    return func
+
+
+def source_version(func):
+    """Version of an unversioned script, derived from its source code"""
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        return None
+    return 'src-%s' % hashlib.sha1(source.encode()).hexdigest()[:12]
+
+
+def _jsonable(value):
+    try:
+        json.dumps(value)
+        return value
+    except (TypeError, ValueError):
+        return repr(value)
+
+
+class ScriptSpec:
+    """Metadata and lifecycle of a registered script function
+
+    The first argument of each script is the Job data, which is not part of
+    the Job arguments. Therefore it is not listed in 'arguments' and not
+    expected by bind. The same applies to the 'context' argument, which is
+    filled from the setup function.
+
+    """
+    def __init__(self, func, name=None, version=None, resources=None,
+                 setup=None, teardown=None, source=None, coalesce=True):
+        self.func = func
+        self.name = name or func.__name__
+        self.version = version if version is not None else \
+            source_version(func)
+        self.source = source
+        self.resources = dict(resources or {})
+        self.coalesce = coalesce
+        self.description = inspect.getdoc(func)
+        self.signature = inspect.signature(func)
+
+        # lifecycle
+        self.setup = setup
+        self.teardown = teardown
+        self.accepts_context = 'context' in self.signature.parameters
+        self._context = None
+        self._ready = False
+        self._users = 0
+        self._retired = False
+        self._lock = RLock()
+
+        self.arguments = [self._describe(p) for p in
+                          list(self.signature.parameters.values())[1:]
+                          if p.name != 'context']
+
+    @staticmethod
+    def _describe(param):
+        d = {'name': param.name, 'kind': param.kind.name.lower(),
+             'required': param.default is param.empty and
+             param.kind not in (param.VAR_POSITIONAL, param.VAR_KEYWORD)}
+        if param.default is not param.empty:
+            d['default'] = _jsonable(param.default)
+        if param.annotation is not param.empty:
+            d['annotation'] = getattr(param.annotation, '__name__',
+                                      str(param.annotation))
+        return d
+
+    def bind(self, args=(), kwargs=None):
+        """Validate Job arguments against the signature
+
+        Raises
+        ------
+        error : ScriptArgumentError
+            If the arguments do not match the signature.
+
+        """
+        kwargs = dict(kwargs or {})
+        if self.accepts_context:
+            if 'context' in kwargs:
+                raise ScriptArgumentError('The context of script %s cannot '
+                                          'be passed.' % self.name)
+            kwargs['context'] = None
+        try:
+            return self.signature.bind(None, *args, **kwargs)
+        except TypeError as e:
+            raise ScriptArgumentError('Invalid arguments for script %s: %s'
+                                      % (self.name, str(e)))
+
+    def context(self):
+        """Return the shared context, run setup on first use
+
+        A dict returned by setup is wrapped into a read-only mapping. If
+        setup fails, it is tried again on the next call.
+
+        """
+        if self._ready:
+            return self._context
+        with self._lock:
+            if not self._ready:
+                context = self.setup() if self.setup is not None else None
+                if isinstance(context, dict):
+                    context = MappingProxyType(context)
+                self._context = context
+                self._ready = True
+        return self._context
+
+    def acquire(self):
+        """Mark the script as used by a running Job"""
+        with self._lock:
+            self._users += 1
+
+    def release(self):
+        """Mark a Job as finished. A retired script is closed when idle"""
+        with self._lock:
+            self._users -= 1
+            close = self._retired and self._users == 0
+        if close:
+            self.close()
+
+    def retire(self):
+        """Close the script as soon as no Job is using it anymore"""
+        with self._lock:
+            self._retired = True
+            close = self._users == 0
+        if close:
+            self.close()
+
+    def close(self):
+        """Run teardown, if the script was set up"""
+        with self._lock:
+            if not self._ready:
+                return
+            context, self._context, self._ready = self._context, None, False
+        if self.teardown is not None:
+            self.teardown(context)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'description': self.description,
+            'version': self.version,
+            'resources': self.resources,
+            'coalesce': self.coalesce,
+            'parameters': list(self.signature.parameters.keys()),
+            'arguments': self.arguments
+        }
+
+
+class ScriptRegistry:
+    def __init__(self):
+        self._scripts = dict()
+        self._listing = None
+        self._lock = RLock()
+
+    def register(self, func, **options):
+        """Register a single function. Options overwrite the decorator"""
+        spec = self._spec(func, **options)
+        with self._lock:
+            old = self._scripts.get(spec.name)
+            self._scripts[spec.name] = spec
+            self._listing = None
+        if old is not None:
+            old.retire()
+        return spec
+
+    @staticmethod
+    def _spec(func, **options):
+        opts = dict(getattr(func, SCRIPT_ATTR, {}))
+        opts.update(options)
+        return ScriptSpec(func, **opts)
+
+    @staticmethod
+    def collect(module, own_only=False):
+        """Return the script functions of a module
+
+        Private names, modules and the on_init hook are skipped. If own_only
+        is True, only functions defined in the module itself are returned.
+
+        """
+        funcs = []
+        for attr in dir(module):
+            if attr.startswith('_') or attr == 'on_init':
+                continue
+            obj = getattr(module, attr)
+            if not (inspect.isfunction(obj) or hasattr(obj, SCRIPT_ATTR)):
+                continue
+            if own_only and getattr(obj, '__module__', None) != \
+                    module.__name__:
+                continue
+            funcs.append(obj)
+        return funcs
+
+    def load_module(self, module, own_only=False):
+        """Register all script functions of a module
+
+        The scripts replace all scripts previously loaded from the module.
+
+        """
+        self.replace(module.__name__, self.collect(module, own_only))
+
+    def replace(self, source, funcs):
+        """Atomically replace all scripts of a source
+
+        The new ScriptSpecs are built first, then the scripts previously
+        registered from source are removed and the new ones are added in
+        one step. Requests never see a partially loaded source.
+
+        Parameters
+        ----------
+        source : str
+            Name of the source, like a module name.
+        funcs : list
+            The script functions of the source.
+
+        """
+        specs = [self._spec(f, source=source) for f in funcs]
+        with self._lock:
+            scripts = {n: s for n, s in self._scripts.items()
+                       if s.source != source}
+            scripts.update({s.name: s for s in specs})
+            replaced = [s for s in self._scripts.values()
+                        if scripts.get(s.name) is not s]
+            self._scripts = scripts
+            self._listing = None
+
+        # tear down the old versions, once their Jobs are finished
+        for spec in replaced:
+            spec.retire()
+
+    def warm_up(self, source=None):
+        """Set up all scripts, or all scripts of a source
+
+        Returns
+        -------
+        errors : dict
+            Error messages of failed setups by script name.
+
+        """
+        errors = dict()
+        for spec in list(self._scripts.values()):
+            if spec.setup is None or (source is not None and
+                                      spec.source != source):
+                continue
+            try:
+                spec.context()
+            except Exception as e:
+                errors[spec.name] = str(e)
+        return errors
+
+    def close(self):
+        """Tear down all scripts. Called on interpreter shutdown"""
+        for spec in list(self._scripts.values()):
+            try:
+                spec.close()
+            except Exception:
+                pass
+
+    def get(self, name):
+        try:
+            return self._scripts[name]
+        except KeyError:
+            raise ScriptNotFoundError('A script %s cannot be found.' % name)
+
+    def __contains__(self, name):
+        return name in self._scripts
+
+    def __len__(self):
+        return len(self._scripts)
+
+    def listing(self):
+        """Return the cached listing of all scripts and its ETag"""
+        with self._lock:
+            if self._listing is None:
+                specs = sorted(self._scripts.values(), key=lambda s: s.name)
+                payload = {
+                    'found': len(specs),
+                    'scripts': [s.to_dict() for s in specs]
+                }
+                etag = hashlib.sha1(
+                    json.dumps(payload, sort_keys=True).encode()
+                ).hexdigest()
+                self._listing = (payload, etag)
+            return self._listing
+
+
+registry = ScriptRegistry()
+atexit.register(registry.close)
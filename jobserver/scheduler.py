@@ -0,0 +1,426 @@
+"""
+Scheduling of Job executions.
+
+General
+-------
+Started Jobs are not run right away, but submitted to the Scheduler. The
+Scheduler runs the Jobs on a bounded pool of worker threads and decides
+which Job runs next:
+
+* Every user has an own queue. Within the queue, Jobs of higher priority
+  run first, Jobs of the same priority in submission order.
+* The queues are served by deficit round robin. In each round, a queue
+  earns a quantum weighted by the role of its user and spends it on the
+  cost of its Jobs. Thus, a user submitting hundreds of Jobs cannot starve
+  anybody else, while a single user still gets all workers when nobody
+  else is waiting.
+* A number of workers is reserved for admins and superusers. Jobs of other
+  users are only started as long as more than that number of workers is
+  left idle.
+
+The scheduler is configured by the application config:
+
+* SCHEDULER_WORKERS: number of worker threads.
+* SCHEDULER_RESERVED_WORKERS: workers reserved for admin Jobs.
+* SCHEDULER_ROLE_WEIGHTS: dict of the fair-share weight per role. The
+  'default' key is used for users without a listed role. All weights have
+  to be positive.
+
+Resources
+---------
+Each Job requests resources: 'cores', 'memory' and the expected 'duration'
+in seconds. The requests are taken from the resource hints of the script,
+which can be raised by a 'resources' dict on the Job. The Scheduler
+bin-packs the Jobs onto its capacity of SCHEDULER_CORES cores and
+SCHEDULER_MEMORY memory: if the next Job of a queue does not fit into the
+free capacity, a smaller Job of the same or another queue is started
+instead. If a Job could not be started for SCHEDULER_BACKFILL_LIMIT
+seconds, no other Jobs are started until it fits. The cost of a Job in the
+fair-share rounds is its number of cores times its duration.
+
+Memory can be given in bytes or as string like '512M' or '2G'. The memory
+request is enforced as address space limit on script files run in a
+subprocess.
+
+Single flight
+-------------
+Jobs can be submitted with a fingerprint of their script, arguments and
+input data. While a Job of the same fingerprint is queued or running, the
+new Job is not queued, but attached to it. When the first Job finishes, its
+outcome is copied to all attached Jobs. Thus, many identical Jobs started
+at the same time are executed only once. This is turned off by setting
+SCHEDULER_SINGLE_FLIGHT to False.
+
+"""
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from threading import Thread, Condition
+
+from jobserver import metrics
+from jobserver.errors import ResourceLimitError
+
+PRIVILEGED_ROLES = ('admin', 'superuser')
+
+MEMORY_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+DEFAULT_RESOURCES = {'cores': 1, 'memory': None, 'duration': None}
+
+# number of queued Jobs per user checked for a fitting one
+BACKFILL_DEPTH = 16
+
+
+def parse_memory(value):
+    """Convert a memory size like '512M' into bytes"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+
+    value = str(value).strip().upper().rstrip('B')
+    try:
+        if value[-1:] in MEMORY_UNITS:
+            return int(float(value[:-1]) * MEMORY_UNITS[value[-1]])
+        return int(float(value))
+    except ValueError:
+        raise ValueError('%s is not a valid memory size.' % value)
+
+
+def parse_resources(*hints):
+    """Merge resource hints
+
+    Later hints can raise, but not lower the cores and memory of earlier
+    ones. The duration is taken from the last hint that sets it.
+
+    Returns
+    -------
+    resources : dict
+        'cores' (float), 'memory' (int bytes or None) and 'duration' (float
+        seconds or None).
+
+    """
+    resources = dict(DEFAULT_RESOURCES)
+    for i, hint in enumerate(hints):
+        hint = hint or {}
+        try:
+            cores = float(hint.get('cores', resources['cores']))
+            memory = parse_memory(hint.get('memory', resources['memory']))
+            duration = hint.get('duration', resources['duration'])
+            duration = float(duration) if duration is not None else None
+        except (TypeError, ValueError) as e:
+            raise ValueError('Invalid resources: %s' % str(e))
+
+        if i > 0:
+            cores = max(cores, resources['cores'])
+            if resources['memory'] is not None:
+                memory = max(memory or 0, resources['memory'])
+        resources.update(cores=cores, memory=memory, duration=duration)
+    return resources
+
+
+class Task:
+    __slots__ = ('process', 'key', 'role', 'priority', 'cores', 'memory',
+                 'cost', 'submitted', 'fingerprint')
+
+    def __init__(self, process, key, role=None, priority=0, resources=None,
+                 fingerprint=None):
+        resources = resources or DEFAULT_RESOURCES
+        self.process = process
+        self.fingerprint = fingerprint
+        self.key = key
+        self.role = role
+        self.priority = priority
+        self.cores = resources.get('cores') or 0.
+        self.memory = resources.get('memory') or 0
+        self.cost = max(self.cores, 1.) * max(resources.get('duration') or 1.,
+                                               1.)
+        self.submitted = time.perf_counter()
+
+    @property
+    def privileged(self):
+        return self.role in PRIVILEGED_ROLES
+
+
+class Scheduler:
+    def __init__(self, app=None):
+        self.workers = 4
+        self.reserved = 0
+        self.weights = {'default': 1.0}
+        self.cores = float(os.cpu_count() or 1)
+        self.memory = None
+        self.backfill_limit = 60.
+        self.single_flight = True
+
+        self.used_cores = 0.
+        self.used_memory = 0
+        self._blocked = None
+
+        self.queues = dict()
+        self.active = deque()
+        self.deficit = dict()
+        self.roles = dict()
+        self.running = 0
+        self.running_general = 0
+        self.flights = dict()
+
+        self._counter = itertools.count()
+        self._cond = Condition()
+        self._threads = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure the scheduler and start the worker threads"""
+        config = app.config
+        with self._cond:
+            self.workers = max(1, config.get('SCHEDULER_WORKERS', 4))
+            self.reserved = min(config.get('SCHEDULER_RESERVED_WORKERS', 0),
+                                self.workers - 1)
+            weights = dict(config.get('SCHEDULER_ROLE_WEIGHTS') or {})
+            weights.setdefault('default', 1.0)
+            # a queue without weight would never earn a quantum
+            for role, weight in weights.items():
+                if not weight > 0:
+                    raise ValueError('The weight of role %s has to be '
+                                     'positive, got %s.' % (role, weight))
+            self.weights = weights
+            self.cores = float(config.get('SCHEDULER_CORES') or
+                               os.cpu_count() or 1)
+            self.memory = parse_memory(config.get('SCHEDULER_MEMORY'))
+            self.backfill_limit = config.get('SCHEDULER_BACKFILL_LIMIT', 60.)
+            self.single_flight = config.get('SCHEDULER_SINGLE_FLIGHT', True)
+
+            while len(self._threads) < self.workers:
+                thread = Thread(target=self._work, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify_all()
+
+    def weight(self, role):
+        return self.weights.get(role, self.weights['default'])
+
+    @property
+    def queued(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def check(self, resources):
+        """Check that the resources can ever be provided
+
+        Raises
+        ------
+        error : ResourceLimitError
+            If the resources exceed the capacity of the Scheduler.
+
+        """
+        if resources['cores'] > self.cores:
+            raise ResourceLimitError('%s cores requested, but only %s '
+                                     'available.' % (resources['cores'],
+                                                     self.cores))
+        if self.memory is not None and resources['memory'] is not None and \
+                resources['memory'] > self.memory:
+            raise ResourceLimitError('%d bytes of memory requested, but only '
+                                     '%d available.' % (resources['memory'],
+                                                        self.memory))
+
+    def fits(self, task):
+        """Check if the task fits into the free capacity"""
+        if self.used_cores + task.cores > self.cores:
+            return False
+        if self.memory is not None and \
+                self.used_memory + task.memory > self.memory:
+            return False
+        return True
+
+    def submit(self, process, key=None, role=None, priority=0,
+               resources=None, fingerprint=None):
+        """Queue a Process for execution
+
+        Parameters
+        ----------
+        process : jobserver.models.process.Process
+            The Process to run.
+        key : str
+            The fair-share key, usually the user id.
+        role : str
+            Role of the user, used for the weight and reserved workers.
+        priority : int
+            Jobs of higher priority are run first within the user queue.
+        resources : dict
+            The resources requested by the Job, see parse_resources.
+        fingerprint : str
+            Identifies identical Jobs. If a Process of the same fingerprint
+            is queued or running, this Process is attached to it instead.
+
+        Returns
+        -------
+        task : Task
+            The queued Task, or None if the Process was attached to an
+            identical one.
+
+        """
+        if not self.single_flight:
+            fingerprint = None
+        task = Task(process, key or 'anonymous', role, priority, resources,
+                    fingerprint)
+        with self._cond:
+            if fingerprint is not None:
+                followers = self.flights.get(fingerprint)
+                if followers is not None:
+                    followers.append(process)
+                    metrics.coalesced_jobs.labels(process.name).inc()
+                    return None
+                self.flights[fingerprint] = []
+
+            queue = self.queues.get(task.key)
+            if queue is None:
+                queue = self.queues[task.key] = []
+                self.active.append(task.key)
+                self.deficit[task.key] = 0.
+            self.roles[task.key] = role
+            heapq.heappush(queue, (-priority, next(self._counter), task))
+            metrics.queued_jobs.inc()
+            self._cond.notify()
+        return task
+
+    def _eligible(self, key):
+        """Check if the queue may start a Job on an idle worker"""
+        if self.roles.get(key) in PRIVILEGED_ROLES:
+            return True
+        return self.running_general < self.workers - self.reserved
+
+    def _next(self):
+        """Pick the next Task by deficit round robin, or None"""
+        keys = [k for k in self.active if self._eligible(k)]
+        if len(keys) == 0:
+            return None
+
+        # a Job waiting too long for its resources blocks all others
+        if self._blocked not in self.queues:
+            self._blocked = None
+        if self._blocked is None:
+            now = time.perf_counter()
+            waiting = [k for k in keys if not self.fits(self._head(k)) and
+                       now - self._head(k).submitted > self.backfill_limit]
+            if len(waiting) > 0:
+                self._blocked = min(waiting,
+                                    key=lambda k: self._head(k).submitted)
+        if self._blocked is not None:
+            if not self.fits(self._head(self._blocked)):
+                return None
+            key, self._blocked = self._blocked, None
+            return self._take(key)
+
+        # bin-packing: only queues with a fitting Job take part
+        candidates = dict()
+        for key in keys:
+            entry = self._fitting(key)
+            if entry is not None:
+                candidates[key] = entry
+        if len(candidates) == 0:
+            return None
+        quantum = max(e[2].cost for e in candidates.values())
+
+        while True:
+            key = self.active[0]
+            if key not in candidates:
+                self.active.rotate(-1)
+                continue
+
+            if self.deficit[key] < candidates[key][2].cost:
+                # earn the quantum and go to the end of the round
+                self.deficit[key] += self.weight(self.roles.get(key)) * \
+                    quantum
+                self.active.rotate(-1)
+                continue
+
+            return self._take(key, candidates[key])
+
+    def _head(self, key):
+        return self.queues[key][0][2]
+
+    def _fitting(self, key):
+        """Return the first queue entry fitting into the free capacity
+
+        Only the first BACKFILL_DEPTH entries in priority order are checked.
+
+        """
+        queue = self.queues[key]
+        if self.fits(queue[0][2]):
+            return queue[0]
+        for entry in heapq.nsmallest(BACKFILL_DEPTH, queue)[1:]:
+            if self.fits(entry[2]):
+                return entry
+        return None
+
+    def _take(self, key, entry=None):
+        queue = self.queues[key]
+        if entry is None or entry is queue[0]:
+            _, _, task = heapq.heappop(queue)
+        else:
+            queue.remove(entry)
+            heapq.heapify(queue)
+            task = entry[2]
+        self.deficit[key] -= task.cost
+        if len(queue) == 0:
+            del self.queues[key]
+            del self.deficit[key]
+            del self.roles[key]
+            self.active.remove(key)
+        return task
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = self._next()
+                while task is None:
+                    self._cond.wait()
+                    task = self._next()
+                self.running += 1
+                if not task.privileged:
+                    self.running_general += 1
+                self.used_cores += task.cores
+                self.used_memory += task.memory
+                metrics.queued_jobs.dec()
+
+            try:
+                task.process.run()
+            except Exception as e:
+                # errors outside of the script, like failed saves
+                task.process.fail(e)
+            finally:
+                with self._cond:
+                    self.running -= 1
+                    if not task.privileged:
+                        self.running_general -= 1
+                    self.used_cores -= task.cores
+                    self.used_memory -= task.memory
+                    followers = self.flights.pop(task.fingerprint, []) \
+                        if task.fingerprint is not None else []
+                    self._cond.notify_all()
+
+            # share the outcome with the identical Processes
+            for process in followers:
+                try:
+                    process.follow(task.process)
+                except Exception as e:
+                    process.fail(e)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'reserved': self.reserved,
+                'running': self.running,
+                'cores': self.cores,
+                'used_cores': self.used_cores,
+                'memory': self.memory,
+                'used_memory': self.used_memory,
+                'queued': self.queued,
+                'coalesced': sum(len(f) for f in self.flights.values()),
+                'queues': {k: len(q) for k, q in self.queues.items()}
+            }
+
+
+scheduler = Scheduler()
@@ -10,6 +10,18 @@ instance and can be of any JSONifyable type.
 The output should preferably be a pandas.DataFrame, pandas.Series,
 numpy.ndarray or a plain text.
 
+All public functions imported here are registered as scripts on startup.
+The jobserver.registry.register_script decorator can be used to attach a
+version and resource hints to a function:
+
+.. code-block:: python
+
+    from jobserver.registry import register_script
+
+    @register_script(version='1.0', resources={'cores': 2})
+    def my_script(data, window=10):
+        pass
+
 Notes
 -----
 
@@ -18,8 +30,19 @@ these packages have to be importable by the Python environment running the
 Flask server, or they have to be installable by pip and be defined in the
 requirements.txt upon setup.
 
-In case a process needs some kind of warmup, a warmup-function call can be
-added to the on_init function. That function will be called, after the Flask
+Scripts holding expensive state, like loaded models or lookup tables, should
+pass setup and teardown functions to register_script. The setup is run once
+per worker process and its result is passed to every call of the script as
+read-only 'context' keyword argument:
+
+.. code-block:: python
+
+    @register_script(setup=load_tables, teardown=close_tables)
+    def lookup(data, context=None):
+        return context['table'].loc[data]
+
+In case the server needs some other kind of warmup, a warmup-function call
+can be added to the on_init function. That function will be called, after the Flask
 app will be fully initialized. That means, that all the database connections
 used by the application and all of its routes are already bound to the
 application.
@@ -0,0 +1,31 @@
+"""
+Synthetic scripts for load tests. They do not use their data, but simulate
+I/O bound (sleep_for) and CPU bound (burn_cpu) workloads of a predictable
+duration. Each Job has to do its own work, so they are never coalesced.
+
+The scripts are only registered, if LOADTEST_SCRIPTS is set in the config.
+Their arguments are clamped to MAX_SECONDS and MAX_ITERATIONS.
+"""
+import time
+import hashlib
+
+from jobserver.registry import register_script
+
+MAX_SECONDS = 10.
+MAX_ITERATIONS = 10000000
+
+
+@register_script(version='1.0', resources={'cores': 0}, coalesce=False)
+def sleep_for(data, seconds=0.1):
+    seconds = min(max(float(seconds), 0.), MAX_SECONDS)
+    time.sleep(seconds)
+    return {'slept': seconds}
+
+
+@register_script(version='1.0', resources={'cores': 1}, coalesce=False)
+def burn_cpu(data, iterations=100000):
+    iterations = min(max(int(iterations), 0), MAX_ITERATIONS)
+    h = b'jobserver'
+    for _ in range(iterations):
+        h = hashlib.sha256(h).digest()
+    return {'iterations': iterations, 'digest': h.hex()}
@@ -6,7 +6,10 @@ import pandas as pd
 import time
 import random
 
+from jobserver.registry import register_script
 
+
+@register_script(version='1.0', resources={'cores': 1, 'duration': 3})
 def summary(df_or_filepath):
     if isinstance(df_or_filepath, str):
         df = pd.read_csv(df_or_filepath)
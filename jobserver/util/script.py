@@ -1,7 +1,8 @@
 """
 Utility functions for loading and handling Script instances
 """
-from jobserver.app import scripts
+from jobserver.errors import ScriptNotFoundError
+from jobserver.registry import registry
 
 
 def load_script_func(module, name):
@@ -22,20 +23,25 @@ def load_script_func(module, name):
     func : function
         A Python function that will be processed by a Process instance.
 
+    Raises
+    ------
+    error : ScriptNotFoundError
+        If the function does not exist.
+
     """
-    # switch the module
+    # scripts are looked up in the registry
     if module == 'scripts':
-        mod = scripts
-    else:
-        try:
-            mod = globals()[module]
-        except KeyError:
-            raise ValueError('The script module %s is not imported.'
-                             % module)
+        return registry.get(name).func
+
     try:
-        func = getattr(mod, name)
+        mod = globals()[module]
     except KeyError:
-        raise ValueError('A function %s cannot be found in %s.'
-                         % (name, module))
+        raise ValueError('The script module %s is not imported.'
+                         % module)
+    try:
+        func = getattr(mod, name)
+    except AttributeError:
+        raise ScriptNotFoundError('A function %s cannot be found in %s.'
+                                  % (name, module))
 
-    return func
\ No newline at end of file
+    return func
@@ -61,11 +61,21 @@ setup(name='jobserver',
       long_description=readme(),
       classifiers=classifiers(),
       install_requires=requirements(),
+      extras_require={
+          'asgi': ['motor', 'asgiref', 'uvicorn'],
+          'formats': ['pyarrow', 'msgpack'],
+          'loadtest': ['httpx']
+      },
       packages=find_packages(),
       cmdclass = {
           'develop': PostDevelopCommand,
           'install': PostInstallCommand
       },
+      entry_points={
+          'console_scripts': [
+              'jobserver-loadtest=jobserver.loadtest:main'
+          ]
+      },
       include_package_data=True,
       zip_safe=False
 )